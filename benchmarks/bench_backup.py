@@ -0,0 +1,169 @@
+"""
+Runs complete backups against a local fake pool, see
+`fakeserver.FakeXenServer`, and reports throughput, CPU time and peak
+memory of the xenbackup process.
+
+Every scenario starts a fresh fake pool in its own process and runs
+xenbackup.py in another, so the numbers are the client's alone. The
+per VM timings come from the run's --report. With --restore the backups
+are restored into the same fake pool afterwards, see `xenbackup.py restore`.
+
+Examples:
+
+    python benchmarks/bench_backup.py
+    python benchmarks/bench_backup.py --scenario few_huge --scale 0.25 \
+        --xenbackup_args "--parallel 2 --compression zstd"
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakeserver import FakePool, FakeXenServer, self_signed_certificate
+
+MB = 1024 * 1024
+
+XENBACKUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'xenbackup', 'xenbackup.py')
+
+# name -> (FakePool arguments, xenbackup arguments), sizes in MiB
+SCENARIOS = {
+    'many_small': (
+        dict(vm_sizes=[64] * 50),
+        ['--parallel', '4', '--max_per_sr', '2'],
+    ),
+    'few_huge': (
+        dict(vm_sizes=[4096, 4096]),
+        ['--parallel', '2'],
+    ),
+    'flaky_network': (
+        dict(vm_sizes=[256] * 8, export_failure=0.3, call_latency=0.02),
+        ['--parallel', '4', '--max_per_sr', '2', '--retry_max', '5'],
+    ),
+    'slow_snapshots': (
+        dict(vm_sizes=[128] * 8, snapshot_delay=3, snapshot_failure=0.1, destroy_delay=2),
+        ['--parallel', '2', '--snapshot_lookahead', '2'],
+    ),
+}
+
+
+def serve(pool_kwargs, certfile, keyfile, queue):
+    server = FakeXenServer(FakePool(**pool_kwargs), certfile, keyfile)
+    queue.put(server.host)
+    server.serve_forever()
+
+
+def run(command, verbose=False):
+    '''
+    :returns: tuple (status, seconds, resource usage) of the command
+    '''
+    started = time.time()
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, stderr=None if verbose else devnull)
+        # the usage of this child alone, not of the fake servers
+        _, status, usage = os.wait4(process.pid, 0)
+    return status, time.time() - started, usage
+
+
+def run_scenario(name, scale, extra_args, directory, certfile, keyfile, verbose=False, restore=False):
+    pool_kwargs, args = SCENARIOS[name]
+    pool_kwargs = dict(pool_kwargs, seed=1)
+    pool_kwargs['vm_sizes'] = [max(1, int(size * scale)) * MB for size in pool_kwargs['vm_sizes']]
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(pool_kwargs, certfile, keyfile, queue))
+    server.daemon = True
+    server.start()
+    path = os.path.join(directory, name)
+    os.mkdir(path)
+    report_path = os.path.join(directory, name + '.json')
+    host = queue.get()
+    try:
+        command = [
+            sys.executable, XENBACKUP,
+            '--host', host,
+            '--user', 'root',
+            '--password', 'bench',
+            '--path', path,
+            '--retry_delay', '0',
+            '--report', report_path,
+        ] + args + extra_args
+        status, wall, usage = run(command, verbose)
+        if restore and not status:
+            restore_status, restore_wall, restore_usage = run([
+                sys.executable, XENBACKUP, 'restore',
+                '--host', host,
+                '--user', 'root',
+                '--password', 'bench',
+                '--path', path,
+                '--vms', ','.join(n for n in sorted(os.listdir(path)) if os.path.isdir(os.path.join(path, n)) and not n.startswith('.')),
+                '--parallel', '4',
+                '--max_per_sr', '2',
+            ], verbose)
+    finally:
+        server.terminate()
+        shutil.rmtree(path, True)
+    if status:
+        print '{:<16} xenbackup exited with {}'.format(name, os.WEXITSTATUS(status))
+        return
+    with open(report_path) as f:
+        report = json.load(f)
+    vms = report['vms']
+    cpu = usage.ru_utime + usage.ru_stime
+    gigabytes = report['bytes'] / float(1024 * MB)
+    print '{:<16} {:>4} VMs {:>3} failed {:>8.1f} MB/s {:>7.1f} s {:>6.2f} CPU s/GB {:>6.0f} MiB RSS' \
+        ' {:>6.2f} s snapshot {:>6.2f} s first byte {:>4} retries'.format(
+            name,
+            len(vms),
+            report['failed'],
+            report['bytes'] / float(MB) / wall,
+            wall,
+            cpu / gigabytes if gigabytes else 0,
+            # KiB on Linux
+            usage.ru_maxrss / 1024.0,
+            sum(v['snapshot_seconds'] for v in vms) / max(1, len(vms)),
+            sum(v['first_byte_seconds'] or 0 for v in vms) / max(1, len(vms)),
+            sum(v['snapshot_retries'] + v['export_retries'] for v in vms),
+        )
+    if not restore:
+        return
+    if restore_status:
+        print '{:<16} xenbackup.py restore exited with {}'.format('', os.WEXITSTATUS(restore_status))
+        return
+    # throughput in exported bytes, however the archives are stored
+    print '{:<16} restore {:>8.1f} MB/s {:>7.1f} s {:>6.2f} CPU s/GB {:>6.0f} MiB RSS'.format(
+        '',
+        report['bytes'] / float(MB) / restore_wall,
+        restore_wall,
+        (restore_usage.ru_utime + restore_usage.ru_stime) / gigabytes if gigabytes else 0,
+        restore_usage.ru_maxrss / 1024.0,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', help='scenarios to run, all by default', default=None, nargs='+', choices=sorted(SCENARIOS))
+    parser.add_argument('--scale', help='factor for the VM sizes of the scenarios', default=1.0, type=float)
+    parser.add_argument('--xenbackup_args', help='extra arguments for xenbackup.py, e.g. "--compression gzip"', default='', type=str)
+    parser.add_argument('--path', help='directory to back up to, a temporary directory by default', default=None)
+    parser.add_argument('--restore', help='restore the backups afterwards and measure the restore as well', action='store_true')
+    parser.add_argument('--verbose', help='show the output of xenbackup.py', action='store_true')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.path)
+    try:
+        certfile, keyfile = self_signed_certificate(directory)
+        for name in args.scenario or sorted(SCENARIOS):
+            run_scenario(name, args.scale, shlex.split(args.xenbackup_args), directory,
+                         certfile, keyfile, args.verbose, args.restore)
+    finally:
+        shutil.rmtree(directory, True)
+
+
+if __name__ == '__main__':
+    main()
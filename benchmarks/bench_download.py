@@ -0,0 +1,110 @@
+"""
+Compares the old 8 KiB urllib2 read loop with the transfer engine used by
+_download_url, against a local fake export server.
+
+The server runs in its own process so the CPU time reported is only the
+client's.
+
+Example:
+
+    python benchmarks/bench_download.py --size 2048 --buffer_size 1 4 16
+"""
+
+import argparse
+import base64
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from xenbackup import transfer
+from fakeserver import ExportServer
+
+MB = 1024 * 1024
+
+
+def serve(size, queue):
+    server = ExportServer(size=size)
+    queue.put(server.url)
+    server.serve_forever()
+
+
+def legacy_download(url, path, auth):
+    request = urllib2.Request(url)
+    request.add_header('Authorization', 'Basic {}'.format(auth))
+    result = urllib2.urlopen(request)
+    with open(path, 'wb') as f:
+        block_sz = 8192
+        while True:
+            buffer = result.read(block_sz)
+            if not buffer:
+                break
+            f.write(buffer)
+
+
+def engine_download(url, path, auth, buffer_size, direct_io, drop_cache):
+    connection = transfer.ExportConnection(auth)
+    view = transfer.allocate_buffer(buffer_size)
+    writer = transfer.FileWriter(path, direct=direct_io, drop_cache=drop_cache,
+                                 buffer_size=buffer_size)
+    try:
+        transfer.copy(connection.get(url), writer, view)
+    finally:
+        writer.close()
+        connection.close()
+
+
+def measure(name, size, func, *args):
+    before = os.times()
+    started = time.time()
+    func(*args)
+    wall = time.time() - started
+    after = os.times()
+    cpu = (after[0] - before[0]) + (after[1] - before[1])
+    print '{:<28} {:>9.1f} MB/s {:>8.2f} CPU s/GB'.format(
+        name,
+        size / float(MB) / wall,
+        cpu / (size / float(1024 * MB)),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', help='export size in MiB', default=1024, type=int)
+    parser.add_argument('--buffer_size', help='buffer sizes in MiB to test', default=[1, 4, 16], nargs='+', type=int)
+    parser.add_argument('--path', help='directory to write to, a temporary directory by default', default=None)
+    parser.add_argument('--direct_io', action='store_true')
+    parser.add_argument('--drop_cache', action='store_true')
+    parser.add_argument('--skip_legacy', action='store_true')
+    args = parser.parse_args()
+
+    size = args.size * MB
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(size, queue))
+    server.daemon = True
+    server.start()
+    url = queue.get() + '/export?uuid=bench'
+    auth = base64.b64encode('root:bench')
+    path = os.path.join(args.path or tempfile.mkdtemp(), 'bench.xva')
+    try:
+        if not args.skip_legacy:
+            measure('urllib2 8 KiB', size, legacy_download, url, path, auth)
+        for buffer_size in args.buffer_size:
+            measure('transfer {} MiB{}{}'.format(
+                buffer_size,
+                ' direct' if args.direct_io else '',
+                ' dropcache' if args.drop_cache else '',
+            ), size, engine_download, url, path, auth, buffer_size * MB,
+                args.direct_io, args.drop_cache)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
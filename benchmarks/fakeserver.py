@@ -0,0 +1,740 @@
+"""
+A local stand-in for the XenServer HTTP handlers used by xenbackup,
+for benchmarking without a real pool.
+
+`ExportServer` only serves /export. `FakeXenServer` adds the XenAPI
+XML-RPC calls xenbackup makes, serves the exports of a `FakePool` as
+synthetic XVA archives, their disks as VHD and their metadata, and takes
+imports, over HTTPS like a real pool master.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import os
+import random
+import ssl
+import struct
+import subprocess
+import tarfile
+import threading
+import time
+import urlparse
+import uuid
+import xmlrpclib
+
+
+def synthetic_block(size=1024 * 1024):
+    '''
+    Half text, half zeros, roughly what an export of a mostly empty
+    disk looks like.
+    '''
+    half = size // 2
+    text = ('xenbackup synthetic export data\n' * (half // 32 + 1))[:half]
+    return text + '\0' * (size - half)
+
+
+class ExportHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path != '/export':
+            self.send_error(404)
+            return
+        size = self.server.export_size(query)
+        if size is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        self.stream(size, self.server.rate)
+
+    def stream(self, size, rate=None):
+        '''
+        Writes `size` bytes of synthetic data, at most `rate` bytes per second.
+        '''
+        block = self.server.block
+        started = time.time()
+        sent = 0
+        while sent < size:
+            data = block if size - sent >= len(block) else block[:size - sent]
+            self.wfile.write(data)
+            sent += len(data)
+            if rate:
+                ahead = sent / float(rate) - (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+class ExportServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), size=1024 ** 3, rate=None,
+                 handler=ExportHandler):
+        '''
+        :param size: int
+            bytes served for every export
+        :param rate: int
+            bytes per second per export, unlimited if None
+        '''
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.size = size
+        self.rate = rate
+        self.block = synthetic_block()
+
+    def export_size(self, query):
+        return self.size
+
+    def handle_error(self, request, client_address):
+        # clients hanging up in the middle of an export is expected
+        pass
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+
+XVA_CHUNK_SIZE = 1024 * 1024
+VHD_FOOTER_SIZE = 512
+
+
+def self_signed_certificate(directory):
+    '''
+    Creates a throw away certificate with the openssl command line tool.
+
+    :returns: tuple (certfile, keyfile)
+    '''
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-keyout', keyfile, '-out', certfile, '-days', '1',
+            '-subj', '/CN=localhost',
+        ], stdout=devnull, stderr=devnull)
+    return certfile, keyfile
+
+
+class XenAPIFailure(Exception):
+
+    def __init__(self, *details):
+        Exception.__init__(self, *details)
+        self.details = list(details)
+
+
+class FakePool(object):
+    '''
+    In memory records of a pool, with the latency and failures of the
+    XenAPI calls and the exports configurable.
+
+    Changes are recorded as events for event.from, the records are the
+    subset of the real ones xenbackup reads. Async calls run in a thread
+    of their own, as tasks.
+    '''
+
+    classes = ('VM', 'VBD', 'VDI', 'SR', 'VM_metrics', 'task')
+
+    def __init__(self, vm_sizes=(), srs=2, call_latency=0, snapshot_delay=0,
+                 snapshot_failure=0, export_rate=None, export_failure=0, halted=0, seed=None,
+                 destroy_delay=0, destroy_failure=0):
+        '''
+        :param vm_sizes: list
+            disk sizes in bytes, one VM with one disk per entry, or a
+            list of sizes per VM for VMs with several disks
+        :param srs: int
+            number of storage repositories the disks are spread over
+        :param call_latency: float
+            seconds added to every XenAPI call
+        :param snapshot_delay: float
+            seconds VM.snapshot takes
+        :param snapshot_failure: float
+            probability of VM.snapshot failing
+        :param export_rate: int
+            bytes per second per export, unlimited if None
+        :param export_failure: float
+            probability of an export breaking off halfway
+        :param halted: float
+            fraction of the VMs that are shut down
+        :param destroy_delay: float
+            seconds VDI.destroy takes
+        :param destroy_failure: float
+            probability of VDI.destroy failing
+        '''
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.call_latency = call_latency
+        self.snapshot_delay = snapshot_delay
+        self.snapshot_failure = snapshot_failure
+        self.export_rate = export_rate
+        self.export_failure = export_failure
+        self.destroy_delay = destroy_delay
+        self.destroy_failure = destroy_failure
+        self.local = threading.local()
+        self.records = dict((cls, {}) for cls in self.classes)
+        self.imports = []
+        self.events = []
+        self.calls = {}
+        self.counter = 0
+        self.host = 'OpaqueRef:host0'
+        srs = [self._add('SR', {'name_label': 'sr{}'.format(i)}) for i in range(max(1, srs))]
+        for i, sizes in enumerate(vm_sizes):
+            if not isinstance(sizes, (list, tuple)):
+                sizes = [sizes]
+            vm = self.add_vm('vm{:03d}'.format(i), sizes, srs[i % len(srs)])
+            if self.random.random() < halted:
+                self.records['VM'][vm].update(power_state='Halted', resident_on='OpaqueRef:NULL')
+
+    def _ref(self, cls):
+        self.counter += 1
+        return 'OpaqueRef:{}{}'.format(cls.lower(), self.counter)
+
+    def _add(self, cls, record):
+        ref = self._ref(cls)
+        record.setdefault('uuid', str(uuid.uuid4()))
+        self.records[cls][ref] = record
+        self.events.append((cls, 'add', ref))
+        return ref
+
+    def _destroy(self, cls, ref):
+        del self.records[cls][ref]
+        self.events.append((cls, 'del', ref))
+
+    def _modify(self, cls, ref, **values):
+        self.records[cls][ref].update(values)
+        self.events.append((cls, 'mod', ref))
+
+    def add_vm(self, name, sizes, sr, snapshot_of=None):
+        # the VMs were all started together when the pool was created
+        metrics = self._add('VM_metrics', {'start_time': '20240101T00:00:00Z'})
+        vm = self._add('VM', {
+            'name_label': name,
+            'is_a_template': bool(snapshot_of),
+            'is_a_snapshot': bool(snapshot_of),
+            'is_control_domain': False,
+            'power_state': 'Halted' if snapshot_of else 'Running',
+            'resident_on': 'OpaqueRef:NULL' if snapshot_of else self.host,
+            'snapshot_of': snapshot_of or 'OpaqueRef:NULL',
+            'snapshots': [],
+            'VBDs': [],
+            'metrics': metrics,
+        })
+        for userdevice, size in enumerate(sizes):
+            vdi = self._add('VDI', {
+                'name_label': '{} disk {}'.format(name, userdevice),
+                'SR': sr,
+                'virtual_size': str(size),
+                'physical_utilisation': str(size),
+                'is_a_snapshot': bool(snapshot_of),
+                'VBDs': [],
+            })
+            vbd = self._add('VBD', {
+                'VM': vm,
+                'VDI': vdi,
+                'type': 'Disk',
+                'userdevice': str(userdevice),
+            })
+            self.records['VDI'][vdi]['VBDs'].append(vbd)
+            self.records['VM'][vm]['VBDs'].append(vbd)
+        return vm
+
+    def disks(self, vm):
+        '''
+        :returns: list of (vdi ref, size)
+        '''
+        disks = []
+        for vbd in self.records['VM'][vm]['VBDs']:
+            vdi = self.records['VBD'][vbd]['VDI']
+            disks.append((vdi, int(self.records['VDI'][vdi]['virtual_size'])))
+        return disks
+
+    def find(self, cls, uuid):
+        with self.lock:
+            for ref, record in self.records[cls].items():
+                if record['uuid'] == uuid:
+                    return ref
+        return None
+
+    def call(self, method, params):
+        if self.call_latency:
+            time.sleep(self.call_latency)
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'session.login_with_password':
+            return 'OpaqueRef:session'
+        params = params[1:]
+        if method.startswith('Async.'):
+            return self.run_async(method[len('Async.'):], params)
+        return self.dispatch(method, params)
+
+    def dispatch(self, method, params):
+        handler = getattr(self, method.replace('.', '_'), None)
+        if handler:
+            return handler(*params)
+        cls, _, op = method.partition('.')
+        if cls not in self.records:
+            raise XenAPIFailure('MESSAGE_METHOD_UNKNOWN', method)
+        with self.lock:
+            table = self.records[cls]
+            if op == 'get_all_records':
+                return dict(table)
+            if op == 'get_by_uuid':
+                for ref, record in table.items():
+                    if record['uuid'] == params[0]:
+                        return ref
+                raise XenAPIFailure('UUID_INVALID', cls, params[0])
+            if params[0] not in table:
+                raise XenAPIFailure('HANDLE_INVALID', cls, params[0])
+            if op == 'get_record':
+                return table[params[0]]
+            if op.startswith('get_') and op[4:] in table[params[0]]:
+                return table[params[0]][op[4:]]
+        raise XenAPIFailure('MESSAGE_METHOD_UNKNOWN', method)
+
+    def session_logout(self):
+        return ''
+
+    def pool_get_all(self):
+        return ['OpaqueRef:pool0']
+
+    def pool_get_master(self, pool):
+        return self.host
+
+    def host_get_API_version_major(self, host):
+        return '2'
+
+    def host_get_API_version_minor(self, host):
+        return '5'
+
+    def run_async(self, method, params):
+        '''
+        Runs a call in a thread and returns its task, like the Async
+        calls of XAPI. The result is XML-RPC encoded, without the type
+        of strings.
+        '''
+        with self.lock:
+            task = self._new_task('Async.{}'.format(method))
+
+        def run():
+            self.local.task = task
+            try:
+                result = self.dispatch(method, params)
+            except XenAPIFailure as e:
+                self.finish_task(task, error=e.details)
+            else:
+                self.finish_task(task, '<value>{}</value>'.format(result) if result else '')
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        return task
+
+    def progress(self, value):
+        '''
+        Sets the progress of the task of the running Async call.
+        '''
+        task = getattr(self.local, 'task', None)
+        with self.lock:
+            if task in self.records['task']:
+                self._modify('task', task, progress=value)
+
+    def event_from(self, classes, token, timeout):
+        names = dict((cls.lower(), cls) for cls in self.classes)
+        classes = [names[c.lower()] for c in classes if c.lower() in names]
+        deadline = time.time() + float(timeout or 0)
+        while True:
+            events = []
+            with self.lock:
+                if not token:
+                    for cls in classes:
+                        for ref, record in self.records.get(cls, {}).items():
+                            events.append({'class': cls.lower(), 'operation': 'add', 'ref': ref, 'snapshot': dict(record)})
+                else:
+                    for cls, operation, ref in self.events[int(token):]:
+                        if cls not in classes:
+                            continue
+                        event = {'class': cls.lower(), 'operation': operation, 'ref': ref}
+                        if operation != 'del' and ref in self.records[cls]:
+                            event['snapshot'] = dict(self.records[cls][ref])
+                        events.append(event)
+                result = {'events': events, 'valid_ref_counts': {}, 'token': str(len(self.events))}
+            # like XAPI, wait up to `timeout` seconds for events
+            if events or not token or time.time() >= deadline:
+                return result
+            time.sleep(0.05)
+
+    def VM_snapshot(self, vm, name):
+        for step in range(4):
+            # a few steps, so the progress of the task moves
+            if self.snapshot_delay:
+                time.sleep(self.snapshot_delay / 4.0)
+            self.progress(step / 4.0)
+        with self.lock:
+            if vm not in self.records['VM']:
+                raise XenAPIFailure('HANDLE_INVALID', 'VM', vm)
+            if self.random.random() < self.snapshot_failure:
+                raise XenAPIFailure('SR_BACKEND_FAILURE_44', '', 'There is insufficient space')
+            sr = self.records['VDI'][self.disks(vm)[0][0]]['SR']
+            snapshot = self.add_vm(name, [size for vdi, size in self.disks(vm)], sr, snapshot_of=vm)
+            self.records['VM'][vm]['snapshots'].append(snapshot)
+            return snapshot
+
+    def VM_destroy(self, vm):
+        with self.lock:
+            if vm not in self.records['VM']:
+                raise XenAPIFailure('HANDLE_INVALID', 'VM', vm)
+            record = self.records['VM'][vm]
+            for vbd in record['VBDs']:
+                self._destroy('VBD', vbd)
+            parent = self.records['VM'].get(record['snapshot_of'])
+            if parent and vm in parent['snapshots']:
+                parent['snapshots'].remove(vm)
+            self._destroy('VM', vm)
+        return ''
+
+    def VDI_destroy(self, vdi):
+        if self.destroy_delay:
+            time.sleep(self.destroy_delay)
+        with self.lock:
+            if vdi not in self.records['VDI']:
+                raise XenAPIFailure('HANDLE_INVALID', 'VDI', vdi)
+            if self.random.random() < self.destroy_failure:
+                raise XenAPIFailure('SR_BACKEND_FAILURE_1200', '', 'Device or resource busy')
+            self._destroy('VDI', vdi)
+        return ''
+
+    def VDI_create(self, record):
+        with self.lock:
+            if record['SR'] not in self.records['SR']:
+                raise XenAPIFailure('HANDLE_INVALID', 'SR', record['SR'])
+            return self._add('VDI', {
+                'name_label': record['name_label'],
+                'SR': record['SR'],
+                'virtual_size': record['virtual_size'],
+                'physical_utilisation': '0',
+                'is_a_snapshot': False,
+                'VBDs': [],
+            })
+
+    def VM_set_is_a_template(self, vm, value):
+        with self.lock:
+            self.records['VM'][vm]['is_a_template'] = value
+        return ''
+
+    def VM_set_name_label(self, vm, value):
+        with self.lock:
+            self.records['VM'][vm]['name_label'] = value
+        return ''
+
+    def pool_get_default_SR(self, pool):
+        return sorted(self.records['SR'])[0]
+
+    def _new_task(self, label):
+        return self._add('task', {
+            'name_label': label,
+            'status': 'pending',
+            'progress': 0.0,
+            'result': '',
+            'error_info': [],
+        })
+
+    def task_create(self, label, description):
+        with self.lock:
+            return self._new_task(label)
+
+    def task_destroy(self, task):
+        with self.lock:
+            if task in self.records['task']:
+                self._destroy('task', task)
+        return ''
+
+    def finish_task(self, task, result=None, error=None):
+        with self.lock:
+            if task not in self.records['task']:
+                return
+            if error:
+                self._modify('task', task, status='failure', progress=1.0, error_info=list(error))
+            else:
+                self._modify('task', task, status='success', progress=1.0, result=result or '')
+
+    def import_vm(self, path, query, disks, digest, size):
+        '''
+        Creates the VM of an /import or /import_metadata, records what
+        was received in `imports`.
+
+        :param disks: list
+            sizes of the imported disks, or refs of existing VDIs
+        :returns: str
+            the task result, an array with the new VM like XAPI's
+        '''
+        with self.lock:
+            self.imports.append({'path': path, 'query': query, 'sha256': digest, 'bytes': size})
+            if path == '/import_raw_vdi':
+                vdi = self.records['VDI'][query['vdi']]
+                vdi['physical_utilisation'] = str(int(vdi['physical_utilisation']) + size)
+                return ''
+            sr = query.get('sr_id') or sorted(self.records['SR'])[0]
+            vm = self.add_vm('imported', [d for d in disks if not isinstance(d, str)], sr, snapshot_of=None)
+            record = self.records['VM'][vm]
+            record.update(power_state='Halted', resident_on='OpaqueRef:NULL', is_a_template=True)
+            for vdi in [d for d in disks if isinstance(d, str)]:
+                vbd = self._add('VBD', {'VM': vm, 'VDI': vdi, 'type': 'Disk', 'userdevice': str(len(record['VBDs']))})
+                record['VBDs'].append(vbd)
+            return '<value><array><data><value>{}</value></data></array></value>'.format(vm)
+
+
+def xva_pieces(disks, block):
+    '''
+    Yields the pieces of an XVA archive: a tar with ova.xml followed by
+    every disk in 1 MiB chunks, each with the SHA-1 of its data in a
+    .checksum file, like the exports of XenServer.
+
+    :param disks: list of (vdi ref, size)
+    :param block: str
+        synthetic data the chunks are cut from, `XVA_CHUNK_SIZE` long
+    '''
+    checksums = {}
+
+    def member(name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = 0
+        yield info.tobuf(tarfile.USTAR_FORMAT)
+        yield data
+        if len(data) % tarfile.BLOCKSIZE:
+            yield '\0' * (tarfile.BLOCKSIZE - len(data) % tarfile.BLOCKSIZE)
+
+    ova = '<value><struct><member><name>objects</name><value><array><data>{}</data></array></value></member></struct></value>'.format(
+        ''.join('<value>{}</value>'.format(vdi) for vdi, size in disks)
+    )
+    for piece in member('ova.xml', ova):
+        yield piece
+    for vdi, size in disks:
+        for i, offset in enumerate(range(0, size, XVA_CHUNK_SIZE)):
+            data = block[:min(XVA_CHUNK_SIZE, size - offset)]
+            if len(data) not in checksums:
+                checksums[len(data)] = hashlib.sha1(data).hexdigest()
+            name = 'Ref:{}/{:08d}'.format(vdi.split(':')[-1], i)
+            for piece in member(name, data):
+                yield piece
+            for piece in member(name + '.checksum', checksums[len(data)]):
+                yield piece
+    yield '\0' * (2 * tarfile.BLOCKSIZE)
+
+
+def xva_size(disks):
+    return sum(len(piece) for piece in xva_pieces(disks, '\0' * XVA_CHUNK_SIZE))
+
+
+def vhd_pieces(size, data_size, block):
+    '''
+    Yields the pieces of a VHD export of a disk of `size` bytes: the copy
+    of the footer, `data_size` bytes cut from `block` and the footer. Only
+    the footer is real, it is all restores read of a VHD.
+    '''
+    footer = 'conectix' + '\0' * 40 + struct.pack('>Q', size)
+    footer += '\0' * (VHD_FOOTER_SIZE - len(footer))
+    yield footer
+    for offset in range(0, data_size, len(block)):
+        yield block[:min(len(block), data_size - offset)]
+    yield footer
+
+
+class BodyReader(object):
+    '''
+    File like object reading `length` bytes of a request body, hashing
+    them on the way.
+    '''
+
+    def __init__(self, fileobj, length):
+        self.fileobj = fileobj
+        self.remaining = length
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    def read(self, size=None):
+        chunks = []
+        while self.remaining and (size is None or size > 0):
+            n = min(self.remaining, 1024 * 1024 if size is None else size)
+            data = self.fileobj.read(n)
+            if not data:
+                raise IOError('the request body ended {} bytes early'.format(self.remaining))
+            self.remaining -= len(data)
+            self.size += len(data)
+            self.hash.update(data)
+            chunks.append(data)
+            if size is not None:
+                size -= len(data)
+        return ''.join(chunks)
+
+
+def xva_disk_sizes(fileobj):
+    '''
+    Reads an XVA, plain or gzip compressed, and checks its chunks against
+    their checksums.
+
+    :returns: list
+        the size of every disk
+    '''
+    sizes = {}
+    data = None
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            content = tar.extractfile(member).read() if member.isfile() else ''
+            if member.name.endswith('.checksum'):
+                if data is None or hashlib.sha1(data).hexdigest() != content.strip():
+                    raise ValueError('Checksum mismatch of {}'.format(member.name))
+                data = None
+            elif member.name.startswith('Ref:'):
+                disk = member.name.split('/')[0]
+                sizes[disk] = sizes.get(disk, 0) + len(content)
+                data = content
+    return [sizes[disk] for disk in sorted(sizes)]
+
+
+class XenAPIHandler(ExportHandler):
+    '''
+    Serves the XenAPI calls of `FakePool` on POST, its VMs as XVA on
+    GET /export, their metadata on /export_metadata and their disks as
+    VHD on /export_raw_vdi, resuming at the offset of a Range header, and
+    imports on PUT. Deltas against a base are a quarter of the disk.
+    '''
+
+    def do_POST(self):
+        params, method = xmlrpclib.loads(self.rfile.read(int(self.headers['content-length'])))
+        try:
+            result = {'Status': 'Success', 'Value': self.server.pool.call(method, params)}
+        except XenAPIFailure as e:
+            result = {'Status': 'Failure', 'ErrorDescription': e.details}
+        body = xmlrpclib.dumps((result,), methodresponse=True, allow_none=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        pool = self.server.pool
+        vm = pool.find('VM', query.get('uuid', ''))
+        vdi = pool.find('VDI', query.get('vdi', ''))
+        if url.path == '/export' and vm is not None:
+            disks = pool.disks(vm)
+            size = self.server.xva_size(disks)
+            pieces = lambda: xva_pieces(disks, self.server.block)
+        elif url.path == '/export_metadata' and vm is not None:
+            # an XVA with the ova.xml only
+            metadata = ''.join(xva_pieces([(ref, 0) for ref, _ in pool.disks(vm)], self.server.block))
+            size = len(metadata)
+            pieces = lambda: [metadata]
+        elif url.path == '/export_raw_vdi' and vdi is not None and query.get('format') == 'vhd':
+            if query.get('base') and pool.find('VDI', query['base']) is None:
+                self.send_error(404)
+                return
+            disk_size = int(pool.records['VDI'][vdi]['virtual_size'])
+            data_size = disk_size // 4 if query.get('base') else disk_size
+            size = data_size + 2 * VHD_FOOTER_SIZE
+            pieces = lambda: vhd_pieces(disk_size, data_size, self.server.block)
+        else:
+            self.send_error(404)
+            return
+        offset = 0
+        if self.headers.get('Range', '').startswith('bytes='):
+            offset = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size - offset))
+        self.end_headers()
+        fail_at = None
+        if pool.random.random() < pool.export_failure:
+            fail_at = offset + (size - offset) // 2
+        self.stream_pieces(pieces(), offset, fail_at, pool.export_rate)
+
+    def do_PUT(self):
+        '''
+        /import of an XVA, plain or gzip compressed, /import_raw_vdi and
+        /import_metadata, reporting the result on the task of the upload.
+        '''
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        pool = self.server.pool
+        if url.path not in ('/import', '/import_raw_vdi', '/import_metadata') or 'content-length' not in self.headers:
+            self.send_error(404)
+            return
+        body = BodyReader(self.rfile, int(self.headers['content-length']))
+        result = error = None
+        disks = []
+        try:
+            if url.path == '/import':
+                disks = xva_disk_sizes(body)
+            elif url.path == '/import_metadata':
+                disks = [pool.find('VDI', value) for key, value in query.items() if key.startswith('vdi:')]
+            body.read()
+            result = pool.import_vm(url.path, query, disks, body.hash.hexdigest(), body.size)
+        except Exception as e:
+            error = ['IMPORT_ERROR', str(e)]
+            body.read()
+        pool.finish_task(query.get('task_id'), result, error)
+        self.send_response(500 if error else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def stream_pieces(self, pieces, offset, fail_at, rate):
+        started = time.time()
+        position = 0
+        sent = 0
+        for piece in pieces:
+            end = position + len(piece)
+            if end > offset:
+                data = piece[max(0, offset - position):]
+                if fail_at is not None and position + len(piece) > fail_at:
+                    # break off like a dropped connection
+                    self.wfile.flush()
+                    self.connection.shutdown(2)
+                    self.close_connection = 1
+                    return
+                self.wfile.write(data)
+                sent += len(data)
+                if rate:
+                    ahead = sent / float(rate) - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            position = end
+
+
+class FakeXenServer(ExportServer):
+    '''
+    A pool master serving the XenAPI and the exports of `pool` over HTTPS.
+    '''
+
+    def __init__(self, pool, certfile, keyfile, address=('127.0.0.1', 0), handler=XenAPIHandler):
+        ExportServer.__init__(self, address, handler=handler)
+        self.pool = pool
+        self.sizes = {}
+        self.socket = ssl.wrap_socket(self.socket, keyfile=keyfile, certfile=certfile, server_side=True)
+
+    def xva_size(self, disks):
+        key = tuple(size for vdi, size in disks)
+        if key not in self.sizes:
+            self.sizes[key] = xva_size(disks)
+        return self.sizes[key]
+
+    @property
+    def host(self):
+        return '{}:{}'.format(*self.server_address)
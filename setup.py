@@ -16,7 +16,14 @@ setup(
         'archive-rotator==0.2.1',
         'python-logstash==0.4.5',
     ],
-    extras_require={},
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'dedup': ['numpy'],
+        's3': ['boto3'],
+        'xxhash': ['xxhash'],
+        'test': ['pytest', 'moto', 'boto3', 'numpy'],
+    },
     license=None,
     include_package_data=True,
     entry_points={
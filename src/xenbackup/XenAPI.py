@@ -54,12 +54,15 @@
 # OF THIS SOFTWARE.
 # --------------------------------------------------------------------
 
+import errno
 import gettext
 import xmlrpclib
 import httplib
 import socket
 import sys
 import ssl
+import threading
+import time
 
 translation = gettext.translation('xen-xm', fallback = True)
 
@@ -113,6 +116,155 @@ class UDSTransport(xmlrpclib.Transport):
         for key, value in self._extra_headers:
             connection.putheader(key, value)
 
+class PooledTransport(xmlrpclib.Transport):
+    """Keep-alive HTTP(S) transport with a bounded pool of connections.
+
+    One transport can be shared by the Sessions of several threads: each
+    request checks out an idle connection to the host, or opens a new one
+    when none is idle and fewer than `size` are in use, and returns it to
+    the pool afterwards. A kept alive connection that the server closed
+    in the meantime is reopened and the request sent again once, see
+    `_stale()`. Other errors are raised, the calls are not idempotent.
+
+    Python 2's ssl module can not resume TLS sessions, reusing the
+    connections is what saves the handshakes. Like Session, the server
+    certificate is not verified unless a `context` is given.
+    """
+
+    def __init__(self, size=4, secure=True, context=None, timeout=120,
+                 use_datetime=0):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self.size = size
+        self.secure = secure
+        if secure and context is None:
+            try:
+                context = ssl._create_unverified_context()
+            except AttributeError:
+                pass
+        self.context = context
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self.requests = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def stats(self):
+        """Counters since the transport was created, the latencies in
+        seconds."""
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'connects': self.connects,
+                'reconnects': self.reconnects,
+                'errors': self.errors,
+                'seconds': self.seconds,
+                'max_seconds': self.max_seconds,
+                'idle': len(self._idle),
+            }
+
+    def _connect(self, host):
+        chost, extra_headers, x509 = self.get_host_info(host)
+        if not self.secure:
+            connection = httplib.HTTPConnection(chost, timeout=self.timeout)
+        elif self.context is not None:
+            connection = httplib.HTTPSConnection(chost, timeout=self.timeout,
+                                                 context=self.context, **(x509 or {}))
+        else:
+            connection = httplib.HTTPSConnection(chost, timeout=self.timeout,
+                                                 **(x509 or {}))
+        with self._lock:
+            self.connects += 1
+        return connection, extra_headers
+
+    def _checkout(self, host):
+        self._slots.acquire()
+        with self._lock:
+            for i, (idle_host, connection, extra_headers) in enumerate(self._idle):
+                if idle_host == host:
+                    del self._idle[i]
+                    return connection, extra_headers, True
+        try:
+            connection, extra_headers = self._connect(host)
+        except Exception:
+            self._slots.release()
+            raise
+        return connection, extra_headers, False
+
+    def _checkin(self, host, connection, extra_headers, reusable):
+        if reusable:
+            with self._lock:
+                self._idle.append((host, connection, extra_headers))
+        else:
+            connection.close()
+        self._slots.release()
+
+    def _stale(self, error):
+        """Whether `error`, raised before any byte of the response
+        arrived, is how a kept alive connection closed by the server fails:
+        an empty status line, or a reset or broken pipe. A timeout means
+        the server may still be working on the call."""
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        if isinstance(error, socket.timeout):
+            return False
+        return isinstance(error, socket.error) and \
+            error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+    def request(self, host, handler, request_body, verbose=0):
+        for attempt in (0, 1):
+            connection, extra_headers, reused = self._checkout(host)
+            started = time.time()
+            responded = False
+            try:
+                connection.putrequest('POST', handler, skip_accept_encoding=True)
+                for key, value in extra_headers or []:
+                    connection.putheader(key, value)
+                connection.putheader('User-Agent', self.user_agent)
+                connection.putheader('Content-Type', 'text/xml')
+                connection.putheader('Content-Length', str(len(request_body)))
+                connection.endheaders(request_body)
+                response = connection.getresponse(buffering=True)
+                responded = True
+                if response.status != 200:
+                    response.read()
+                    raise xmlrpclib.ProtocolError(host + handler, response.status,
+                                                  response.reason, response.msg)
+                self.verbose = verbose
+                result = self.parse_response(response)
+            except (socket.error, httplib.HTTPException), e:
+                self._checkin(host, connection, extra_headers, False)
+                if reused and not attempt and not responded and self._stale(e):
+                    # the server closed the idle connection, try a new one
+                    with self._lock:
+                        self.reconnects += 1
+                    continue
+                with self._lock:
+                    self.errors += 1
+                raise
+            except Exception:
+                self._checkin(host, connection, extra_headers, False)
+                with self._lock:
+                    self.errors += 1
+                raise
+            elapsed = time.time() - started
+            with self._lock:
+                self.requests += 1
+                self.seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+            self._checkin(host, connection, extra_headers, not response.will_close)
+            return result
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for host, connection, extra_headers in idle:
+            connection.close()
+
 class Session(xmlrpclib.ServerProxy):
     """A server proxy and session manager for communicating with xapi using
     the Xen-API.
@@ -127,6 +279,8 @@ class Session(xmlrpclib.ServerProxy):
 
     def __init__(self, uri, transport=None, encoding=None, verbose=0,
                  allow_none=1):
+        if transport is None and uri.startswith('http'):
+            transport = PooledTransport(size=1, secure=uri.startswith('https'))
         try:
             xmlrpclib.ServerProxy.__init__(self, uri, transport, encoding,
                                        verbose, allow_none, context=ssl._create_unverified_context())
@@ -137,6 +291,7 @@ class Session(xmlrpclib.ServerProxy):
         self.last_login_method = None
         self.last_login_params = None
         self.API_version = API_VERSION_1_1
+        self._dispatcher = None
 
 
     def xenapi_request(self, methodname, params):
@@ -197,7 +352,11 @@ class Session(xmlrpclib.ServerProxy):
         if name == 'handle':
             return self._session
         elif name == 'xenapi':
-            return _Dispatcher(self.API_version, self.xenapi_request, None)
+            # the dispatchers are rebuilt when the API version changes on login
+            if self._dispatcher is None or self._dispatcher[0] != self.API_version:
+                self._dispatcher = (self.API_version,
+                                    _Dispatcher(self.API_version, self.xenapi_request, None))
+            return self._dispatcher[1]
         elif name.startswith('login') or name.startswith('slave_local'):
             return lambda *params: self._login(name, params)
         else:
@@ -240,10 +399,15 @@ class _Dispatcher:
             return '<XenAPI._Dispatcher>'
 
     def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
         if self.__name is None:
-            return _Dispatcher(self.__API_version, self.__send, name)
+            dispatcher = _Dispatcher(self.__API_version, self.__send, name)
         else:
-            return _Dispatcher(self.__API_version, self.__send, "%s.%s" % (self.__name, name))
+            dispatcher = _Dispatcher(self.__API_version, self.__send, "%s.%s" % (self.__name, name))
+        # cached, later lookups of the same name do not get here
+        self.__dict__[name] = dispatcher
+        return dispatcher
 
     def __call__(self, *args):
         return self.__send(self.__name, args)
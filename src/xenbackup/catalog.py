@@ -0,0 +1,380 @@
+import calendar
+import contextlib
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    destination TEXT NOT NULL,
+    vm_uuid TEXT NOT NULL,
+    vm_name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    created REAL NOT NULL,
+    size INTEGER NOT NULL,
+    point_id TEXT,
+    parent INTEGER REFERENCES backups (id),
+    rotation_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS backups_vm ON backups (destination, vm_uuid, kind, created);
+CREATE INDEX IF NOT EXISTS backups_name ON backups (destination, vm_name COLLATE NOCASE, created);
+CREATE TABLE IF NOT EXISTS files (
+    backup_id INTEGER NOT NULL REFERENCES backups (id),
+    location TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    algorithm TEXT,
+    digest TEXT
+);
+CREATE INDEX IF NOT EXISTS files_backup ON files (backup_id);
+CREATE TABLE IF NOT EXISTS imported (
+    destination TEXT NOT NULL,
+    vm_uuid TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    PRIMARY KEY (destination, vm_uuid, kind)
+);
+'''
+
+# bound parameters per query, old SQLite versions allow 999
+MAX_VARIABLES = 500
+
+# ISO 8601 year and week, see `bucket()`
+ISO_WEEK = '%G-%V'
+
+# retention periods and the strftime() format of their buckets
+PERIODS = [
+    ('daily', '%Y-%m-%d'),
+    ('weekly', ISO_WEEK),
+    ('monthly', '%Y-%m'),
+    ('yearly', '%Y'),
+]
+
+
+def destination(path):
+    '''
+    :param path: str
+        the --path of a run, a local directory or s3://bucket/prefix
+    :returns: str
+        the key of the backups stored there in the catalog
+    '''
+    if '://' in path:
+        return path.rstrip('/')
+    return os.path.abspath(path)
+
+
+def point_time(point_id):
+    '''
+    :returns: float
+        creation time of an incremental restore point, from its id
+    '''
+    return calendar.timegm(time.strptime(point_id, '%Y%m%dT%H%M%SZ'))
+
+
+def bucket(created, format):
+    '''
+    :param created: float
+        timestamp
+    :param format: str
+        a strftime() format of `PERIODS`
+    :returns: str
+        the period of local time `created` falls in. ISO weeks belong to
+        the year of their Thursday, a week is not split at new year.
+    '''
+    t = time.localtime(created)
+    if format == ISO_WEEK:
+        return '{}-{:02d}'.format(*datetime.date(*t[:3]).isocalendar()[:2])
+    return time.strftime(format, t)
+
+
+class Retention(object):
+    '''
+    Grandfather-father-son retention: the newest `last` backups are kept,
+    and the newest backup of each of the newest `daily` days, `weekly`
+    weeks, `monthly` months and `yearly` years that have a backup. A
+    backup kept for several reasons is only kept once. Nothing expires if
+    all counts are 0.
+    '''
+
+    def __init__(self, last=5, daily=0, weekly=0, monthly=0, yearly=0):
+        self.last = last
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+        self.yearly = yearly
+
+    def keeps_all(self):
+        return not self.last and not any(getattr(self, period) for period, _ in PERIODS)
+
+    def __str__(self):
+        return ', '.join('{} {}'.format(name, getattr(self, name)) for name in
+                         ['last'] + [period for period, _ in PERIODS] if getattr(self, name))
+
+
+class BackupCatalog(object):
+    '''
+    SQLite index of every backup and the files it is made of, stored next
+    to the state file.
+
+    A backup is an archive (an .xva or its deduplicated manifest) or an
+    incremental restore point (kind `point`, its metadata and VHD files).
+    Deltas reference the restore point they are based on as their
+    `parent`. Listing, lookups and retention are queries on the indexes,
+    the backup directories are only read once per VM, to import the
+    backups made before the catalog existed.
+
+    Safe to share between the workers of a run.
+    '''
+
+    filename = 'xenbackup-catalog.sqlite'
+
+    def __init__(self, path):
+        '''
+        :param path: str
+            directory of the catalog
+        '''
+        self.path = os.path.join(path, self.filename)
+        self.lock = threading.Lock()
+        # a rollback journal, WAL does not work on network file systems
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.create_function('bucket', 2, bucket)
+        with self.lock:
+            self.db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Locks the catalog and yields the connection, the changes are
+        committed when the block exits and rolled back on exceptions.
+        '''
+        with self.lock:
+            with self.db:
+                yield self.db
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def is_imported(self, destination, vm_uuid, kind):
+        with self.transaction() as db:
+            return db.execute(
+                'SELECT 1 FROM imported WHERE destination = ? AND vm_uuid = ? AND kind = ?',
+                (destination, vm_uuid, kind),
+            ).fetchone() is not None
+
+    def add(self, destination, vm_uuid, vm_name, kind, files, created=None,
+            point_id=None, parent=None, rotation_id=None):
+        '''
+        Records a backup.
+
+        :param kind: str
+            archive or point
+        :param files: list of dicts
+            `location`, `size` and optionally the `algorithm` and `digest`
+            of the checksum of every file of the backup
+        :param created: float
+            timestamp, now if None
+        :param point_id: str
+            id of the incremental restore point
+        :param parent: str
+            id of the restore point a delta is based on
+        :param rotation_id: int
+            the number in the name of a local archive
+        :returns: int
+            id of the backup
+        '''
+        return self.add_many(destination, vm_uuid, vm_name, kind, [{
+            'files': files,
+            'created': created,
+            'point_id': point_id,
+            'parent': parent,
+            'rotation_id': rotation_id,
+        }])[0]
+
+    def add_many(self, destination, vm_uuid, vm_name, kind, backups, imported=False):
+        '''
+        Records backups of one VM in a single transaction.
+
+        :param backups: list of dicts
+            the keyword arguments of `add()`, parents before their deltas
+        :param imported: boolean
+            mark the VM's backups of this kind as imported
+        :returns: list
+            ids of the backups
+        '''
+        ids = []
+        with self.transaction() as db:
+            for backup in backups:
+                parent = None
+                if backup.get('parent'):
+                    row = db.execute(
+                        'SELECT id FROM backups WHERE destination = ? AND vm_uuid = ? AND point_id = ?',
+                        (destination, vm_uuid, backup['parent']),
+                    ).fetchone()
+                    parent = row[0] if row else None
+                cursor = db.execute(
+                    'INSERT INTO backups (destination, vm_uuid, vm_name, kind, created, size, point_id, parent, rotation_id)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                        destination,
+                        vm_uuid,
+                        vm_name,
+                        kind,
+                        backup.get('created') or time.time(),
+                        sum(f['size'] for f in backup['files']),
+                        backup.get('point_id'),
+                        parent,
+                        backup.get('rotation_id'),
+                    ))
+                ids.append(cursor.lastrowid)
+                # a file written again under the same name replaces its old entry
+                db.executemany(
+                    'INSERT OR REPLACE INTO files (backup_id, location, size, algorithm, digest) VALUES (?, ?, ?, ?, ?)',
+                    [(cursor.lastrowid, f['location'], f['size'], f.get('algorithm'), f.get('digest'))
+                     for f in backup['files']],
+                )
+            if imported:
+                db.execute(
+                    'INSERT OR IGNORE INTO imported (destination, vm_uuid, kind) VALUES (?, ?, ?)',
+                    (destination, vm_uuid, kind),
+                )
+        return ids
+
+    def next_rotation_id(self, destination, vm_uuid):
+        with self.transaction() as db:
+            row = db.execute(
+                'SELECT MAX(rotation_id) FROM backups WHERE destination = ? AND vm_uuid = ?',
+                (destination, vm_uuid),
+            ).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def backups(self, destination, vm_name=None, vm_uuid=None, kind=None, ids=None):
+        '''
+        :param vm_name: str
+            only the backups of VMs of this name, case insensitive
+        :returns: list of dicts
+            the backups and their `files`, oldest first
+        '''
+        if ids is not None and len(ids) > MAX_VARIABLES:
+            backups = []
+            for i in range(0, len(ids), MAX_VARIABLES):
+                backups.extend(self.backups(destination, vm_name, vm_uuid, kind, ids[i:i + MAX_VARIABLES]))
+            return sorted(backups, key=lambda b: (b['created'], b['id']))
+        where = ['destination = ?']
+        args = [destination]
+        if vm_name is not None:
+            where.append('vm_name = ? COLLATE NOCASE')
+            args.append(vm_name)
+        if vm_uuid is not None:
+            where.append('vm_uuid = ?')
+            args.append(vm_uuid)
+        if kind is not None:
+            where.append('kind = ?')
+            args.append(kind)
+        if ids is not None:
+            where.append('id IN ({})'.format(', '.join('?' * len(ids))))
+            args.extend(ids)
+        with self.transaction() as db:
+            backups = [dict(row) for row in db.execute(
+                'SELECT * FROM backups WHERE {} ORDER BY created, id'.format(' AND '.join(where)),
+                args,
+            )]
+            files = {}
+            for row in db.execute(
+                'SELECT files.* FROM files JOIN backups ON files.backup_id = backups.id WHERE {} ORDER BY location'.format(
+                    ' AND '.join('backups.' + w for w in where),
+                ),
+                args,
+            ):
+                files.setdefault(row['backup_id'], []).append(dict(row))
+        for backup in backups:
+            backup['files'] = files.get(backup['id'], [])
+        return backups
+
+    def latest(self, destination, vm_name):
+        '''
+        :returns: dict
+            the newest backup of a VM, with its `files`, None if it has none
+        '''
+        with self.transaction() as db:
+            row = db.execute(
+                'SELECT id FROM backups WHERE destination = ? AND vm_name = ? COLLATE NOCASE'
+                ' ORDER BY created DESC, id DESC LIMIT 1',
+                (destination, vm_name),
+            ).fetchone()
+        if row is None:
+            return None
+        return self.backups(destination, ids=[row[0]])[0]
+
+    def expired(self, destination, vm_uuid, kind, retention):
+        '''
+        Applies `retention` to a VM's backups of one kind. Restore points
+        kept as the base of a kept delta are kept too.
+
+        :param retention: `Retention`
+        :returns: list of dicts
+            the backups to delete, with their `files`
+        '''
+        if retention.keeps_all():
+            return []
+        where = 'destination = ? AND vm_uuid = ? AND kind = ?'
+        args = (destination, vm_uuid, kind)
+        kept = set()
+        with self.transaction() as db:
+            if retention.last:
+                kept.update(row[0] for row in db.execute(
+                    'SELECT id FROM backups WHERE {} ORDER BY created DESC, id DESC LIMIT ?'.format(where),
+                    args + (retention.last,),
+                ))
+            for period, bucket in PERIODS:
+                if not getattr(retention, period):
+                    continue
+                # the id of the row with MAX(created) of every bucket
+                kept.update(row[0] for row in db.execute(
+                    'SELECT id, MAX(created) FROM backups WHERE {} GROUP BY bucket(created, ?)'
+                    ' ORDER BY 2 DESC LIMIT ?'.format(where),
+                    args + (bucket, getattr(retention, period)),
+                ))
+            parents = dict(db.execute('SELECT id, parent FROM backups WHERE {}'.format(where), args).fetchall())
+        for backup_id in list(kept):
+            parent = parents.get(backup_id)
+            while parent and parent not in kept:
+                kept.add(parent)
+                parent = parents.get(parent)
+        expired = [backup_id for backup_id in parents if backup_id not in kept]
+        if not expired:
+            return []
+        return self.backups(destination, ids=expired)
+
+    def remove(self, ids):
+        '''
+        Removes backups and their files from the catalog, in one transaction.
+        '''
+        with self.transaction() as db:
+            db.executemany('DELETE FROM files WHERE backup_id = ?', [(i,) for i in ids])
+            db.executemany('DELETE FROM backups WHERE id = ?', [(i,) for i in ids])
+
+
+def file_info(backend, location, checksum_suffix=None):
+    '''
+    :param checksum_suffix: str
+        suffix of the integrity manifest of `location`, whose checksum is
+        taken over if it exists
+    :returns: dict
+        a file of `BackupCatalog.add()`
+    '''
+    info = {
+        'location': location,
+        'size': backend.size(location),
+    }
+    if checksum_suffix:
+        try:
+            manifest = json.loads(backend.read(location + checksum_suffix))
+            info['algorithm'] = manifest['algorithm']
+            info['digest'] = manifest['digest']
+        except Exception:
+            # no or an unreadable manifest, the checksum stays unknown
+            pass
+    return info
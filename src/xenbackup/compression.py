@@ -0,0 +1,310 @@
+import threading
+import zlib
+import Queue
+
+from transfer import to_bytes
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class GzipCompressor(object):
+    suffix = '.gz'
+    default_level = 6
+
+    def __init__(self, level=None):
+        self.obj = zlib.compressobj(
+            self.default_level if level is None else level,
+            zlib.DEFLATED,
+            16 + zlib.MAX_WBITS, # gzip header and trailer
+        )
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+class ZstdCompressor(object):
+    suffix = '.zst'
+    default_level = 3
+
+    def __init__(self, level=None):
+        if zstandard is None:
+            raise Exception('zstd compression requires the zstandard package')
+        self.obj = zstandard.ZstdCompressor(
+            level=self.default_level if level is None else level,
+        ).compressobj()
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+class LZ4Compressor(object):
+    suffix = '.lz4'
+    default_level = 0
+
+    def __init__(self, level=None):
+        if lz4 is None:
+            raise Exception('lz4 compression requires the lz4 package')
+        self.obj = lz4.frame.LZ4FrameCompressor(
+            compression_level=self.default_level if level is None else level,
+        )
+        self.header = self.obj.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, b''
+        return header + self.obj.compress(data)
+
+    def flush(self):
+        header, self.header = self.header, b''
+        return header + self.obj.flush()
+
+
+class _Target(object):
+    '''
+    File like object passing what a zstd stream writer writes on.
+    '''
+
+    def __init__(self):
+        self.write = None
+
+
+class Decompressor(object):
+    '''
+    Streaming decompressor for a stream produced by one of the compressors.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.target = None
+        self.writer = None
+        if name == 'gzip':
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif name == 'zstd':
+            if zstandard is None:
+                raise Exception('zstd decompression requires the zstandard package')
+            self.obj = zstandard.ZstdDecompressor().decompressobj()
+        elif name == 'lz4':
+            if lz4 is None:
+                raise Exception('lz4 decompression requires the lz4 package')
+            self.obj = lz4.frame.LZ4FrameDecompressor()
+        else:
+            raise Exception('Unknown compression: {}'.format(name))
+
+    def decompress(self, data):
+        return self.obj.decompress(data)
+
+    def decompress_to(self, data, write, size=4 * 1024 * 1024):
+        '''
+        Decompresses `data`, passing the output to `write` at most `size`
+        bytes at a time however well the data was compressed, unlike
+        `decompress()`. Use one of the two per stream.
+        '''
+        if self.name == 'zstd':
+            if self.writer is None:
+                self.target = _Target()
+                self.writer = zstandard.ZstdDecompressor().stream_writer(self.target, write_size=size)
+            self.target.write = write
+            self.writer.write(data)
+        elif self.name == 'gzip':
+            while data:
+                out = self.obj.decompress(data, size)
+                if out:
+                    write(out)
+                data = self.obj.unconsumed_tail
+        else:
+            if self.obj.eof:
+                return
+            out = self.obj.decompress(data, max_length=size)
+            while True:
+                if out:
+                    write(out)
+                if self.obj.needs_input or self.obj.eof:
+                    break
+                out = self.obj.decompress(b'', max_length=size)
+
+
+def iter_decompressed(name, fileobj, size=4 * 1024 * 1024, read_size=64 * 1024):
+    '''
+    Decompresses a file like object, yielding at most `size` bytes at a
+    time however well the data was compressed.
+    '''
+    if name == 'zstd':
+        if zstandard is None:
+            raise Exception('zstd decompression requires the zstandard package')
+        for data in zstandard.ZstdDecompressor().read_to_iter(fileobj, read_size=read_size, write_size=size):
+            yield data
+        return
+    if name == 'gzip':
+        obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif name == 'lz4':
+        if lz4 is None:
+            raise Exception('lz4 decompression requires the lz4 package')
+        obj = lz4.frame.LZ4FrameDecompressor()
+    else:
+        raise Exception('Unknown compression: {}'.format(name))
+    while True:
+        data = fileobj.read(read_size)
+        if not data:
+            break
+        if name == 'gzip':
+            while data:
+                out = obj.decompress(data, size)
+                if out:
+                    yield out
+                data = obj.unconsumed_tail
+        else:
+            out = obj.decompress(data, max_length=size)
+            while True:
+                if out:
+                    yield out
+                if obj.needs_input or obj.eof:
+                    break
+                out = obj.decompress(b'', max_length=size)
+    if name == 'gzip':
+        out = obj.flush()
+        if out:
+            yield out
+
+
+def decompress(name, data):
+    '''
+    Decompresses a complete compressed string.
+    '''
+    return Decompressor(name).decompress(data)
+
+
+COMPRESSORS = {
+    'gzip': GzipCompressor,
+    'zstd': ZstdCompressor,
+    'lz4': LZ4Compressor,
+}
+
+
+MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'\x04\x22\x4d\x18', 'lz4'),
+)
+
+
+def detect(head):
+    '''
+    :param head: str
+        The first bytes of a stream
+    :returns: str
+        gzip, zstd or lz4 if the stream is compressed, otherwise None
+    '''
+    for magic, name in MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def get_compressor(name, level=None):
+    '''
+    :param name: str
+        gzip, zstd or lz4
+    :param level: int
+        compression level, the compressor's default if None
+    '''
+    if name not in COMPRESSORS:
+        raise Exception('Unknown compression: {}'.format(name))
+    return COMPRESSORS[name](level)
+
+
+def suffix(name, ext='.xva'):
+    '''
+    :param name: str
+        gzip, zstd, lz4 or None
+    :param ext: str
+        extension of the uncompressed file
+    :returns: str
+        The archive extension, e.g. `.xva.zst`
+    '''
+    if not name:
+        return ext
+    return ext + COMPRESSORS[name].suffix
+
+
+class CompressingWriter(object):
+    '''
+    File like object compressing everything written to it before passing
+    it on to `fileobj`. Closing or aborting it does the same to `fileobj`.
+
+    With `threaded` the compression runs in a separate thread fed through
+    a bounded queue. zlib, zstandard and lz4 all release the GIL while
+    compressing, so the socket reads in the calling thread are not held
+    back by the compressor.
+    '''
+
+    def __init__(self, fileobj, compressor, threaded=True, queue_size=16):
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.threaded = threaded
+        self.error = None
+        self.thread = None
+        if threaded:
+            self.queue = Queue.Queue(queue_size)
+            self.thread = threading.Thread(
+                target=self._run,
+                name='xenbackup-compress',
+            )
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error:
+                # keep draining so the writer never blocks on a full queue
+                continue
+            try:
+                self.fileobj.write(self.compressor.compress(data))
+            except Exception as e:
+                self.error = e
+
+    def _check(self):
+        if self.error:
+            raise self.error
+
+    def write(self, data):
+        if not self.threaded:
+            self.fileobj.write(self.compressor.compress(to_bytes(data)))
+            return
+        self._check()
+        # the buffer is reused by the caller, so queue a copy
+        self.queue.put(to_bytes(data))
+
+    def abort(self):
+        '''
+        Stops the compression thread without flushing, used when the
+        download failed and the output is going to be discarded.
+        '''
+        if self.threaded and self.thread.is_alive():
+            self.error = self.error or Exception('aborted')
+            self.queue.put(None)
+            self.thread.join()
+        self.fileobj.abort()
+
+    def close(self):
+        if self.threaded:
+            self.queue.put(None)
+            self.thread.join()
+            self._check()
+        self.fileobj.write(self.compressor.flush())
+        self.fileobj.close()
@@ -0,0 +1,399 @@
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+
+import compression
+from transfer import to_bytes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MANIFEST_MAGIC = b'XENBACKUP-MANIFEST-1\n'
+DIGEST_SIZE = 32
+# digests read from a manifest at a time, and released at a time
+DIGEST_BATCH = 4096
+
+# Gear hash table, fixed so chunk boundaries are stable between runs
+_random = random.Random(0x58656e42)
+GEAR = [_random.getrandbits(32) for _ in range(256)]
+WINDOW = 32
+
+
+class Chunker(object):
+    '''
+    Content defined chunking with a gear hash over a 32 byte window.
+
+    A chunk ends after byte `i` when the top bits of the hash of the 32
+    bytes ending at `i` are all zero, so identical data produces identical
+    chunks no matter where it is in the stream.
+
+    The hash is computed with numpy when it is installed and with a
+    plain Python loop otherwise, both give the same boundaries.
+    '''
+
+    def __init__(self, min_size=512 * 1024, avg_size=1024 * 1024, max_size=4 * 1024 * 1024):
+        assert WINDOW <= min_size < avg_size < max_size
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = (avg_size - min_size).bit_length() - 1
+        self.mask = ((1 << bits) - 1) << (32 - bits)
+        self.pending = bytearray()
+        self.scanned = 0
+        if numpy is not None:
+            self.gear = numpy.array(GEAR, dtype=numpy.uint32)
+
+    def _find_numpy(self, start, end):
+        data = numpy.frombuffer(self.pending, dtype=numpy.uint8, count=end)
+        h = self.gear[data[start - WINDOW + 1:end]]
+        # h[i] = sum(gear[data[i - k]] << k for k < WINDOW), built by doubling
+        # the window: h2m[i] = hm[i] + (hm[i - m] << m)
+        m = 1
+        while m < WINDOW:
+            h[m:] += h[:-m] << numpy.uint32(m)
+            m *= 2
+        hits = numpy.flatnonzero((h[WINDOW - 1:] & self.mask) == 0)
+        if len(hits):
+            return start + int(hits[0]) + 1
+        return None
+
+    def _find_python(self, start, end):
+        data = self.pending
+        gear = GEAR
+        mask = self.mask
+        h = 0
+        for i in xrange(start - WINDOW + 1, start):
+            h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        for i in xrange(start, end):
+            h = ((h << 1) + gear[data[i]]) & 0xffffffff
+            if not h & mask:
+                return i + 1
+        return None
+
+    def _find(self, start, end):
+        if numpy is not None:
+            return self._find_numpy(start, end)
+        return self._find_python(start, end)
+
+    def feed(self, data):
+        '''
+        :returns: list
+            the chunks completed by `data`
+        '''
+        self.pending.extend(data)
+        chunks = []
+        while True:
+            start = max(self.scanned, self.min_size)
+            end = min(len(self.pending), self.max_size, start + self.avg_size)
+            if start < end:
+                cut = self._find(start, end)
+                if cut is None:
+                    self.scanned = end
+                    continue
+            elif len(self.pending) >= self.max_size:
+                cut = self.max_size
+            else:
+                return chunks
+            chunks.append(bytes(self.pending[:cut]))
+            del self.pending[:cut]
+            self.scanned = 0
+
+    def finish(self):
+        '''
+        :returns: list
+            the remaining chunks at the end of the stream
+        '''
+        chunks = []
+        if self.pending:
+            chunks.append(bytes(self.pending))
+        self.pending = bytearray()
+        self.scanned = 0
+        return chunks
+
+
+class ChunkStore(object):
+    '''
+    A directory of chunks named after their SHA-256, with a SQLite index
+    of the chunks and their reference counts.
+
+    A chunk is referenced once for every time it appears in a manifest.
+    References are taken while a backup is being written and given back
+    with `release()` when the backup is removed, chunks that are no
+    longer referenced are deleted.
+
+    Safe to share between the workers of a run.
+    '''
+
+    def __init__(self, path, compression=None, compression_level=None):
+        '''
+        :param path: str
+            directory of the store, created if missing
+        :param compression: str
+            compress every new chunk with gzip, zstd or lz4
+        '''
+        self.path = path
+        self.compression = compression
+        self.compression_level = compression_level
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.lock = threading.Lock()
+        # chunks whose files release() is deleting, put() waits for them
+        self.deleting = set()
+        self.deleted = threading.Condition(self.lock)
+        # puts since the last commit
+        self.uncommitted = 0
+        # release() calls that deleted chunks, for put() to notice them
+        self.releases = 0
+        self.db = sqlite3.connect(
+            os.path.join(path, 'index.sqlite'),
+            check_same_thread=False,
+        )
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS chunks (
+                hash BLOB PRIMARY KEY,
+                size INTEGER NOT NULL,
+                refs INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        self.db.commit()
+
+    def chunk_path(self, digest, suffix=''):
+        h = digest.encode('hex')
+        return os.path.join(self.path, h[:2], h[2:4], h + suffix)
+
+    def find(self, digest):
+        '''
+        :returns: tuple (path, compression)
+            where the chunk is stored and how it is compressed
+        '''
+        for name in [None] + sorted(compression.COMPRESSORS):
+            path = self.chunk_path(digest, compression.suffix(name, ''))
+            if os.path.exists(path):
+                return path, name
+        raise Exception('Chunk {} is missing from the store'.format(digest.encode('hex')))
+
+    def read(self, digest):
+        path, name = self.find(digest)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if name:
+            data = compression.decompress(name, data)
+        return data
+
+    def put(self, digest, data):
+        '''
+        Takes a reference on the chunk, storing it first if it is new.
+        The references are committed every `DIGEST_BATCH` puts, so a
+        crash leaves few chunk files the index does not know.
+
+        :returns: boolean
+            True if the chunk was new
+        '''
+        key = sqlite3.Binary(digest)
+        while True:
+            with self.lock:
+                while digest in self.deleting:
+                    self.deleted.wait()
+                if self.db.execute('UPDATE chunks SET refs = refs + 1 WHERE hash = ?', (key,)).rowcount:
+                    self._count_put()
+                    return False
+                releases = self.releases
+            path, size = self._write(digest, data)
+            with self.lock:
+                if self.releases != releases and (digest in self.deleting or not os.path.exists(path)):
+                    # release() deleted the chunk while it was written, store it again
+                    continue
+                # another worker may have stored the same chunk in the meantime,
+                # only the one whose row went in counts it as new
+                new = self.db.execute('INSERT OR IGNORE INTO chunks (hash, size, refs) VALUES (?, ?, 1)',
+                                      (key, size)).rowcount > 0
+                if not new:
+                    self.db.execute('UPDATE chunks SET refs = refs + 1 WHERE hash = ?', (key,))
+                self._count_put()
+            return new
+
+    def _write(self, digest, data):
+        '''
+        :returns: tuple (path, size)
+            the chunk's file and its size once compressed
+        '''
+        path = self.chunk_path(digest, compression.suffix(self.compression, ''))
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+        if self.compression:
+            compressor = compression.get_compressor(self.compression, self.compression_level)
+            data = compressor.compress(data) + compressor.flush()
+        tmp = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        return path, len(data)
+
+    def _count_put(self):
+        self.uncommitted += 1
+        if self.uncommitted >= DIGEST_BATCH:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def release(self, digests):
+        '''
+        Gives back one reference per digest and deletes the chunks
+        nobody references anymore.
+
+        :param digests: iterable
+            read once, `DIGEST_BATCH` at a time, e.g. from `read_manifest()`
+        :returns: int
+            number of chunks deleted
+        '''
+        unreferenced = set()
+        with self.lock:
+            for batch in _batches(digests, DIGEST_BATCH):
+                self.db.executemany(
+                    'UPDATE chunks SET refs = refs - 1 WHERE hash = ?',
+                    ((sqlite3.Binary(d),) for d in batch),
+                )
+                # later batches only take references away, the chunks are deleted at the end
+                for digest in set(batch) - unreferenced:
+                    row = self.db.execute('SELECT refs FROM chunks WHERE hash = ?', (sqlite3.Binary(digest),)).fetchone()
+                    if row is not None and row[0] <= 0:
+                        unreferenced.add(digest)
+            self.db.executemany(
+                'DELETE FROM chunks WHERE hash = ?',
+                ((sqlite3.Binary(d),) for d in unreferenced),
+            )
+            self.db.commit()
+            self.uncommitted = 0
+            if unreferenced:
+                self.releases += 1
+                self.deleting.update(unreferenced)
+        # the other workers go on meanwhile, only a put of one of these waits
+        try:
+            for digest in unreferenced:
+                for name in [None] + sorted(compression.COMPRESSORS):
+                    path = self.chunk_path(digest, compression.suffix(name, ''))
+                    if os.path.exists(path):
+                        os.remove(path)
+        finally:
+            with self.lock:
+                self.deleting.difference_update(unreferenced)
+                self.deleted.notify_all()
+        return len(unreferenced)
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _iter_digests(f):
+    try:
+        while True:
+            data = f.read(DIGEST_SIZE * DIGEST_BATCH)
+            for i in xrange(0, len(data) - DIGEST_SIZE + 1, DIGEST_SIZE):
+                yield data[i:i + DIGEST_SIZE]
+            if len(data) < DIGEST_SIZE * DIGEST_BATCH:
+                return
+    finally:
+        f.close()
+
+
+def read_manifest(path):
+    '''
+    The manifest is opened right away, its digests can still be read
+    once the file is deleted.
+
+    :returns: tuple (info, digests)
+        the manifest's header dict and an iterator over the chunk
+        digests, which reads them `DIGEST_BATCH` at a time
+    '''
+    f = open(path, 'rb')
+    try:
+        if f.readline() != MANIFEST_MAGIC:
+            raise Exception('{} is not a xenbackup manifest'.format(path))
+        info = json.loads(f.readline())
+    except Exception:
+        f.close()
+        raise
+    return info, _iter_digests(f)
+
+
+class DedupWriter(object):
+    '''
+    File like object splitting everything written to it into chunks,
+    storing new chunks in a `ChunkStore` and writing the list of chunks
+    to a manifest when closed.
+    '''
+
+    def __init__(self, path, store, chunker=None):
+        '''
+        :param path: str
+            where to write the manifest
+        '''
+        self.path = path
+        self.store = store
+        self.chunker = chunker or Chunker()
+        self.digests = []
+        self.size = 0
+        self.new_chunks = 0
+        self.new_bytes = 0
+
+    def _store(self, chunks):
+        for chunk in chunks:
+            digest = hashlib.sha256(chunk).digest()
+            if self.store.put(digest, chunk):
+                self.new_chunks += 1
+                self.new_bytes += len(chunk)
+            self.digests.append(digest)
+            self.size += len(chunk)
+
+    def write(self, data):
+        self._store(self.chunker.feed(to_bytes(data)))
+
+    def close(self):
+        self._store(self.chunker.finish())
+        self.store.commit()
+        with open(self.path, 'wb') as f:
+            f.write(MANIFEST_MAGIC)
+            f.write(json.dumps({
+                'size': self.size,
+                'chunks': len(self.digests),
+                'new_chunks': self.new_chunks,
+                'new_bytes': self.new_bytes,
+            }) + '\n')
+            f.write(b''.join(self.digests))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def abort(self):
+        '''
+        Gives back the references taken so far, the backup will not
+        be used.
+        '''
+        self.store.release(self.digests)
+        self.digests = []
@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+
+import scheduler
+
+
+def load_config(path):
+    '''
+    Reads a JSON file listing the pools to backup:
+
+        {
+            "max_parallel": 8,
+            "bandwidth": 400,
+            "pools": [
+                {"host": "xen1", "user": "root", "password": "pw"},
+                {"host": "xen2", "user": "root", "password": "pw", "parallel": 4}
+            ]
+        }
+
+    Every key of a pool overrides the command line argument of the same
+    name. The other top level keys override command line arguments for
+    all pools, max_parallel and the bandwidth limits apply to all pools
+    together.
+
+    :returns: dict
+    '''
+    with open(path) as f:
+        config = json.load(f)
+    if not config.get('pools'):
+        raise Exception('{} does not list any pools'.format(path))
+    for pool in config['pools']:
+        for key in ('host', 'user', 'password'):
+            if not pool.get(key):
+                raise Exception('Pool {} in {} has no {}'.format(
+                    pool.get('host'),
+                    path,
+                    key,
+                ))
+    return config
+
+
+class MultiPoolEngine(object):
+    '''
+    Backs up several pools from one process, each pool in its own thread
+    with its own scheduler, under one concurrency budget and one set of
+    bandwidth limits, so the pools do not put uncoordinated load on the
+    backup storage.
+    '''
+
+    def __init__(self, backup_pool, logger, max_parallel=0, shaper=None):
+        '''
+        :param backup_pool: callable
+            backup_pool(args, logger, budget, shaper, shared), backs up
+            one pool and returns its result dicts
+        :param max_parallel: int
+            maximum concurrent exports over all pools, 0 for unlimited
+        :param shaper: `throttle.Shaper`
+            bandwidth limits shared by all pools
+        '''
+        self.backup_pool = backup_pool
+        self.logger = logger
+        self.budget = scheduler.Budget(max_parallel)
+        self.shaper = shaper
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.results = {}
+
+    def shared(self, key, factory):
+        '''
+        :returns: the object created by `factory` for the first pool
+            asking for `key`
+        '''
+        with self.lock:
+            if key not in self.objects:
+                self.objects[key] = factory()
+            return self.objects[key]
+
+    def _run_pool(self, args):
+        try:
+            results = self.backup_pool(
+                args,
+                self.logger,
+                budget=self.budget,
+                shaper=self.shaper,
+                shared=self.shared,
+            )
+        except Exception:
+            # already logged by backup_pool
+            results = None
+        with self.lock:
+            self.results[args.host] = results
+
+    def run(self, pools):
+        '''
+        :param pools: list
+            argparse.Namespace per pool
+        :returns: dict
+            host -> list of result dicts, None for pools that failed
+            before their VMs could be backed up
+        '''
+        self.results = {}
+        started = time.time()
+        threads = []
+        for args in pools:
+            t = threading.Thread(target=self._run_pool, args=(args,),
+                                 name='xenbackup-pool-{}'.format(args.host))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            # join with a timeout so KeyboardInterrupt still reaches the main thread
+            while t.is_alive():
+                t.join(1)
+        failed_pools = [host for host, results in self.results.items() if results is None]
+        results = [r for rs in self.results.values() if rs for r in rs]
+        failed = len([r for r in results if r['status'] != 'success'])
+        self.logger.info('All pools finished: {} pools, {} failed pools, {} succeeded, {} failed VMs in {:.0f} seconds'.format(
+            len(pools),
+            len(failed_pools),
+            len(results) - failed,
+            failed,
+            time.time() - started,
+        ), extra={
+            'pools': len(pools),
+            'failed_pools': failed_pools,
+            'succeeded': len(results) - failed,
+            'failed': failed,
+        })
+        return self.results
@@ -0,0 +1,245 @@
+import collections
+import os
+import tempfile
+import threading
+import time
+
+import transfer
+
+# what a mirror does when its queue is full, see MirrorSink
+POLICIES = ('block', 'spill', 'drop')
+DEFAULT_MIRROR_BUFFER = 64 * 1024 * 1024
+# seconds a full queue may block the download before the mirror is dropped
+DROP_TIMEOUT = 30
+# size of the reads from the spill file
+SPILL_CHUNK = 4 * 1024 * 1024
+
+
+class SlowMirror(Exception):
+    pass
+
+
+class MirrorSink(object):
+    '''
+    Writes a copy of a stream to `writer` in a thread of its own, through
+    a queue of at most `buffer_size` bytes, so a mirror on a slower
+    destination does not hold up the download for every write.
+
+    When the queue is full the `policy` decides: `block` makes the
+    download wait for the mirror, `spill` appends the data to a temporary
+    file in `spill_dir`, which the thread reads back once it caught up
+    with the queue, and `drop` gives the mirror up after `drop_timeout`
+    seconds of waiting. A mirror that fails or is dropped is left behind,
+    its `error` says why, the stream goes on.
+    '''
+
+    def __init__(self, name, writer, buffer_size=DEFAULT_MIRROR_BUFFER, policy='block',
+                 spill_dir=None, drop_timeout=DROP_TIMEOUT):
+        '''
+        :param name: str
+            the mirror, for the thread name and the errors
+        :param writer: file like object
+            with write(), close() and abort()
+        '''
+        if policy not in POLICIES:
+            raise Exception('Unknown mirror policy: {}'.format(policy))
+        self.name = name
+        self.writer = writer
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.drop_timeout = drop_timeout
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.queued = 0
+        self.spill_writer = None
+        self.spill_reader = None
+        self.spill_written = 0
+        self.spill_read = 0
+        self.spilled = 0
+        self.bytes = 0
+        self.closing = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='xenbackup-mirror')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _spilling(self):
+        return self.spill_read < self.spill_written
+
+    def _spill(self, data):
+        if self.spill_writer is None:
+            fd, path = tempfile.mkstemp(prefix='.xenbackup-spill-', dir=self.spill_dir)
+            self.spill_writer = os.fdopen(fd, 'wb')
+            self.spill_reader = open(path, 'rb')
+            # only the two handles keep the file alive
+            os.remove(path)
+        self.spill_writer.write(data)
+        self.spill_writer.flush()
+        self.spill_written += len(data)
+        self.spilled += len(data)
+        self.cond.notify_all()
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.queue.clear()
+        self.queued = 0
+        self.cond.notify_all()
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        # the download reuses its buffer, the queue needs a copy
+        data = bytes(transfer.to_bytes(data))
+        with self.cond:
+            if self._spilling():
+                # keep the order, everything goes through the spill file until it is read back
+                self._spill(data)
+                return
+            deadline = None
+            while self.queue and self.queued + len(data) > self.buffer_size and self.error is None:
+                if self.policy == 'spill':
+                    self._spill(data)
+                    return
+                if self.policy == 'drop':
+                    if deadline is None:
+                        deadline = time.time() + self.drop_timeout
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._fail(SlowMirror('{} fell more than {} seconds behind'.format(
+                            self.name,
+                            self.drop_timeout,
+                        )))
+                        return
+                    self.cond.wait(min(remaining, 1))
+                else:
+                    # a timeout so KeyboardInterrupt still reaches the main thread
+                    self.cond.wait(1)
+            if self.error is not None:
+                return
+            self.queue.append(data)
+            self.queued += len(data)
+            self.cond.notify_all()
+
+    def _next(self):
+        '''
+        :returns: str
+            the next data to write, None when closed and done or failed
+        '''
+        with self.cond:
+            while not self.queue and not self._spilling() and not self.closing and self.error is None:
+                self.cond.wait(1)
+            if self.error is not None:
+                return None
+            if self.queue:
+                data = self.queue.popleft()
+                self.queued -= len(data)
+                self.cond.notify_all()
+                return data
+            if not self._spilling():
+                return None
+            length = min(SPILL_CHUNK, self.spill_written - self.spill_read)
+        # only this thread reads the spill file, the write handle is flushed
+        data = self.spill_reader.read(length)
+        with self.cond:
+            self.spill_read += len(data)
+            self.cond.notify_all()
+        return data
+
+    def _run(self):
+        while True:
+            data = self._next()
+            if data is None:
+                return
+            try:
+                self.writer.write(data)
+                self.bytes += len(data)
+            except Exception as e:
+                with self.cond:
+                    self._fail(e)
+                return
+
+    def _join(self):
+        # join with a timeout so KeyboardInterrupt still reaches the main thread
+        while self.thread.is_alive():
+            self.thread.join(1)
+        for f in (self.spill_writer, self.spill_reader):
+            if f is not None:
+                f.close()
+        self.spill_writer = self.spill_reader = None
+
+    def close(self):
+        '''
+        Waits for the mirror to write everything and closes its writer.
+        Failures end up in `error`, they are not raised.
+        '''
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self._join()
+        if self.error is None:
+            try:
+                self.writer.close()
+                return
+            except Exception as e:
+                self.error = e
+        self.writer.abort()
+
+    def abort(self):
+        with self.cond:
+            self._fail(Exception('aborted'))
+        self._join()
+        self.writer.abort()
+
+
+class FanOutWriter(object):
+    '''
+    Writes a stream to `primary` and copies it to the mirrors, see
+    `MirrorSink`, so one download produces every copy of a backup.
+
+    The primary is written by the caller's thread, its errors fail the
+    stream. The mirrors only fail themselves.
+    '''
+
+    def __init__(self, primary, mirrors):
+        '''
+        :param primary: file like object
+        :param mirrors: list of `MirrorSink`
+        '''
+        self.primary = primary
+        self.mirrors = mirrors
+
+    def prefill(self, path, length):
+        '''
+        Copies the first `length` bytes of the file `path` to the
+        mirrors, the part of a resumed download the primary already has.
+        '''
+        with open(path, 'rb') as f:
+            while length > 0:
+                data = f.read(min(SPILL_CHUNK, length))
+                if not data:
+                    raise Exception('{} is shorter than expected'.format(path))
+                for mirror in self.mirrors:
+                    mirror.write(data)
+                length -= len(data)
+
+    def write(self, data):
+        self.primary.write(data)
+        for mirror in self.mirrors:
+            mirror.write(data)
+
+    def close(self):
+        try:
+            self.primary.close()
+        except Exception:
+            for mirror in self.mirrors:
+                mirror.abort()
+            raise
+        for mirror in self.mirrors:
+            mirror.close()
+
+    def abort(self):
+        self.primary.abort()
+        for mirror in self.mirrors:
+            mirror.abort()
@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+
+
+class RestorePointIndex(object):
+    '''
+    The list of incremental restore points of a VM, stored as index.json in
+    the VM's backup folder.
+
+    A restore point is a dict:
+
+        {
+            'id': '20240101T000000Z',
+            'type': 'full' or 'delta',
+            'parent': id of the restore point the deltas are based on,
+            'snapshot_uuid': uuid of the snapshot kept on the host,
+            'metadata': file name of the VM metadata export,
+            'disks': {
+                userdevice: {
+                    'vdi_uuid': uuid of the snapshot VDI,
+                    'file': file name of the VHD export,
+                    'delta': boolean,
+                },
+            },
+        }
+
+    Restoring a delta needs every restore point up to its full,
+    see `chain()`.
+    '''
+
+    filename = 'index.json'
+
+    def __init__(self, vm_path):
+        self.vm_path = vm_path
+        self.path = os.path.join(vm_path, self.filename)
+        self.lock = threading.Lock()
+        self.points = []
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.points = json.load(f)['restore_points']
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'restore_points': self.points}, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def get(self, point_id):
+        for point in self.points:
+            if point['id'] == point_id:
+                return point
+        return None
+
+    def latest(self):
+        return self.points[-1] if self.points else None
+
+    def add(self, point):
+        self.points.append(point)
+        self.save()
+
+    def chain(self, point_id):
+        '''
+        :returns: list
+            The restore points needed to restore `point_id`, starting
+            with the full.
+        '''
+        chain = []
+        point = self.get(point_id)
+        while point:
+            chain.insert(0, point)
+            point = self.get(point['parent']) if point['parent'] else None
+        return chain
+
+    def deltas_since_full(self):
+        point = self.latest()
+        if not point:
+            return 0
+        return len(self.chain(point['id'])) - 1
+
+    def files(self, point):
+        names = [point['metadata']]
+        names.extend(disk['file'] for disk in point['disks'].values())
+        return [os.path.join(self.vm_path, name) for name in names]
+
+    def remove(self, point_ids):
+        '''
+        Removes restore points from the index, their files are left to
+        the caller.
+        '''
+        point_ids = set(point_ids)
+        if any(p['id'] in point_ids for p in self.points):
+            self.points = [p for p in self.points if p['id'] not in point_ids]
+            self.save()
+
+    def expire(self, keep, sidecars=()):
+        '''
+        Removes all but the newest `keep` restore points, except those
+        still needed as the base of a kept delta.
+
+        :param sidecars: list
+            suffixes of files belonging to the restore point files,
+            removed with them
+        :returns: list
+            the removed restore points
+        '''
+        needed = set()
+        for point in self.points[-keep:] if keep else self.points:
+            needed.update(p['id'] for p in self.chain(point['id']))
+        expired = [p for p in self.points if p['id'] not in needed]
+        for point in expired:
+            for path in self.files(point):
+                for file_path in [path] + [path + suffix for suffix in sidecars]:
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+        if expired:
+            self.points = [p for p in self.points if p['id'] in needed]
+            self.save()
+        return expired
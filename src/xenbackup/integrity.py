@@ -0,0 +1,407 @@
+import Queue
+import hashlib
+import json
+import re
+import threading
+from datetime import datetime
+
+import compression
+import dedup
+from transfer import to_bytes
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+CHECKSUMS = ('sha256', 'xxhash')
+# SHA-256 costs several CPU seconds per GB, xxHash a small part of that
+DEFAULT_CHECKSUM = 'xxhash' if xxhash is not None else 'sha256'
+INTEGRITY_SUFFIX = '.integrity.json'
+READ_SIZE = 4 * 1024 * 1024
+
+TAR_BLOCK = 512
+# a disk chunk of an XVA, followed by a member of the same name with a
+# .checksum (SHA-1) or .xxhash extension holding its hex digest
+XVA_CHUNK = re.compile(r'^Ref:[^/]+/\d{8}$')
+XVA_CHECKSUMS = {
+    'checksum': 'sha1',
+    'xxhash': 'xxhash',
+}
+
+
+class IntegrityError(Exception):
+    pass
+
+
+class Checksum(object):
+    '''
+    Hash of everything passed to `update()`, and its size.
+    '''
+
+    def __init__(self, algorithm='sha256'):
+        '''
+        :param algorithm: str
+            sha256, or xxhash (xxh64) when the xxhash package is installed
+        '''
+        if algorithm == 'sha256':
+            self.hash = hashlib.sha256()
+        elif algorithm == 'xxhash':
+            if xxhash is None:
+                raise Exception('xxhash checksums need the xxhash package, pip install xenbackup[xxhash]')
+            self.hash = xxhash.xxh64()
+        else:
+            raise Exception('Unknown checksum: {}'.format(algorithm))
+        self.algorithm = algorithm
+        self.size = 0
+
+    def update(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class Length(object):
+    '''
+    Number of bytes passed to `update()`, the size of an archive before
+    it was compressed.
+    '''
+
+    def __init__(self):
+        self.size = 0
+
+    def update(self, data):
+        self.size += len(data)
+
+
+def _chunk_hashes(algorithm):
+    if algorithm == 'sha1':
+        return [hashlib.sha1()]
+    if algorithm == 'xxhash' and xxhash is not None:
+        # XAPI has used both flavours of 64 bit xxHash
+        return [xxhash.xxh64()] + ([xxhash.xxh3_64()] if hasattr(xxhash, 'xxh3_64') else [])
+    return []
+
+
+def _tar_number(field):
+    if ord(field[0]) & 0x80:
+        # base-256, used by GNU tar for sizes of 8 GiB and more
+        value = 0
+        for c in bytearray(field[1:]):
+            value = value * 256 + c
+        return value
+    field = field.split('\0', 1)[0].strip()
+    return int(field, 8) if field else 0
+
+
+def _tar_checksum(header):
+    data = bytearray(header)
+    return sum(data[:148]) + 8 * ord(' ') + sum(data[156:])
+
+
+class XVAValidator(object):
+    '''
+    Parses an XVA export as a tar stream while it is downloaded and checks
+    every disk chunk against the checksum member that follows it, so a
+    corrupt or truncated export fails the download instead of a restore.
+
+    Chunks are hashed as they stream through. The checksum algorithm is
+    only known once the first checksum member arrives, the chunk before
+    it is kept in memory until then.
+    '''
+
+    def __init__(self, received=None):
+        '''
+        :param received: str
+            compression of the stream, gzip or zstd for server side
+            compressed exports
+        '''
+        self.decompressor = compression.Decompressor(received) if received else None
+        self.header = bytearray()
+        self.name = None
+        self.kind = None
+        self.remaining = 0
+        self.padding = 0
+        self.ended = False
+        self.algorithm = None
+        self.hashes = None
+        self.data = []
+        self.chunk = None
+        self.members = 0
+        self.chunks = 0
+        self.verified = 0
+        # bytes of the export, after decompressing
+        self.size = 0
+
+    def update(self, data):
+        if self.decompressor:
+            # in bounded slices, a small compressed piece may inflate a thousandfold
+            self.decompressor.decompress_to(to_bytes(data), self._parse, READ_SIZE)
+        else:
+            self._parse(data)
+
+    def _parse(self, data):
+        view = data if isinstance(data, memoryview) else memoryview(data)
+        self.size += len(view)
+        pos = 0
+        size = len(view)
+        while pos < size and not self.ended:
+            if self.remaining:
+                n = min(self.remaining, size - pos)
+                self._member_data(view[pos:pos + n])
+                self.remaining -= n
+                pos += n
+                if not self.remaining:
+                    self._end_member()
+            elif self.padding:
+                n = min(self.padding, size - pos)
+                self.padding -= n
+                pos += n
+            else:
+                n = min(TAR_BLOCK - len(self.header), size - pos)
+                self.header += view[pos:pos + n].tobytes()
+                pos += n
+                if len(self.header) == TAR_BLOCK:
+                    self._start_member(bytes(self.header))
+                    self.header = bytearray()
+
+    def _start_member(self, header):
+        if header == b'\0' * TAR_BLOCK:
+            self.ended = True
+            return
+        try:
+            valid = _tar_checksum(header) == _tar_number(header[148:156])
+        except ValueError:
+            valid = False
+        if not valid:
+            raise IntegrityError('Corrupt tar header after {}'.format(self.name))
+        name = header[:100].split(b'\0', 1)[0]
+        if header[257:262] == b'ustar' and header[345] != b'\0':
+            name = header[345:500].split(b'\0', 1)[0] + b'/' + name
+        self.name = name
+        self.members += 1
+        try:
+            self.remaining = _tar_number(header[124:136])
+        except ValueError:
+            raise IntegrityError('Corrupt tar header of {}'.format(name))
+        self.padding = -self.remaining % TAR_BLOCK
+        self.data = []
+        self.kind = None
+        if XVA_CHUNK.match(name):
+            self.kind = 'chunk'
+            self.hashes = _chunk_hashes(self.algorithm) if self.algorithm else None
+        elif name.rpartition('.')[2] in XVA_CHECKSUMS:
+            self.kind = 'checksum'
+        if not self.remaining:
+            self._end_member()
+
+    def _member_data(self, view):
+        if self.kind == 'chunk' and self.hashes is not None:
+            for h in self.hashes:
+                h.update(view)
+        elif self.kind:
+            self.data.append(view.tobytes())
+
+    def _end_member(self):
+        if self.kind == 'chunk':
+            self.chunks += 1
+            self.chunk = (self.name, self.hashes, self.data)
+        elif self.kind == 'checksum':
+            self._check(self.name.rpartition('.'))
+        self.data = []
+
+    def _check(self, name):
+        base, _, ext = name
+        if not self.chunk or self.chunk[0] != base:
+            raise IntegrityError('{}.{} does not follow its chunk'.format(base, ext))
+        expected = b''.join(self.data).strip().lower()
+        _, hashes, pieces = self.chunk
+        self.chunk = None
+        algorithm = XVA_CHECKSUMS[ext]
+        if hashes is None:
+            hashes = _chunk_hashes(algorithm)
+            for piece in pieces:
+                for h in hashes:
+                    h.update(piece)
+        self.algorithm = algorithm
+        if not hashes:
+            # the xxhash package is missing, the chunks can not be checked
+            return
+        if expected not in [h.hexdigest() for h in hashes]:
+            raise IntegrityError('Checksum mismatch of {} in the export'.format(base))
+        self.verified += 1
+
+    def finish(self):
+        '''
+        :raises: IntegrityError if the archive is incomplete
+        '''
+        if not self.ended:
+            raise IntegrityError('The export is truncated, it ends in {}'.format(self.name))
+
+    def summary(self):
+        return {
+            'members': self.members,
+            'chunks': self.chunks,
+            'verified_chunks': self.verified,
+        }
+
+
+class TapWriter(object):
+    '''
+    File like object passing everything written to it on to `fileobj`
+    and to the `taps`, objects with an update(data) method such as a
+    `Checksum` or an `XVAValidator`.
+    '''
+
+    def __init__(self, fileobj, taps):
+        self.fileobj = fileobj
+        self.taps = taps
+
+    def write(self, data):
+        for tap in self.taps:
+            tap.update(data)
+        self.fileobj.write(data)
+
+    def close(self):
+        self.fileobj.close()
+
+    def abort(self):
+        self.fileobj.abort()
+
+
+def replay(path, length, taps):
+    '''
+    Feeds the first `length` bytes of `path` to the taps, when a download
+    continues a partial file.
+    '''
+    with open(path, 'rb') as f:
+        while length:
+            data = f.read(min(READ_SIZE, length))
+            if not data:
+                raise IntegrityError('{} is shorter than {} bytes'.format(path, length))
+            for tap in taps:
+                tap.update(data)
+            length -= len(data)
+
+
+def manifest(checksum, content='file', validator=None, uncompressed_size=None):
+    '''
+    :param content: str
+        file if `checksum` covers the stored file, stream if it covers
+        the export before it was stored, e.g. deduplicated
+    :param uncompressed_size: int
+        size of a compressed archive once decompressed, None if unknown
+        or not compressed
+    :returns: str
+        the integrity manifest stored next to an archive
+    '''
+    return json.dumps({
+        'algorithm': checksum.algorithm,
+        'digest': checksum.hexdigest(),
+        'size': checksum.size,
+        'uncompressed_size': uncompressed_size,
+        'content': content,
+        'xva': validator.summary() if validator else None,
+        'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }, sort_keys=True)
+
+
+def uncompressed_size(backend, location):
+    '''
+    :returns: int
+        the size of the compressed archive `location` once decompressed,
+        from its integrity manifest, None if it was not recorded
+    '''
+    try:
+        return json.loads(backend.read(location + INTEGRITY_SUFFIX)).get('uncompressed_size')
+    except Exception:
+        # no or an unreadable manifest
+        return None
+
+
+def verify(backend, location, chunk_store=None):
+    '''
+    Reads an archive again and compares it with its integrity manifest.
+
+    :param backend: `storage.LocalStorage` or `storage.S3Storage`
+    :param location: str
+        the archive, without the manifest suffix
+    :param chunk_store: `dedup.ChunkStore`
+        where the chunks of deduplicated archives are
+    :raises: IntegrityError
+    '''
+    info = json.loads(backend.read(location + INTEGRITY_SUFFIX))
+    checksum = Checksum(info['algorithm'])
+    if info['content'] == 'stream':
+        if chunk_store is None:
+            raise IntegrityError('{} is deduplicated, the chunk store is missing'.format(location))
+        for digest in dedup.read_manifest(location)[1]:
+            data = chunk_store.read(digest)
+            if hashlib.sha256(data).digest() != digest:
+                raise IntegrityError('Chunk {} is corrupt'.format(digest.encode('hex')))
+            checksum.update(data)
+    else:
+        f = backend.open(location)
+        try:
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                checksum.update(data)
+        finally:
+            f.close()
+    if checksum.size != info['size']:
+        raise IntegrityError('{} has {} bytes, expected {}'.format(location, checksum.size, info['size']))
+    if checksum.hexdigest() != info['digest']:
+        raise IntegrityError('{} does not match its {} checksum'.format(location, info['algorithm']))
+
+
+def verify_all(backend, logger, parallel=4, chunk_store=None, names=None):
+    '''
+    Verifies every archive with an integrity manifest, `parallel` at a time.
+
+    :param names: list
+        lower case VM names to verify, all if empty
+    :returns: list
+        (location, error) of every archive, error is None if it is intact
+    '''
+    queue = Queue.Queue()
+    for location in sorted(backend.find(INTEGRITY_SUFFIX)):
+        location = location[:-len(INTEGRITY_SUFFIX)]
+        if names and backend.vm_name(location).lower() not in names:
+            continue
+        queue.put(location)
+    results = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                location = queue.get_nowait()
+            except Queue.Empty:
+                return
+            error = None
+            try:
+                verify(backend, location, chunk_store)
+            except Exception as e:
+                error = str(e)
+                logger.error('Verification of {} failed: {}'.format(location, error), extra={
+                    'path': location,
+                    'error': error,
+                })
+            with lock:
+                results.append((location, error))
+
+    threads = []
+    for i in range(max(1, parallel)):
+        t = threading.Thread(target=work, name='xenbackup-verify-{}'.format(i))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        # join with a timeout so KeyboardInterrupt still reaches the main thread
+        while t.is_alive():
+            t.join(1)
+    return results
@@ -0,0 +1,114 @@
+import threading
+
+import XenAPI
+
+
+class MetadataCache(object):
+    '''
+    The VM, VBD, VDI, SR and VM_metrics records of the pool, loaded in
+    bulk once and kept up to date with `event.from`, so looking up a
+    record does not cost a XML-RPC round trip.
+
+    Safe to share between threads, the session passed in is only used
+    by the cache while holding its lock.
+    '''
+
+    classes = ('VM', 'VBD', 'VDI', 'SR', 'VM_metrics')
+
+    def __init__(self, session, logger=None):
+        '''
+        :param session: XenAPI.Session
+        '''
+        self.session = session
+        self.logger = logger
+        self.lock = threading.RLock()
+        self.records = None
+        self.token = None
+
+    def _events(self, token):
+        # `from` is a keyword, the method can only be reached with getattr
+        return getattr(self.session.xenapi.event, 'from')(list(self.classes), token, 0.0)
+
+    def _load(self):
+        self.records = dict((cls, {}) for cls in self.classes)
+        try:
+            # with an empty token event.from returns every object of the
+            # classes as an event, so one call loads all of them
+            self._apply(self._events(''))
+        except XenAPI.Failure:
+            # hosts without event.from, load everything on every refresh
+            self.token = None
+            for cls in self.classes:
+                self.records[cls] = getattr(self.session.xenapi, cls).get_all_records()
+
+    def _apply(self, result):
+        names = dict((cls.lower(), cls) for cls in self.classes)
+        for event in result['events']:
+            cls = names.get(event['class'].lower())
+            if cls is None:
+                continue
+            if event['operation'] == 'del':
+                self.records[cls].pop(event['ref'], None)
+            elif 'snapshot' in event:
+                self.records[cls][event['ref']] = event['snapshot']
+        self.token = result['token']
+
+    def refresh(self):
+        '''
+        Applies the changes made on the pool since the last load or refresh.
+        '''
+        with self.lock:
+            if self.records is None or self.token is None:
+                self._load()
+            else:
+                self._apply(self._events(self.token))
+
+    def all(self, cls):
+        '''
+        :param cls: str
+            VM, VBD, VDI, SR or VM_metrics
+        :returns: dict
+            OpaqueRef -> record
+        '''
+        with self.lock:
+            if self.records is None:
+                self._load()
+            return dict(self.records[cls])
+
+    def get(self, cls, opaque_ref):
+        '''
+        :returns: dict
+            the record, refreshing the cache first if it is unknown
+        :raises: XenAPI.Failure if the object does not exist
+        '''
+        with self.lock:
+            if self.records is None:
+                self._load()
+            if opaque_ref not in self.records[cls]:
+                self.refresh()
+            if opaque_ref not in self.records[cls]:
+                self.records[cls][opaque_ref] = getattr(self.session.xenapi, cls).get_record(opaque_ref)
+            return self.records[cls][opaque_ref]
+
+    def find(self, cls, uuid):
+        '''
+        :returns: str
+            OpaqueRef of the object with the given uuid, None if it
+            does not exist
+        '''
+        with self.lock:
+            for attempt in range(2):
+                if attempt or self.records is None:
+                    self.refresh()
+                for opaque_ref, record in self.records[cls].items():
+                    if record['uuid'] == uuid:
+                        return opaque_ref
+        return None
+
+    def forget(self, cls, opaque_ref):
+        '''
+        Removes an object that was destroyed, without waiting for its event.
+        '''
+        with self.lock:
+            if self.records is not None:
+                self.records[cls].pop(opaque_ref, None)
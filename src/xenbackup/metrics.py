@@ -0,0 +1,321 @@
+import collections
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import urllib2
+from contextlib import contextmanager
+
+# (name, help, key of VMMetrics.as_dict())
+VM_METRICS = [
+    ('xenbackup_vm_success', 'Whether the last backup of the VM succeeded', 'success'),
+    ('xenbackup_vm_duration_seconds', 'Time from the start of the backup until it finished', 'duration'),
+    ('xenbackup_vm_snapshot_seconds', 'Time spent creating snapshots', 'snapshot_seconds'),
+    ('xenbackup_vm_first_byte_seconds', 'Time from requesting the export until its first bytes arrived', 'first_byte_seconds'),
+    ('xenbackup_vm_export_seconds', 'Time spent downloading the export, retries included', 'export_seconds'),
+    ('xenbackup_vm_bytes', 'Bytes received from the server', 'bytes'),
+    ('xenbackup_vm_throughput_bytes_per_second', 'Bytes received per second of export time', 'bytes_per_second'),
+    ('xenbackup_vm_write_stall_seconds', 'Time the download waited for the writer', 'write_stall_seconds'),
+    ('xenbackup_vm_throttled_seconds', 'Time the download waited for the bandwidth limits', 'throttled_seconds'),
+    ('xenbackup_vm_sparse_bytes', 'Bytes of zeros left as holes instead of written', 'sparse_bytes'),
+    ('xenbackup_vm_delete_seconds', 'Time spent deleting snapshots', 'delete_seconds'),
+    ('xenbackup_vm_rotate_seconds', 'Time spent rotating the backups', 'rotate_seconds'),
+    ('xenbackup_vm_snapshot_retries', 'Retried snapshot creations', 'snapshot_retries'),
+    ('xenbackup_vm_export_retries', 'Retried downloads', 'export_retries'),
+    ('xenbackup_vm_delete_retries', 'Retried destroys of snapshot disks', 'delete_retries'),
+    ('xenbackup_vm_mirror_failures', 'Mirrors left without a copy of the backup', 'mirror_failures'),
+    ('xenbackup_vm_mirror_spill_bytes', 'Bytes spilled to disk for mirrors that fell behind', 'mirror_spill_bytes'),
+]
+
+
+class VMMetrics(object):
+    '''
+    The per phase timings of one VM's backup. Safe to update from the
+    snapshot stage and the export worker at the same time.
+    '''
+
+    def __init__(self, host, vm_info):
+        self.lock = threading.Lock()
+        self.values = {
+            'host': host,
+            'vm_name': vm_info['name_label'],
+            'vm_uuid': vm_info['uuid'],
+            'status': None,
+            'error': None,
+            'duration': None,
+            'snapshot_seconds': 0,
+            'first_byte_seconds': None,
+            'export_seconds': 0,
+            'bytes': 0,
+            'write_stall_seconds': 0,
+            'throttled_seconds': 0,
+            'sparse_bytes': 0,
+            'delete_seconds': 0,
+            'rotate_seconds': 0,
+            'snapshot_retries': 0,
+            'export_retries': 0,
+            'delete_retries': 0,
+            'mirror_failures': 0,
+            'mirror_spill_bytes': 0,
+        }
+
+    def add(self, key, value):
+        with self.lock:
+            self.values[key] += value
+
+    def first(self, key, value):
+        '''
+        Sets `key` unless it has been set before, e.g. the time to first
+        byte of a VM exported in several downloads.
+        '''
+        with self.lock:
+            if self.values[key] is None:
+                self.values[key] = value
+
+    def update(self, **values):
+        with self.lock:
+            self.values.update(values)
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Adds the time spent in the block to `<name>_seconds`, also if
+        it raises.
+        '''
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add('{}_seconds'.format(name), time.time() - started)
+
+    def as_dict(self):
+        with self.lock:
+            values = dict(self.values)
+        values['bytes_per_second'] = None
+        if values['export_seconds']:
+            values['bytes_per_second'] = values['bytes'] / values['export_seconds']
+        values['success'] = None
+        if values['status']:
+            values['success'] = 1 if values['status'] == 'success' else 0
+        return values
+
+
+class RunMetrics(object):
+    '''
+    Collects the `VMMetrics` of every VM of a run, over all pools, and
+    writes them as a JSON report or in the Prometheus text format.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.vms = collections.OrderedDict()
+        self.pools = collections.OrderedDict()
+
+    def vm(self, host, vm_info):
+        '''
+        :param host: str
+            the pool master the VM was backed up from
+        :returns: `VMMetrics`
+        '''
+        key = (host, vm_info['uuid'])
+        with self.lock:
+            if key not in self.vms:
+                self.vms[key] = VMMetrics(host, vm_info)
+            return self.vms[key]
+
+    def record_results(self, host, results):
+        '''
+        :param results: list
+            result dicts of `scheduler.BackupScheduler.run`, None if the
+            pool failed before its VMs could be backed up
+        '''
+        with self.lock:
+            self.pools[host] = 'failed' if results is None else 'success'
+        for r in results or []:
+            self.vm(host, {'name_label': r['vm_name'], 'uuid': r['vm_uuid']}).update(
+                status=r['status'],
+                error=r['error'],
+                duration=r['duration'],
+            )
+
+    def finish(self):
+        self.finished = time.time()
+
+    def report(self):
+        '''
+        :returns: dict
+        '''
+        vms = [m.as_dict() for m in self.vms.values()]
+        finished = self.finished or time.time()
+        return {
+            'started': self.started,
+            'finished': finished,
+            'duration': finished - self.started,
+            'pools': dict(self.pools),
+            'succeeded': len([v for v in vms if v['status'] == 'success']),
+            'failed': len([v for v in vms if v['status'] != 'success']),
+            'bytes': sum(v['bytes'] for v in vms),
+            'vms': vms,
+        }
+
+    def write_report(self, path):
+        _write_atomic(path, json.dumps(self.report(), indent=2, sort_keys=True))
+
+    def prometheus(self):
+        '''
+        :returns: str
+            the metrics in the Prometheus text exposition format
+        '''
+        report = self.report()
+        lines = []
+
+        def metric(name, help, samples):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+
+        metric('xenbackup_run_start_timestamp_seconds', 'When the run started',
+               [({}, report['started'])])
+        metric('xenbackup_run_duration_seconds', 'Duration of the run',
+               [({}, report['duration'])])
+        metric('xenbackup_run_vms', 'VMs of the run by status',
+               [({'status': 'success'}, report['succeeded']), ({'status': 'failed'}, report['failed'])])
+        metric('xenbackup_run_bytes', 'Bytes received in the run',
+               [({}, report['bytes'])])
+        metric('xenbackup_pool_success', 'Whether the VMs of the pool could be backed up',
+               [({'host': host}, int(status == 'success')) for host, status in report['pools'].items()])
+        for name, help, key in VM_METRICS:
+            metric(name, help, [
+                ({'host': v['host'], 'vm_name': v['vm_name'], 'vm_uuid': v['vm_uuid']}, v[key])
+                for v in report['vms']
+            ])
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        '''
+        Writes the metrics for node_exporter's textfile collector. The
+        file is replaced atomically so it is never read half written.
+        '''
+        _write_atomic(path, self.prometheus())
+
+    def push(self, url, job='xenbackup', timeout=30):
+        '''
+        Replaces the metrics of `job` on a Prometheus pushgateway.
+
+        :param url: str
+            e.g. http://pushgateway:9091
+        '''
+        request = urllib2.Request(
+            '{}/metrics/job/{}'.format(url.rstrip('/'), job),
+            data=self.prometheus(),
+            headers={'Content-Type': 'text/plain; version=0.0.4'},
+        )
+        request.get_method = lambda: 'PUT'
+        urllib2.urlopen(request, timeout=timeout).close()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return u'{{{}}}'.format(u','.join(
+        u'{}="{}"'.format(key, unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items())
+    )).encode('utf-8')
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _write_atomic(path, data):
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+class SamplingProfiler(object):
+    '''
+    Statistical profiler for the threads running a backup. A background
+    thread takes the stacks of the profiled threads every `interval`
+    seconds, so the overhead does not depend on the number of calls.
+
+    The samples are written in the collapsed stack format of
+    flamegraph.pl and speedscope, one `frame;frame;frame count` line per
+    distinct stack.
+    '''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.threads = {}
+        self.samples = collections.Counter()
+        self.thread = None
+
+    @contextmanager
+    def profile(self):
+        '''
+        Samples the calling thread while in the block. Blocks may nest.
+        '''
+        ident = threading.current_thread().ident
+        with self.lock:
+            self.threads[ident] = self.threads.get(ident, 0) + 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._sample, name='xenbackup-profiler')
+                self.thread.daemon = True
+                self.thread.start()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.threads[ident] -= 1
+                if not self.threads[ident]:
+                    del self.threads[ident]
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                idents = list(self.threads)
+            if not idents:
+                continue
+            frames = sys._current_frames()
+            stacks = []
+            for ident in idents:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                if stack:
+                    stacks.append(';'.join(reversed(stack)))
+            with self.lock:
+                self.samples.update(stacks)
+
+    def write(self, path):
+        with self.lock:
+            samples = self.samples.most_common()
+        _write_atomic(path, ''.join('{} {}\n'.format(stack, count) for stack, count in samples))
+
+
+def profiled(method):
+    '''
+    Runs a `XenBackup` method under the instance's profiler, if it has one.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.profiler:
+            return method(self, *args, **kwargs)
+        with self.profiler.profile():
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,187 @@
+import hashlib
+import heapq
+import json
+import time
+
+import XenAPI
+import scheduler
+
+
+class BackupPlanner(object):
+    '''
+    Decides which VMs of a run need a backup and in which order.
+
+    A halted VM whose disks, power state and start time are the same as at
+    its last successful backup is skipped, its newest backup is still
+    current. The other VMs are ordered longest first (LPT scheduling), so
+    the big exports do not end up alone at the end of the run. Their
+    duration is estimated from their previous backups in `state`, scaled
+    by the size of their disks, and from the throughput of the other VMs
+    for VMs without history.
+    '''
+
+    def __init__(self, backup, state=None, skip_unchanged=False, max_skip_age=30 * 86400):
+        '''
+        :param backup: `XenBackup`
+            logged in instance, for the metadata of the pool
+        :param state: `state.BackupState`
+        :param skip_unchanged: boolean
+            skip halted VMs that did not change since their last backup
+        :param max_skip_age: int
+            seconds after which an unchanged VM is backed up anyway,
+            0 to skip it forever
+        '''
+        self.backup = backup
+        self.state = state
+        self.skip_unchanged = skip_unchanged
+        self.max_skip_age = max_skip_age
+
+    def get_size(self, vm_info):
+        '''
+        :returns: int
+            bytes allocated by the VM's disks
+        '''
+        size = 0
+        for vbd in vm_info['VBDs']:
+            vbd_record = self.backup.metadata.get('VBD', vbd)
+            if vbd_record['type'].lower() != 'disk':
+                continue
+            size += int(self.backup.metadata.get('VDI', vbd_record['VDI'])['physical_utilisation'])
+        return size
+
+    def get_fingerprint(self, vm_info):
+        '''
+        :returns: str
+            digest of everything that changes when the VM's disks can have
+            changed, None if that can not be known, e.g. while it is running
+        '''
+        if vm_info['power_state'] != 'Halted':
+            return None
+        try:
+            # thick provisioned disks keep their size when written to,
+            # only the start time tells that the VM ran in the meantime
+            start_time = self.backup.metadata.get('VM_metrics', vm_info['metrics'])['start_time']
+        except (XenAPI.Failure, KeyError):
+            return None
+        disks = []
+        for vbd in vm_info['VBDs']:
+            vbd_record = self.backup.metadata.get('VBD', vbd)
+            if vbd_record['type'].lower() != 'disk':
+                continue
+            vdi = self.backup.metadata.get('VDI', vbd_record['VDI'])
+            disks.append([
+                vbd_record['userdevice'],
+                vdi['uuid'],
+                vdi['virtual_size'],
+                vdi['physical_utilisation'],
+            ])
+        return hashlib.sha1(json.dumps([
+            vm_info['power_state'],
+            str(start_time),
+            sorted(disks),
+        ])).hexdigest()
+
+    def is_unchanged(self, job, previous):
+        if not self.skip_unchanged or not job['fingerprint']:
+            return False
+        if previous.get('fingerprint') != job['fingerprint']:
+            return False
+        age = time.time() - previous.get('time', 0)
+        return not self.max_skip_age or age < self.max_skip_age
+
+    def plan(self, jobs):
+        '''
+        Adds `size`, `fingerprint` and `estimate`, the expected duration in
+        seconds or None without history, to the jobs.
+
+        :param jobs: list of dicts
+            from `XenBackup.get_jobs()`
+        :returns: tuple (list, list)
+            the jobs to run, longest first, and the skipped jobs
+        '''
+        history = {}
+        todo = []
+        skipped = []
+        for job in jobs:
+            job['size'] = self.get_size(job['vm_info'])
+            job['fingerprint'] = self.get_fingerprint(job['vm_info'])
+            previous = self.state.get_vm(job['vm_info']['uuid']).get('last_backup', {}) if self.state else {}
+            history[job['vm_info']['uuid']] = previous
+            if self.is_unchanged(job, previous):
+                skipped.append(job)
+            else:
+                todo.append(job)
+        # bytes per second over all VMs with history, for the VMs without
+        rate = None
+        known = [p for p in history.values() if p.get('seconds') and p.get('size')]
+        if known:
+            rate = sum(p['size'] for p in known) / sum(p['seconds'] for p in known)
+        for job in todo:
+            previous = history[job['vm_info']['uuid']]
+            job['estimate'] = None
+            if previous.get('seconds') and previous.get('size'):
+                job['estimate'] = previous['seconds'] * job['size'] / float(previous['size'])
+            elif previous.get('seconds'):
+                job['estimate'] = previous['seconds']
+            elif rate:
+                job['estimate'] = job['size'] / rate
+        todo.sort(key=lambda job: (job['estimate'] or 0, job['size']), reverse=True)
+        return todo, skipped
+
+    def record(self, jobs, results):
+        '''
+        Stores the fingerprint, size and duration of the successful
+        backups, for the next runs.
+        '''
+        if not self.state:
+            return
+        jobs = dict((job['vm_info']['uuid'], job) for job in jobs)
+        for result in results:
+            job = jobs.get(result['vm_uuid'])
+            if job is None or result['status'] != 'success':
+                continue
+            with self.state.vm(result['vm_uuid']) as vm:
+                vm['last_backup'] = {
+                    'time': result['started'],
+                    'fingerprint': job['fingerprint'],
+                    'size': job['size'],
+                    'seconds': result['duration'],
+                }
+
+
+def predict(jobs, workers=1, max_per_host=2, max_per_sr=1):
+    '''
+    Simulates a run of the planned jobs under the limits of
+    `scheduler.BackupScheduler`, which starts the first job in order that
+    fits whenever a worker is free.
+
+    :param jobs: list of dicts
+        from `BackupPlanner.plan()`
+    :returns: float
+        predicted seconds until the last job finishes, None if the
+        duration of a job is unknown
+    '''
+    if any(job['estimate'] is None for job in jobs):
+        return None
+    limiter = scheduler.Limiter({'host': max_per_host, 'sr': max_per_sr})
+    keys = lambda job: [('sr', sr) for sr in job['srs']] + ([('host', job['host'])] if job['host'] else [])
+    pending = list(jobs)
+    running = []
+    now = 0.0
+    counter = 0
+    workers = max(1, workers)
+    while pending or running:
+        started = True
+        while started and pending and len(running) < workers:
+            started = False
+            for job in pending:
+                if limiter.can_acquire(keys(job)):
+                    limiter.acquire(keys(job))
+                    pending.remove(job)
+                    counter += 1
+                    heapq.heappush(running, (now + job['estimate'], counter, job))
+                    started = True
+                    break
+        now, _, job = heapq.heappop(running)
+        limiter.release(keys(job))
+    return now
@@ -0,0 +1,479 @@
+import Queue
+import calendar
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import urllib
+
+import compression
+import dedup
+import incremental
+import integrity
+import scheduler
+import storage
+import transfer
+
+READ_SIZE = 4 * 1024 * 1024
+PREFETCH = 4
+# archives of full backups, not the metadata of incremental restore points
+ARCHIVE = re.compile(r'(?<!\.metadata)\.xva(\.gz|\.zst|\.lz4)?(\.manifest)?$')
+# compressed archives XAPI decompresses itself on /import
+IMPORT_COMPRESSION = ('gzip',)
+VHD_COOKIE = b'conectix'
+
+
+class RestoreError(Exception):
+    pass
+
+
+def prefetch(iterable, depth=PREFETCH):
+    '''
+    Runs `iterable` in a separate thread, up to `depth` items ahead, so
+    reading and decompressing the archive overlaps with the upload.
+    '''
+    queue = Queue.Queue(depth)
+    end = object()
+    stopped = []
+
+    def run():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+                if stopped:
+                    return
+            queue.put((end, None))
+        except Exception:
+            queue.put((end, sys.exc_info()))
+
+    t = threading.Thread(target=run, name='xenbackup-prefetch')
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error:
+                raise error[0], error[1], error[2]
+            if item is end:
+                return
+            yield item
+    finally:
+        stopped.append(True)
+        # unblock the thread if it waits on a full queue
+        while t.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+def read_file(backend, location, size=READ_SIZE):
+    f = backend.open(location)
+    try:
+        while True:
+            data = f.read(size)
+            if not data:
+                return
+            yield data
+    finally:
+        f.close()
+
+
+def decompressed(backend, location, name):
+    f = backend.open(location)
+    try:
+        for data in compression.iter_decompressed(name, f, READ_SIZE):
+            yield data
+    finally:
+        f.close()
+
+
+def get_compression(location):
+    '''
+    :returns: str
+        gzip, zstd or lz4 if the archive is compressed, otherwise None
+    '''
+    for name, compressor in compression.COMPRESSORS.items():
+        if location.endswith(compressor.suffix):
+            return name
+    return None
+
+
+def open_archive(backend, location, chunk_store=None, send_compressed=IMPORT_COMPRESSION):
+    '''
+    :param send_compressed: list
+        compressions the server takes, archives compressed otherwise are
+        decompressed on the fly
+    :returns: tuple (iterable, int)
+        the data to upload and its length
+    '''
+    if location.endswith('.manifest'):
+        if chunk_store is None:
+            raise RestoreError('{} is deduplicated, the chunk store is missing'.format(location))
+        info, digests = dedup.read_manifest(location)
+        return prefetch(chunk_store.read(digest) for digest in digests), info['size']
+    name = get_compression(location)
+    if not name or name in send_compressed:
+        return prefetch(read_file(backend, location)), backend.size(location)
+    # the length has to be sent first, archives without it in their
+    # integrity manifest have to be decompressed once to learn it
+    length = integrity.uncompressed_size(backend, location)
+    if length is None:
+        length = sum(len(data) for data in decompressed(backend, location, name))
+    return prefetch(decompressed(backend, location, name)), length
+
+
+def vhd_size(backend, location):
+    '''
+    :returns: int
+        the virtual size of a VHD, from the copy of its footer at the start
+    '''
+    name = get_compression(location)
+    chunks = decompressed(backend, location, name) if name else read_file(backend, location)
+    head = b''
+    for data in chunks:
+        head += data
+        if len(head) >= 64:
+            break
+    chunks.close()
+    if head[:8] != VHD_COOKIE:
+        raise RestoreError('{} is not a VHD'.format(location))
+    return struct.unpack('>Q', head[48:56])[0]
+
+
+def find_backup(backend, name, point_id=None, backup_catalog=None, destination=None):
+    '''
+    Picks the newest backup of a VM: its newest archive, or the newest
+    incremental restore point if that is more recent.
+
+    :param name: str
+        the VM's folder
+    :param point_id: str
+        restore this incremental restore point instead
+    :param backup_catalog: `catalog.BackupCatalog`
+        look the newest backup up in the catalog, the VM's folder is
+        only read if the catalog has no backups of it
+    :param destination: str
+        key of `backend` in the catalog, see `catalog.destination()`
+    :returns: dict
+        a restore job, `name`, `size` and either `location` or `vm_path`
+        and `point`
+    '''
+    latest = backup_catalog.latest(destination, name) if backup_catalog and not point_id else None
+    if latest and latest['kind'] == 'archive':
+        return {
+            'name': name,
+            'location': latest['files'][0]['location'],
+            'size': latest['files'][0]['size'],
+        }
+    if latest:
+        point_id = latest['point_id']
+    index = None
+    if not backend.remote:
+        vm_path = os.path.abspath(os.path.join(backend.root, name))
+        if os.path.exists(os.path.join(vm_path, incremental.RestorePointIndex.filename)):
+            index = incremental.RestorePointIndex(vm_path)
+    if point_id:
+        point = index.get(point_id) if index else None
+        if point is None:
+            raise RestoreError('{} has no restore point {}'.format(name, point_id))
+    else:
+        point = index.latest() if index else None
+    archives = backend.backups(name, ARCHIVE)
+    if point and (point_id or not archives or
+                  calendar.timegm(time.strptime(point['id'], '%Y%m%dT%H%M%SZ')) >= os.path.getmtime(archives[-1])):
+        files = [f for p in index.chain(point['id']) for f in index.files(p)]
+        return {
+            'name': name,
+            'vm_path': index.vm_path,
+            'point': point,
+            'size': sum(os.path.getsize(f) for f in files if os.path.exists(f)),
+        }
+    if not archives:
+        raise RestoreError('There are no backups of {}'.format(name))
+    return {
+        'name': name,
+        'location': archives[-1],
+        'size': backend.size(archives[-1]),
+    }
+
+
+class Restorer(object):
+    '''
+    Imports backups into a pool, streaming them from the backup storage
+    to the import handlers of the pool master without temporary files.
+    '''
+
+    def __init__(self, backup, backend, chunk_store=None, preserve=False, poll_interval=1, disk_streams=4):
+        '''
+        :param backup: `XenBackup`
+            logged in instance, for its session and logger
+        :param backend: `storage.LocalStorage` or `storage.S3Storage`
+        :param chunk_store: `dedup.ChunkStore`
+            for deduplicated archives
+        :param preserve: boolean
+            keep the MAC addresses of the VIFs, like `xe vm-import preserve=true`
+        :param disk_streams: int
+            number of disks of a restore point imported at the same time
+        '''
+        self.backup = backup
+        self.session = backup.session
+        self.logger = backup.logger
+        self.backend = backend
+        self.chunk_store = chunk_store
+        self.preserve = preserve
+        self.poll_interval = poll_interval
+        self.disk_streams = disk_streams
+
+    def _wait(self, task):
+        '''
+        :returns: str
+            the task's result
+        :raises: RestoreError if the task failed
+        '''
+        while True:
+            status = self.session.xenapi.task.get_status(task)
+            if status != 'pending':
+                break
+            time.sleep(self.poll_interval)
+        if status != 'success':
+            raise RestoreError('Import failed: {}'.format(' '.join(
+                self.session.xenapi.task.get_error_info(task),
+            )))
+        return self.session.xenapi.task.get_result(task)
+
+    def _put(self, handler, query, chunks, length, stats):
+        '''
+        Uploads to an import handler with a task to follow it.
+
+        :returns: str
+            the result of the task
+        '''
+        task = self.session.xenapi.task.create('xenbackup {}'.format(handler), '')
+        try:
+            query = [('session_id', self.session.handle), ('task_id', task)] + query
+            url = 'https://{}/{}?{}'.format(self.backup.server, handler, urllib.urlencode(query))
+            try:
+                transfer.put(url, chunks, length, stats=stats)
+            except Exception:
+                # the task knows why the server gave up on the upload
+                error = self.session.xenapi.task.get_error_info(task)
+                if error:
+                    raise RestoreError('Import failed: {}'.format(' '.join(error)))
+                raise
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+            return self._wait(task)
+        finally:
+            try:
+                self.session.xenapi.task.destroy(task)
+            except Exception:
+                pass
+
+    def _imported(self, result, name):
+        '''
+        Turns the imported snapshot into a VM named `name`, exports of
+        snapshots are imported as templates.
+
+        :returns: str
+            OpaqueRef of the VM
+        '''
+        vms = re.findall(r'OpaqueRef:[^<\s]+', result)
+        if not vms:
+            raise RestoreError('The import of {} did not create a VM'.format(name))
+        for vm in vms:
+            self.session.xenapi.VM.set_is_a_template(vm, False)
+            self.session.xenapi.VM.set_name_label(vm, name)
+        return vms[0]
+
+    def restore_archive(self, job, sr, stats):
+        chunks, length = open_archive(self.backend, job['location'], self.chunk_store)
+        query = [('sr_id', sr)]
+        if self.preserve:
+            query.append(('restore', 'true'))
+        return self._imported(self._put('import', query, chunks, length, stats), job['name'])
+
+    def restore_point(self, job, sr, stats):
+        '''
+        Creates a VDI per disk, imports the full VHD of the disk and then
+        its deltas up to the restore point into it, oldest first, and
+        imports the VM's metadata with the snapshot VDIs it refers to
+        mapped to the new VDIs. `disk_streams` disks are imported at the
+        same time.
+        '''
+        index = incremental.RestorePointIndex(job['vm_path'])
+        chain = index.chain(job['point']['id'])
+        vdis = []
+        disks = []
+        lock = threading.Lock()
+        query = [('force', 'true')]
+        if self.preserve:
+            query.append(('restore', 'true'))
+        try:
+            for userdevice, disk in sorted(job['point']['disks'].items()):
+                points = [p for p in chain if userdevice in p['disks']]
+                # a disk added later starts with a full export of its own
+                full = max(i for i, p in enumerate(points) if not p['disks'][userdevice]['delta'])
+                files = [os.path.join(job['vm_path'], p['disks'][userdevice]['file']) for p in points[full:]]
+                vdi = self.session.xenapi.VDI.create({
+                    'name_label': '{} {}'.format(job['name'], userdevice),
+                    'name_description': 'restored by xenbackup from {}'.format(job['point']['id']),
+                    'SR': sr,
+                    # the disk may have grown since its full export
+                    'virtual_size': str(max(vhd_size(self.backend, f) for f in files)),
+                    'type': 'user',
+                    'sharable': False,
+                    'read_only': False,
+                    'other_config': {},
+                    'xenstore_data': {},
+                    'sm_config': {},
+                    'tags': [],
+                })
+                vdis.append(vdi)
+                disks.append((vdi, files))
+                query.append(('vdi:{}'.format(disk['vdi_uuid']), self.session.xenapi.VDI.get_uuid(vdi)))
+
+            def import_disk(disk):
+                vdi, files = disk
+                disk_stats = {}
+                try:
+                    for path in files:
+                        chunks, length = open_archive(self.backend, path, send_compressed=())
+                        self._put('import_raw_vdi', [('vdi', vdi), ('format', 'vhd')], chunks, length, disk_stats)
+                finally:
+                    with lock:
+                        for key, value in disk_stats.items():
+                            stats[key] = stats.get(key, 0) + value
+
+            storage.run_parallel(import_disk, disks, self.disk_streams, name='xenbackup-restore-disk')
+            metadata = os.path.join(job['vm_path'], job['point']['metadata'])
+            chunks, length = open_archive(self.backend, metadata, send_compressed=())
+            return self._imported(self._put('import_metadata', query, chunks, length, stats), job['name'])
+        except Exception:
+            for vdi in vdis:
+                try:
+                    self.session.xenapi.VDI.destroy(vdi)
+                except Exception:
+                    pass
+            raise
+
+    def restore(self, job, sr):
+        '''
+        :param job: dict
+            from `find_backup()`
+        :param sr: str
+            OpaqueRef of the SR to restore the disks to
+        :returns: dict
+            the result of the restore
+        '''
+        stats = {}
+        result = {
+            'vm_name': job['name'],
+            'sr': sr,
+            'status': 'failed',
+            'error': None,
+            'vm': None,
+            'started': time.time(),
+        }
+        extra = {
+            'host': self.backup.server,
+            'vm_name': job['name'],
+        }
+        self.logger.info('Restoring {} from {}'.format(
+            job['name'],
+            job.get('location') or job['point']['id'],
+        ), extra=extra)
+        try:
+            if 'point' in job:
+                result['vm'] = self.restore_point(job, sr, stats)
+            else:
+                result['vm'] = self.restore_archive(job, sr, stats)
+            result['status'] = 'success'
+        except Exception as e:
+            result['error'] = str(e)
+            self.logger.exception('Restore of {} failed'.format(job['name']), extra=dict(extra, error=str(e)))
+        result['duration'] = time.time() - result['started']
+        result['bytes'] = stats.get('bytes', 0)
+        if result['status'] == 'success':
+            self.logger.info('Restored {} in {:.0f} seconds, {:.1f} MB/s'.format(
+                job['name'],
+                result['duration'],
+                result['bytes'] / 1024.0 / 1024.0 / max(result['duration'], 0.001),
+            ), extra=dict(extra, seconds=result['duration'], bytes=result['bytes']))
+        return result
+
+
+def restore_all(jobs, restorer_factory, srs, workers=2, max_per_sr=1, logger=None):
+    '''
+    Restores the jobs, largest first, `workers` at a time and at most
+    `max_per_sr` per SR. Every job goes to the least busy of `srs`
+    that is below its limit.
+
+    :param restorer_factory: callable
+        returns a new `Restorer` with its own session, called once per worker
+    :param srs: list
+        OpaqueRefs of the SRs to restore to
+    :returns: list
+        the result dicts, see `Restorer.restore()`
+    '''
+    limiter = scheduler.Limiter({'sr': max_per_sr})
+    cond = threading.Condition()
+    pending = sorted(jobs, key=lambda job: job['size'], reverse=True)
+    results = []
+
+    def next_job():
+        with cond:
+            while pending:
+                free = [sr for sr in srs if limiter.can_acquire([('sr', sr)])]
+                if free:
+                    sr = min(free, key=lambda sr: limiter.running.get(('sr', sr), 0))
+                    limiter.acquire([('sr', sr)])
+                    return pending.pop(0), sr
+                cond.wait()
+            return None, None
+
+    def work():
+        try:
+            restorer = restorer_factory()
+        except Exception:
+            logger.exception('Restore worker failed to log in')
+            return
+        try:
+            while True:
+                job, sr = next_job()
+                if job is None:
+                    return
+                result = restorer.restore(job, sr)
+                with cond:
+                    limiter.release([('sr', sr)])
+                    results.append(result)
+                    cond.notify_all()
+        finally:
+            restorer.backup.logout()
+
+    threads = []
+    for i in range(max(1, min(workers, len(jobs)))):
+        t = threading.Thread(target=work, name='xenbackup-restore-{}'.format(i))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        # join with a timeout so KeyboardInterrupt still reaches the main thread
+        while t.is_alive():
+            t.join(1)
+    for job in pending:
+        # every worker failed to log in
+        results.append({
+            'vm_name': job['name'],
+            'sr': None,
+            'status': 'failed',
+            'error': 'not started',
+            'vm': None,
+            'started': time.time(),
+            'duration': 0,
+            'bytes': 0,
+        })
+    return results
@@ -0,0 +1,386 @@
+import threading
+import time
+import traceback
+
+
+class Limiter(object):
+    '''
+    Counts how many jobs are running against a set of keys (hosts, SRs)
+    and only lets a job start when every key it touches is below its limit.
+
+    All keys of a job are acquired atomically, so two jobs sharing
+    several SRs can never deadlock on each other.
+    '''
+
+    def __init__(self, limits):
+        '''
+        :param limits: dict
+            key prefix -> max concurrent jobs, e.g. {'host': 2, 'sr': 1}.
+            A limit of 0 or None means unlimited.
+        '''
+        self.limits = limits
+        self.running = {}
+
+    def _limit(self, key):
+        return self.limits.get(key[0])
+
+    def can_acquire(self, keys):
+        for key in keys:
+            limit = self._limit(key)
+            if limit and self.running.get(key, 0) >= limit:
+                return False
+        return True
+
+    def acquire(self, keys):
+        for key in keys:
+            self.running[key] = self.running.get(key, 0) + 1
+
+    def release(self, keys):
+        for key in keys:
+            self.running[key] -= 1
+            if not self.running[key]:
+                del self.running[key]
+
+
+class Budget(object):
+    '''
+    A concurrency budget shared by the schedulers of several pools running
+    in one process, so together they never run more than `max_parallel`
+    exports.
+
+    The schedulers sharing a budget also share its condition, a job
+    finishing on one pool wakes up the workers of the others.
+    '''
+
+    keys = [('global', None)]
+
+    def __init__(self, max_parallel=0):
+        '''
+        :param max_parallel: int
+            0 or None for unlimited
+        '''
+        self.cond = threading.Condition()
+        self.limiter = Limiter({'global': max_parallel})
+
+
+class SnapshotRelease(object):
+    '''
+    Takes a job's snapshot off the count of live snapshots, once: when
+    the export is done with it or, if the export deletes it in the
+    background, when that delete has finished.
+    '''
+
+    def __init__(self, release):
+        '''
+        :param release: callable
+            called once the snapshot no longer exists or is kept
+        '''
+        self.release = release
+        self.lock = threading.Lock()
+        self.deferred = False
+        self.done = False
+
+    def defer(self):
+        '''
+        Called before the snapshot is handed to a background delete, which
+        calls the release when it finishes.
+        '''
+        self.deferred = True
+
+    def __call__(self):
+        with self.lock:
+            if self.done:
+                return
+            self.done = True
+        self.release()
+
+
+class BackupScheduler(object):
+
+    def __init__(self, backup_factory, workers=4, max_per_host=2, max_per_sr=1,
+                 lookahead=0, logger=None, budget=None, **download_kwargs):
+        '''
+        :param backup_factory: callable
+            Returns a new logged in `XenBackup`. Called once per worker
+            so that every worker gets its own XenAPI session.
+        :param workers: int
+            Number of VMs to back up at the same time
+        :param max_per_host: int
+            Maximum number of concurrent exports per XenServer host
+        :param max_per_sr: int
+            Maximum number of concurrent exports per storage repository
+        :param lookahead: int
+            If set, snapshots are created by a separate snapshot stage
+            running ahead of the exports. At most `workers + lookahead`
+            snapshots exist on the pool at once.
+        :param budget: `Budget`
+            shared with the schedulers of other pools
+        :param download_kwargs:
+            Passed on to `XenBackup.download_vm`
+        '''
+        self.backup_factory = backup_factory
+        self.workers = max(1, workers)
+        self.limiter = Limiter({
+            'host': max_per_host,
+            'sr': max_per_sr,
+        })
+        self.lookahead = lookahead
+        self.max_live_snapshots = self.workers + lookahead
+        self.logger = logger
+        self.download_kwargs = download_kwargs
+        self.budget = budget or Budget()
+        self.cond = self.budget.cond
+        self.to_snapshot = []
+        self.pending = []
+        self.results = []
+        self.snapshotting = False
+        self.snapshot_backup = None
+        self.live_snapshots = 0
+        self.stopping = False
+
+    def run(self, jobs):
+        '''
+        :param jobs: list of dicts
+            Each dict must contain `opaque_ref`, `vm_info`, `host` and `srs`,
+            see `XenBackup.get_jobs()`.
+        :returns: list of result dicts, one per VM
+        '''
+        self.results = []
+        self.stopping = False
+        self.live_snapshots = 0
+        if self.lookahead:
+            self.to_snapshot = list(jobs)
+            self.pending = []
+            self.snapshotting = True
+        else:
+            self.to_snapshot = []
+            self.pending = list(jobs)
+            self.snapshotting = False
+        snapshot_thread = None
+        if self.snapshotting:
+            snapshot_thread = self._start(self._snapshotter, 'xenbackup-snapshot')
+        threads = []
+        for i in range(min(self.workers, len(jobs))):
+            threads.append(self._start(self._worker, 'xenbackup-worker-{}'.format(i)))
+        try:
+            for t in threads:
+                self._join(t)
+        finally:
+            with self.cond:
+                self.stopping = True
+                self.cond.notify_all()
+            if snapshot_thread:
+                self._join(snapshot_thread)
+            self._abandon()
+        return self.results
+
+    def _start(self, target, name):
+        t = threading.Thread(target=target, name=name)
+        t.daemon = True
+        t.start()
+        return t
+
+    def _join(self, t):
+        # join with a timeout so KeyboardInterrupt still reaches the main thread
+        while t.is_alive():
+            t.join(1)
+
+    def _keys(self, job):
+        keys = [('sr', sr) for sr in job['srs']]
+        if job['host']:
+            keys.append(('host', job['host']))
+        return keys
+
+    def _result(self, job, error=None):
+        return {
+            'vm_name': job['vm_info']['name_label'],
+            'vm_uuid': job['vm_info']['uuid'],
+            'host': job['host'],
+            'srs': job['srs'],
+            'status': 'failed',
+            'error': error,
+            'started': time.time(),
+            'duration': 0,
+        }
+
+    def _snapshotter(self):
+        '''
+        Snapshot stage. Creates snapshots in job order and hands them to
+        the export workers, never letting more than `max_live_snapshots`
+        exist at the same time.
+        '''
+        try:
+            self.snapshot_backup = self.backup_factory()
+        except Exception:
+            self.logger.exception('Snapshot stage failed to log in')
+            with self.cond:
+                self.snapshotting = False
+                self.cond.notify_all()
+            return
+        while True:
+            with self.cond:
+                while self.live_snapshots >= self.max_live_snapshots and not self.stopping:
+                    self.cond.wait()
+                if self.stopping or not self.to_snapshot:
+                    self.snapshotting = False
+                    self.cond.notify_all()
+                    return
+                job = self.to_snapshot.pop(0)
+                self.live_snapshots += 1
+            snapshot = None
+            try:
+                snapshot = self.snapshot_backup.create_snapshot(
+                    job['opaque_ref'],
+                    job['vm_info'],
+                    self.download_kwargs.get('retry_max', 3),
+                    self.download_kwargs.get('retry_delay', 30),
+                )
+            except Exception:
+                self.logger.exception('Unexpected error creating snapshot of {}'.format(
+                    job['vm_info']['name_label'],
+                ))
+            with self.cond:
+                if snapshot:
+                    job['snapshot'] = snapshot
+                    self.pending.append(job)
+                else:
+                    self.live_snapshots -= 1
+                    self.results.append(self._result(job, 'snapshot failed'))
+                self.cond.notify_all()
+
+    def _abandon(self):
+        '''
+        Deletes the snapshots of jobs that were never exported, e.g. because
+        all workers failed to log in or the run was interrupted.
+        '''
+        for job in self.pending:
+            error = 'not started'
+            if job.get('snapshot'):
+                error = 'not exported'
+                if self.snapshot_backup:
+                    self.snapshot_backup.delete_snapshot(job['snapshot'], job['vm_info'])
+            self.results.append(self._result(job, error))
+        for job in self.to_snapshot:
+            self.results.append(self._result(job, 'not started'))
+        self.pending = []
+        self.to_snapshot = []
+        if self.snapshot_backup:
+            self.snapshot_backup.logout()
+            self.snapshot_backup = None
+
+    def _next_job(self):
+        '''
+        Returns the first pending job that is allowed to run, blocking
+        until one is available. Returns None when there is no more work.
+        '''
+        with self.cond:
+            while (self.pending or self.snapshotting) and not self.stopping:
+                for job in self.pending:
+                    keys = self._keys(job)
+                    if self.limiter.can_acquire(keys) and self.budget.limiter.can_acquire(self.budget.keys):
+                        self.limiter.acquire(keys)
+                        self.budget.limiter.acquire(self.budget.keys)
+                        self.pending.remove(job)
+                        return job
+                self.cond.wait()
+            return None
+
+    def _release_snapshot(self):
+        with self.cond:
+            self.live_snapshots -= 1
+            self.cond.notify_all()
+
+    def _finish_job(self, job, result):
+        with self.cond:
+            self.limiter.release(self._keys(job))
+            self.budget.limiter.release(self.budget.keys)
+            self.results.append(result)
+            self.cond.notify_all()
+
+    def _worker(self):
+        try:
+            backup = self.backup_factory()
+        except Exception:
+            self.logger.exception('Worker failed to log in')
+            return
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            result = self._result(job)
+            released = None
+            if job.get('snapshot'):
+                # the snapshot counts as live until it is deleted
+                released = SnapshotRelease(self._release_snapshot)
+            try:
+                if job.get('snapshot'):
+                    status = backup.export_snapshot(
+                        snapshot_opaque_ref=job['snapshot'],
+                        opaque_ref=job['opaque_ref'],
+                        vm_info=job['vm_info'],
+                        released=released,
+                        **self.download_kwargs
+                    )
+                else:
+                    status = backup.download_vm(
+                        opaque_ref=job['opaque_ref'],
+                        vm_info=job['vm_info'],
+                        **self.download_kwargs
+                    )
+                if status:
+                    result['status'] = 'success'
+                elif status is None:
+                    result['error'] = 'snapshot failed'
+                else:
+                    result['error'] = 'download failed'
+            except Exception as e:
+                result['error'] = str(e)
+                self.logger.error('Unexpected error backing up {}'.format(
+                    job['vm_info']['name_label'],
+                ), extra={
+                    'error': traceback.format_exc(),
+                    'vm_name': job['vm_info']['name_label'],
+                })
+                if released and not released.deferred:
+                    # the export failed before it could delete the snapshot
+                    try:
+                        backup.delete_snapshot(job['snapshot'], job['vm_info'])
+                    except Exception:
+                        self.logger.exception('Error deleting the snapshot of {}'.format(
+                            job['vm_info']['name_label'],
+                        ))
+            result['duration'] = time.time() - result['started']
+            if released and not released.deferred:
+                released()
+            self._finish_job(job, result)
+        backup.logout()
+
+
+def summarize(results, logger, server=None):
+    '''
+    Logs one line per failed VM and a final summary line.
+
+    :param results: list of result dicts from `BackupScheduler.run`
+    :returns: int
+        Number of failed VMs
+    '''
+    failed = [r for r in results if r['status'] != 'success']
+    for r in failed:
+        logger.error('Backup of {} failed: {}'.format(
+            r['vm_name'],
+            r['error'],
+        ), extra={
+            'host': server,
+            'vm_name': r['vm_name'],
+            'vm_uuid': r['vm_uuid'],
+        })
+    logger.info('Backup finished: {} succeeded, {} failed, {:.0f} seconds spent in exports'.format(
+        len(results) - len(failed),
+        len(failed),
+        sum(r['duration'] for r in results),
+    ), extra={
+        'host': server,
+        'succeeded': len(results) - len(failed),
+        'failed': len(failed),
+    })
+    return len(failed)
@@ -0,0 +1,57 @@
+import contextlib
+import json
+import os
+import threading
+
+
+class BackupState(object):
+    '''
+    Small JSON database with information about previous runs, stored in
+    the root of the backup directory and keyed by VM uuid.
+
+    Safe to share between the workers of a run.
+    '''
+
+    filename = 'xenbackup-state.json'
+
+    def __init__(self, path):
+        '''
+        :param path: str
+            backup directory
+        '''
+        self.path = os.path.join(path, self.filename)
+        self.lock = threading.Lock()
+        self.data = {'vms': {}}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.data = json.load(f)
+            self.data.setdefault('vms', {})
+
+    def get_vm(self, vm_uuid):
+        '''
+        :returns: dict
+            A copy of the stored information about the VM
+        '''
+        with self.lock:
+            return json.loads(json.dumps(self.data['vms'].get(vm_uuid, {})))
+
+    @contextlib.contextmanager
+    def vm(self, vm_uuid):
+        '''
+        Locks the state and yields the VM's dict for modification.
+        The state is saved when the block exits.
+
+        Example:
+
+            with state.vm(vm_uuid) as vm:
+                vm['last_backup'] = time.time()
+        '''
+        with self.lock:
+            yield self.data['vms'].setdefault(vm_uuid, {})
+            self._save()
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
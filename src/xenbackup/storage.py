@@ -0,0 +1,619 @@
+import Queue
+import calendar
+import errno
+import glob
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+
+from archive_rotator import rotator
+from archive_rotator.algorithms import SimpleRotator
+
+import transfer
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+S3_DELETE_BATCH = 1000
+DELETE_PARALLEL = 8
+# <prefix>/<vm name>/<name>.<upload time><ext>
+S3_KEY = re.compile(r'^(?P<name>.*)\.(?P<time>\d{4}-\d{2}-\d{2}-\d{6})(?P<ext>\..*)$')
+S3_TIME_FORMAT = '%Y-%m-%d-%H%M%S'
+# limits of multipart uploads, parts double in size every S3_PART_GROWTH parts
+S3_MAX_PARTS = 10000
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PART_SIZE = 5 * 1024 ** 3
+S3_MAX_OBJECT_SIZE = 5 * 1024 ** 4
+S3_PART_GROWTH = 1000
+
+
+def open_storage(path, **s3_options):
+    '''
+    :param path: str
+        a local directory or s3://bucket/prefix
+    :param s3_options:
+        passed on to `S3Storage`
+    :returns: `LocalStorage` or `S3Storage`
+    '''
+    if path.startswith('s3://'):
+        bucket, _, prefix = path[len('s3://'):].partition('/')
+        return S3Storage(bucket, prefix, **s3_options)
+    return LocalStorage(path)
+
+
+def max_object_size(part_size):
+    '''
+    :param part_size: int
+        first part size of a multipart upload in bytes
+    :returns: int
+        largest object a `MultipartWriter` starting with `part_size` can
+        upload without knowing its size in advance
+    '''
+    size = 0
+    for i in range(S3_MAX_PARTS // S3_PART_GROWTH):
+        size += S3_PART_GROWTH * part_size
+        part_size = min(part_size * 2, S3_MAX_PART_SIZE)
+    return min(size, S3_MAX_OBJECT_SIZE)
+
+
+class LocalStorage(object):
+    '''
+    Stores the backups as files below a directory. Downloads are
+    resumable, see `transfer.PartialDownload`, and rotated with
+    archive_rotator.
+    '''
+
+    remote = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def folder(self, name):
+        '''
+        :returns: str
+            location of a VM's folder, created if missing
+        '''
+        path = os.path.abspath(os.path.join(self.root, name))
+        if not os.path.exists(path):
+            os.mkdir(path)
+        return path
+
+    def join(self, folder, name):
+        return os.path.join(folder, name)
+
+    def upload(self, location, url, size=None):
+        '''
+        :param location: str
+            where to store the export, without extension
+        :param url: str
+            the export url
+        :param size: int
+            expected size of the export, not needed by files
+        :returns: `transfer.PartialDownload`
+        '''
+        return transfer.PartialDownload(location, url)
+
+    def size(self, location):
+        return os.path.getsize(location)
+
+    def destination(self, location):
+        '''
+        :returns: hashable
+            identifies the device written to, for throttling
+        '''
+        return os.stat(location).st_dev
+
+    def put(self, location, data):
+        tmp = location + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, location)
+
+    def read(self, location):
+        with open(location, 'rb') as f:
+            return f.read()
+
+    def open(self, location):
+        return open(location, 'rb')
+
+    def find(self, suffix):
+        '''
+        :returns: list
+            the files in the VM folders ending with `suffix`
+        '''
+        return [p for p in glob.glob(os.path.join(self.root, '*', '*' + suffix)) if os.path.isfile(p)]
+
+    def vm_name(self, location):
+        return os.path.basename(os.path.dirname(location))
+
+    def backups(self, name, pattern):
+        '''
+        :param name: str
+            the VM's folder
+        :param pattern: compiled regular expression
+            matching the names of the archives
+        :returns: list
+            the archives in the VM's folder, oldest first
+        '''
+        paths = glob.glob(os.path.join(self.root, name, '*'))
+        return sorted((p for p in paths if pattern.search(p) and os.path.isfile(p)), key=os.path.getmtime)
+
+    def rotate(self, location, keep, expiring=None, sidecars=()):
+        '''
+        Rotates the backups of `location` with archive_rotator.
+
+        :param expiring: callable
+            called with the paths the rotation is about to delete,
+            its return value is returned
+        :param sidecars: list
+            suffixes of files belonging to `location`, e.g. its integrity
+            manifest, renamed along with it and deleted with its rotated
+            versions
+        '''
+        ext = location[location.rindex('.xva'):]
+        path = location[:-len(ext)]
+        algorithm = SimpleRotator(keep, False)
+        rotated = self._rotated(path)
+        result = None
+        if expiring:
+            result = expiring(self._expiring(algorithm, rotated))
+        rotator.rotate(
+            algorithm,
+            path=location,
+            ext=ext,
+        )
+        rotation_id = max([r[1] for r in rotated] or [-1]) + 1
+        moved = glob.glob('{}.*.backup-{}{}'.format(path, rotation_id, ext))
+        for suffix in sidecars:
+            if moved and os.path.exists(location + suffix):
+                os.rename(location + suffix, moved[0] + suffix)
+        return result
+
+    def _rotated(self, path):
+        '''
+        :returns: list
+            (path, rotation id) of the rotated files of `path`, sidecars
+            included
+        '''
+        rotated = []
+        for rotated_path in glob.glob(path + rotator.FILE_NAME_GLOB):
+            match = re.search(rotator.FILE_NAME_REGEX, rotated_path)
+            if match:
+                rotated.append((rotated_path, int(match.group('rotation_id'))))
+        return rotated
+
+    def _expiring(self, algorithm, rotated):
+        '''
+        :returns: list
+            the rotated files the next rotation is going to delete
+        '''
+        if not rotated:
+            return []
+        slot = algorithm.id_to_slot(max(r[1] for r in rotated) + 1)
+        return [p for p, rotation_id in rotated if algorithm.id_to_slot(rotation_id) == slot]
+
+    def archive(self, location, rotation_id, sidecars=()):
+        '''
+        Gives a new archive the name archive_rotator would give it,
+        `<name>.<time>.backup-<rotation_id><ext>`, without reading the
+        folder. Used instead of `rotate()` with a `catalog.BackupCatalog`.
+
+        :param sidecars: list
+            suffixes of files belonging to `location`, renamed along with it
+        :returns: str
+            the new location
+        '''
+        ext = location[location.rindex('.xva'):]
+        archived = location[:-len(ext)] + rotator.FILE_NAME_TMPL % {
+            'datetime_str': datetime.now().strftime(rotator.DATETIME_FORMAT),
+            'rotation_id': rotation_id,
+            'ext': ext,
+        }
+        os.rename(location, archived)
+        for suffix in sidecars:
+            if os.path.exists(location + suffix):
+                os.rename(location + suffix, archived + suffix)
+        return archived
+
+    def rotated(self, location, sidecars=()):
+        '''
+        :returns: list
+            (location, modification time, rotation id) of the rotated
+            archives of `location`, whatever their extension
+        '''
+        ext = location[location.rindex('.xva'):]
+        archives = []
+        for path, rotation_id in self._rotated(location[:-len(ext)]):
+            if any(path.endswith(suffix) for suffix in sidecars) or not os.path.isfile(path):
+                continue
+            archives.append((path, os.path.getmtime(path), rotation_id))
+        return archives
+
+    def delete(self, locations, parallel=DELETE_PARALLEL):
+        '''
+        Deletes files, `parallel` at a time. Missing files are ignored.
+        '''
+        def remove(location):
+            try:
+                os.remove(location)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        run_parallel(remove, locations, parallel)
+
+
+class S3Storage(object):
+    '''
+    Streams the backups into an S3 compatible object store, as
+    `<prefix>/<vm name>/<name>.<timestamp><ext>` objects.
+
+    Exports are uploaded with parallel multipart uploads while they are
+    downloaded, see `MultipartWriter`. Interrupted uploads can not be
+    resumed. Rotation deletes all but the newest objects of a VM.
+    Needs boto3 (pip install xenbackup[s3]), the credentials are looked
+    up the usual boto3 way.
+    '''
+
+    remote = True
+
+    def __init__(self, bucket, prefix='', endpoint_url=None,
+                 part_size=64 * 1024 * 1024, concurrency=4, client=None):
+        '''
+        :param endpoint_url: str
+            for S3 compatible stores other than AWS, e.g. MinIO
+        :param part_size: int
+            size of the multipart upload parts in bytes
+        :param concurrency: int
+            parts uploaded at the same time per export
+        '''
+        if client is None:
+            if boto3 is None:
+                raise Exception('S3 storage needs boto3, pip install xenbackup[s3]')
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.endpoint_url = endpoint_url
+        self.part_size = part_size
+        self.concurrency = concurrency
+
+    def folder(self, name):
+        return '/'.join(p for p in (self.prefix, name) if p)
+
+    def join(self, folder, name):
+        return '{}/{}'.format(folder, name)
+
+    def upload(self, location, url, size=None):
+        '''
+        :param size: int
+            expected size of the export in bytes, raises the part size
+            of exports that would not fit in `S3_MAX_PARTS` parts
+        :returns: `S3Upload`
+        '''
+        return S3Upload(self, '{}.{}'.format(
+            location,
+            datetime.utcnow().strftime(S3_TIME_FORMAT),
+        ), size)
+
+    def size(self, location):
+        return self.client.head_object(Bucket=self.bucket, Key=location)['ContentLength']
+
+    def put(self, location, data):
+        self.client.put_object(Bucket=self.bucket, Key=location, Body=data)
+
+    def read(self, location):
+        return self.open(location).read()
+
+    def open(self, location):
+        '''
+        :returns: file like object streaming the object
+        '''
+        return self.client.get_object(Bucket=self.bucket, Key=location)['Body']
+
+    def find(self, suffix):
+        prefix = self.prefix + '/' if self.prefix else ''
+        return [k for k in self.list(prefix) if k.endswith(suffix)]
+
+    def vm_name(self, location):
+        return location.split('/')[-2]
+
+    def backups(self, name, pattern):
+        # the keys end with their upload time, sorting them sorts by age
+        return sorted(k for k in self.list(self.folder(name) + '/') if pattern.search(k))
+
+    def destination(self, location):
+        return (self.endpoint_url, self.bucket)
+
+    def list(self, prefix):
+        '''
+        :returns: list
+            keys starting with `prefix`
+        '''
+        keys = []
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix}
+        while True:
+            result = self.client.list_objects_v2(**kwargs)
+            keys.extend(o['Key'] for o in result.get('Contents', []))
+            if not result.get('IsTruncated'):
+                return keys
+            kwargs['ContinuationToken'] = result['NextContinuationToken']
+
+    def delete(self, keys, parallel=DELETE_PARALLEL):
+        '''
+        Deletes objects in batches of `S3_DELETE_BATCH`, `parallel`
+        batches at a time.
+        '''
+        def delete_batch(batch):
+            result = self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in batch],
+                'Quiet': True,
+            })
+            if result.get('Errors'):
+                raise Exception('Failed to delete {} objects from {}: {}'.format(
+                    len(result['Errors']),
+                    self.bucket,
+                    result['Errors'][0].get('Message'),
+                ))
+        run_parallel(delete_batch, [keys[i:i + S3_DELETE_BATCH] for i in range(0, len(keys), S3_DELETE_BATCH)], parallel)
+
+    def archive(self, location, rotation_id, sidecars=()):
+        # the keys are unique already
+        return location
+
+    def rotated(self, location, sidecars=()):
+        '''
+        :returns: list
+            (key, upload time, None) of the objects of `location`'s VM,
+            whatever their extension
+        '''
+        match = S3_KEY.match(location)
+        if not match:
+            raise Exception('{} is not a rotated backup'.format(location))
+        archives = []
+        for key in self.list(match.group('name') + '.'):
+            key_match = S3_KEY.match(key)
+            if not key_match or key_match.group('name') != match.group('name'):
+                continue
+            if any(key.endswith(suffix) for suffix in sidecars):
+                continue
+            archives.append((key, calendar.timegm(time.strptime(key_match.group('time'), S3_TIME_FORMAT)), None))
+        return archives
+
+    def rotate(self, location, keep, expiring=None, sidecars=()):
+        '''
+        Deletes all but the newest `keep` objects of `location`'s VM
+        with the same extension, and their sidecar objects.
+        '''
+        match = S3_KEY.match(location)
+        if not match:
+            raise Exception('{} is not a rotated backup'.format(location))
+        pattern = re.compile(r'^{}\.\d{{4}}-\d{{2}}-\d{{2}}-\d{{6}}{}$'.format(
+            re.escape(match.group('name')),
+            re.escape(match.group('ext')),
+        ))
+        keys = sorted(k for k in self.list(match.group('name') + '.') if pattern.match(k))
+        expired = keys[:-keep] if keep else []
+        result = None
+        if expiring:
+            result = expiring(expired)
+        self.delete(expired + [key + suffix for key in expired for suffix in sidecars])
+        return result
+
+
+def run_parallel(function, items, parallel, name='xenbackup-delete'):
+    '''
+    Calls `function` with every item, in `parallel` threads.
+
+    :param name: str
+        prefix of the names of the threads
+    :raises: the first exception raised by `function`, after all items
+        were tried
+    '''
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+    errors = []
+
+    def work():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                function(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = []
+    for i in range(min(max(1, parallel), queue.qsize())):
+        t = threading.Thread(target=work, name='{}-{}'.format(name, i))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        # join with a timeout so KeyboardInterrupt still reaches the main thread
+        while t.is_alive():
+            t.join(1)
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+class S3Upload(object):
+    '''
+    Counterpart of `transfer.PartialDownload` for `S3Storage`, the
+    object only appears once the multipart upload is completed.
+    '''
+
+    resume_offset = 0
+
+    def __init__(self, storage, key, size=None):
+        self.storage = storage
+        self.key = key
+        self.size = size
+        self.info = {}
+
+    def start(self, mode, ext, offset=0):
+        self.info = {
+            'mode': mode,
+            'ext': ext,
+        }
+
+    def writer(self, **kwargs):
+        return MultipartWriter(
+            self.storage.client,
+            self.storage.bucket,
+            self.key + self.info['ext'],
+            part_size=self.storage.part_size,
+            concurrency=self.storage.concurrency,
+            expected_size=self.size,
+        )
+
+    def finish(self):
+        return self.key + self.info['ext']
+
+    def discard(self):
+        pass
+
+
+class MultipartWriter(object):
+    '''
+    File like object uploading everything written to it as an S3 object,
+    in parts of `part_size` uploaded by `concurrency` threads.
+
+    At most `2 * concurrency + 1` parts are held in memory: the one being
+    filled, the queued ones and the ones being uploaded. Writes block
+    while the queue is full. Objects smaller than a part are uploaded
+    with a single PUT when closed.
+
+    An upload has at most `S3_MAX_PARTS` parts. The first part is made
+    large enough for `expected_size` to fit in all but the last
+    `S3_PART_GROWTH` of them, and the parts double in size every
+    `S3_PART_GROWTH` parts once the object outgrows the expected size,
+    from the first part when it is unknown, see `max_object_size()`.
+    '''
+
+    def __init__(self, client, bucket, key, part_size=64 * 1024 * 1024, concurrency=4, expected_size=None):
+        '''
+        :param expected_size: int
+            expected size of the object in bytes, None if unknown
+        '''
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.planned_parts = 0
+        if expected_size:
+            needed = -(-expected_size // (S3_MAX_PARTS - S3_PART_GROWTH))
+            # whole MiB
+            needed = -(-needed // (1024 * 1024)) * 1024 * 1024
+            self.part_size = min(max(part_size, needed), S3_MAX_PART_SIZE)
+            self.planned_parts = -(-expected_size // self.part_size)
+        self.concurrency = concurrency
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = 0
+        self.etags = {}
+        self.error = None
+        self.queue = Queue.Queue(concurrency)
+        self.threads = []
+
+    def _upload(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            number, data = item
+            if self.error:
+                continue
+            try:
+                result = self.client.upload_part(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    PartNumber=number,
+                    Body=data,
+                )
+                self.etags[number] = result['ETag']
+            except Exception as e:
+                # keep taking parts so the writer does not block, it
+                # raises the error on its next write
+                self.error = e
+
+    def _submit(self, data):
+        if self.error:
+            raise self.error
+        if self.parts >= S3_MAX_PARTS:
+            raise Exception('{} does not fit in the {} parts of a multipart upload'.format(self.key, S3_MAX_PARTS))
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+            )['UploadId']
+            for i in range(self.concurrency):
+                t = threading.Thread(target=self._upload, name='xenbackup-upload-{}'.format(i))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+        self.parts += 1
+        self.queue.put((self.parts, data))
+        grown = self.parts - self.planned_parts
+        if grown > 0 and grown % S3_PART_GROWTH == 0:
+            self.part_size = min(self.part_size * 2, S3_MAX_PART_SIZE)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            # the part size grows while submitting
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:len(part)]
+            self._submit(part)
+
+    def _stop(self):
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def close(self):
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            self.buffer = bytearray()
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            self._stop()
+            if self.error:
+                raise self.error
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': [
+                    {'ETag': self.etags[n], 'PartNumber': n}
+                    for n in range(1, self.parts + 1)
+                ]},
+            )
+        except Exception:
+            self.abort()
+            raise
+        self.upload_id = None
+
+    def abort(self):
+        self.buffer = bytearray()
+        self._stop()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+            )
+            self.upload_id = None
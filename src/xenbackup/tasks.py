@@ -0,0 +1,262 @@
+import random
+import re
+import threading
+import time
+import xmlrpclib
+
+import XenAPI
+
+# statuses of a task that is done
+FINISHED = ('success', 'failure', 'cancelled')
+# error of a task whose record disappeared before it was seen finished
+TASK_LOST = 'TASK_LOST'
+# threads running background() at the same time
+MAX_BACKGROUND = 8
+
+
+def backoff(delay, attempt, cap=None):
+    '''
+    Exponential backoff with jitter: the delay doubles with every attempt,
+    up to `cap`, and a random half of it is taken off, so the workers that
+    failed together do not all retry at the same moment.
+
+    :param delay: float
+        delay before the first retry
+    :param attempt: int
+        number of the retry, from 1
+    :param cap: float
+        largest delay, 16 times `delay` if None
+    :returns: float
+        seconds to wait
+    '''
+    if cap is None:
+        cap = delay * 16
+    delay = min(cap, delay * 2 ** max(0, attempt - 1))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def task_result(result):
+    '''
+    :param result: str
+        result of an Async call, the return value encoded as XML-RPC
+    :returns:
+        the decoded value, the string itself if it is not encoded
+    '''
+    if not result or not result.lstrip().startswith('<value'):
+        return result
+    try:
+        return xmlrpclib.loads('<methodResponse><params><param>{}</param></params></methodResponse>'.format(
+            result,
+        ))[0][0]
+    except Exception:
+        # XAPI leaves the type out of references, e.g. <value>OpaqueRef:...</value>
+        match = re.search(r'<value>([^<]*)</value>', result)
+        return match.group(1) if match else result
+
+
+class TaskWatcher(object):
+    '''
+    Runs XenAPI calls as Async tasks and follows all of them with a single
+    `event.from` loop, instead of every caller polling its own task.
+
+    The loop runs in a thread of its own while someone waits for a task.
+    Hosts without event.from on tasks get the pending tasks polled. The
+    tasks are created with the session passed in, which has to outlive
+    them; calls in `background()` threads are waited for by `drain()`.
+
+    Safe to share between threads.
+    '''
+
+    def __init__(self, session, logger=None, timeout=5.0, poll_interval=1.0,
+                 max_background=MAX_BACKGROUND):
+        '''
+        :param session: XenAPI.Session
+        :param timeout: float
+            seconds an event.from call waits for events
+        :param poll_interval: float
+            seconds between polls on hosts without event.from
+        :param max_background: int
+            threads running background() at the same time, further calls
+            wait for one of them to finish
+        '''
+        self.session = session
+        self.logger = logger
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.cond = threading.Condition()
+        self.tasks = {}
+        self.waiting = {}
+        self.token = ''
+        self.polling = False
+        self.thread = None
+        self.threads = []
+        self.slots = threading.BoundedSemaphore(max_background)
+
+    def _events(self, token):
+        # `from` is a keyword, the method can only be reached with getattr
+        return getattr(self.session.xenapi.event, 'from')(['task'], token, self.timeout)
+
+    def _apply(self, result):
+        with self.cond:
+            for event in result['events']:
+                if event['class'].lower() != 'task':
+                    continue
+                if event['operation'] == 'del':
+                    self.tasks.pop(event['ref'], None)
+                elif 'snapshot' in event:
+                    self.tasks[event['ref']] = event['snapshot']
+            self.token = result['token']
+            self.cond.notify_all()
+
+    def _poll(self):
+        '''
+        Gets the records of the pending tasks. A task whose record is gone
+        fails with TASK_LOST, its call may or may not have been done.
+        Other errors, e.g. of the session, fail the tasks with the error.
+        '''
+        with self.cond:
+            pending = list(self.waiting)
+        records = {}
+        for task in pending:
+            try:
+                records[task] = self.session.xenapi.task.get_record(task)
+            except XenAPI.Failure as e:
+                if e.details[:2] == ['HANDLE_INVALID', 'task']:
+                    records[task] = {'status': 'failure', 'error_info': [TASK_LOST, task]}
+                else:
+                    if self.logger:
+                        self.logger.warning('Error polling task {}: {}'.format(task, e))
+                    records[task] = {'status': 'failure', 'error_info': e.details}
+        with self.cond:
+            self.tasks.update(records)
+            self.cond.notify_all()
+        time.sleep(self.poll_interval)
+
+    def _watch(self):
+        while True:
+            with self.cond:
+                if not self.waiting:
+                    self.thread = None
+                    return
+                token = self.token
+            try:
+                if self.polling:
+                    self._poll()
+                else:
+                    self._apply(self._events(token))
+            except XenAPI.Failure as e:
+                if e.details and e.details[0] == 'EVENTS_LOST':
+                    # too far behind, start over with the current records
+                    with self.cond:
+                        self.token = ''
+                    continue
+                if self.logger:
+                    self.logger.warning('Following the tasks with event.from failed, polling them instead: {}'.format(e))
+                self.polling = True
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Error following the tasks')
+                time.sleep(self.poll_interval)
+
+    def submit(self, method, *args):
+        '''
+        :param method: str
+            XenAPI method, e.g. VM.snapshot
+        :returns: str
+            OpaqueRef of the task running the method
+        '''
+        call = self.session.xenapi.Async
+        for name in method.split('.'):
+            call = getattr(call, name)
+        return call(*args)
+
+    def wait(self, task, progress=None):
+        '''
+        Waits for a task to finish and destroys it.
+
+        :param progress: callable
+            called with the task's progress, 0.0 to 1.0, whenever it changes
+        :returns:
+            the result of the task
+        :raises: XenAPI.Failure with the task's error if it failed
+        '''
+        last = None
+        with self.cond:
+            self.waiting[task] = self.waiting.get(task, 0) + 1
+            try:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._watch, name='xenbackup-tasks')
+                    self.thread.daemon = True
+                    self.thread.start()
+                while True:
+                    record = self.tasks.get(task)
+                    if record is not None:
+                        if progress and record.get('progress') != last:
+                            last = record.get('progress')
+                            progress(float(last or 0))
+                        if record['status'] in FINISHED:
+                            break
+                    # a timeout so KeyboardInterrupt still reaches the main thread
+                    self.cond.wait(1)
+            finally:
+                self.waiting[task] -= 1
+                if not self.waiting[task]:
+                    del self.waiting[task]
+            self.tasks.pop(task, None)
+        try:
+            self.session.xenapi.task.destroy(task)
+        except Exception:
+            pass
+        if record['status'] != 'success':
+            raise XenAPI.Failure(record.get('error_info') or ['TASK_CANCELLED', task])
+        return task_result(record.get('result'))
+
+    def call(self, method, *args, **kwargs):
+        '''
+        Runs a XenAPI method as a task and waits for it.
+
+        :param progress: callable
+            see wait()
+        :returns:
+            the result of the method
+        '''
+        return self.wait(self.submit(method, *args), progress=kwargs.get('progress'))
+
+    def background(self, target, name='xenbackup-background'):
+        '''
+        Runs `target` in a thread that `drain()` waits for, for slow
+        storage operations whose result nobody waits for, such as
+        deleting snapshots. Blocks while `max_background` threads are
+        running.
+        '''
+        def run():
+            try:
+                target()
+            finally:
+                self.slots.release()
+
+        # a timeout so KeyboardInterrupt still reaches the main thread
+        while not self.slots.acquire(False):
+            time.sleep(0.1)
+        t = threading.Thread(target=run, name=name)
+        t.daemon = True
+        with self.cond:
+            self.threads = [other for other in self.threads if other.is_alive()]
+            self.threads.append(t)
+        t.start()
+        return t
+
+    def drain(self):
+        '''
+        Waits for the threads started with background().
+        '''
+        while True:
+            with self.cond:
+                threads = [t for t in self.threads if t.is_alive()]
+                self.threads = threads
+            if not threads:
+                return
+            for t in threads:
+                # join with a timeout so KeyboardInterrupt still reaches the main thread
+                while t.is_alive():
+                    t.join(1)
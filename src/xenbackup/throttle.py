@@ -0,0 +1,319 @@
+import threading
+import time
+
+MB = 1024 * 1024
+
+
+class Schedule(object):
+    '''
+    Time of day windows scaling the bandwidth limits, written as
+    `HH:MM-HH:MM=FACTOR` separated by commas, e.g.
+
+        08:00-18:00=0.2,22:00-06:00=2
+
+    Windows may cross midnight, the first matching window wins and the
+    factor is 1 outside of all windows. A factor of 0 pauses the
+    downloads until the window ends.
+    '''
+
+    def __init__(self, spec):
+        self.windows = []
+        for part in spec.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                times, factor = part.split('=')
+                start, end = times.split('-')
+                self.windows.append((self._minutes(start), self._minutes(end), float(factor)))
+            except ValueError:
+                raise Exception('Invalid bandwidth schedule window: {}'.format(part))
+
+    def _minutes(self, value):
+        hours, minutes = value.strip().split(':')
+        return int(hours) * 60 + int(minutes)
+
+    def _window(self, now):
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for start, end, factor in self.windows:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                inside = minute >= start or minute < end
+            if inside:
+                return start, end, factor, minute
+        return None
+
+    def factor(self, now=None):
+        window = self._window(now or time.time())
+        return window[2] if window else 1.0
+
+    def seconds_left(self, now=None):
+        '''
+        :returns: int
+            seconds until the current window ends
+        '''
+        now = now or time.time()
+        window = self._window(now)
+        if not window:
+            return 0
+        start, end, factor, minute = window
+        return ((end - minute) % (24 * 60)) * 60 - time.localtime(now).tm_sec
+
+
+class Throttle(object):
+    '''
+    Token bucket limiting the combined rate of all downloads sharing it.
+
+    Downloads take the tokens for what they received and sleep off any
+    debt, so threads sharing a throttle get the rate between them.
+
+    With `adaptive` the throttle follows the time it takes to read (or
+    write) a MiB. When that gets more than twice as slow as the best seen
+    so far, the storage is struggling and the rate is cut by a quarter,
+    at most once per second. It recovers by 5% per second once the
+    latency is back near its best. Without a configured rate the rate
+    that is cut is the combined throughput of all downloads sharing the
+    throttle, as measured when it started backing off. Latencies below
+    5 ms per MiB (200 MiB/s) never count as degraded.
+    '''
+
+    min_backoff = 0.25
+    min_latency = 0.005
+    # seconds over which the combined throughput is measured, longer gaps are idle
+    throughput_window = 1.0
+    idle_window = 5.0
+
+    def __init__(self, rate=0, burst=None, schedule=None, adaptive=False, name=None, logger=None):
+        '''
+        :param rate: int
+            bytes per second, 0 or None for unlimited
+        :param burst: int
+            bytes that can be received at full speed after an idle
+            period, one second worth by default
+        :param schedule: `Schedule`
+        :param adaptive: boolean
+            back off when the observed latency degrades
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.schedule = schedule
+        self.adaptive = adaptive
+        self.name = name
+        self.logger = logger
+        self.tokens = None
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self.latency = None
+        self.best_latency = None
+        self.backoff = 1.0
+        self.adjusted = 0
+        self.window_start = None
+        self.window_bytes = 0
+        self.throughput = None
+        self.backoff_base = None
+
+    def current_rate(self, now=None):
+        '''
+        :returns: float
+            bytes per second, 0 for unlimited
+        '''
+        rate = self.rate or 0
+        if self.schedule and rate:
+            rate *= self.schedule.factor(now)
+        if self.backoff < 1:
+            if not rate and self.backoff_base:
+                rate = self.backoff_base
+            rate *= self.backoff
+        return rate
+
+    def _measure(self, n, now):
+        # combined throughput of everyone taking tokens, the fallback rate of the backoff
+        if self.window_start is None or now - self.window_start > self.idle_window:
+            self.window_start = now
+            self.window_bytes = 0
+        self.window_bytes += n
+        elapsed = now - self.window_start
+        if elapsed < self.throughput_window:
+            return
+        sample = self.window_bytes / elapsed
+        if self.throughput is None:
+            self.throughput = sample
+        else:
+            self.throughput = 0.8 * self.throughput + 0.2 * sample
+        self.window_start = now
+        self.window_bytes = 0
+
+    def _paused(self, now):
+        return self.schedule is not None and self.schedule.factor(now) == 0
+
+    def reserve(self, n):
+        '''
+        Takes `n` bytes worth of tokens, blocking while a schedule
+        pauses downloads.
+
+        :returns: float
+            seconds the caller has to wait before going on
+        '''
+        while True:
+            now = time.time()
+            if not self._paused(now):
+                break
+            time.sleep(max(1, min(60, self.schedule.seconds_left(now))))
+        with self.lock:
+            if self.adaptive:
+                self._measure(n, now)
+            rate = self.current_rate(now)
+            if not rate:
+                self.tokens = None
+                return 0
+            burst = self.burst or rate
+            if self.tokens is None:
+                self.tokens = burst
+            else:
+                self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= n
+            return -self.tokens / float(rate) if self.tokens < 0 else 0
+
+    def consume(self, n):
+        wait = self.reserve(n)
+        if wait:
+            time.sleep(wait)
+
+    def observe(self, n, seconds):
+        '''
+        Records that `n` bytes took `seconds` to read or write, not
+        counting the time spent throttled.
+        '''
+        if not self.adaptive or n < MB or seconds <= 0:
+            return
+        with self.lock:
+            latency = seconds * MB / n
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            if self.best_latency is None or self.latency < self.best_latency:
+                self.best_latency = self.latency
+            now = time.time()
+            if now - self.adjusted < 1:
+                return
+            self.adjusted = now
+            backoff = self.backoff
+            if self.latency > max(2 * self.best_latency, self.min_latency):
+                if self.backoff == 1:
+                    self.backoff_base = self.throughput
+                self.backoff = max(self.min_backoff, self.backoff * 0.75)
+            elif self.latency < 1.25 * self.best_latency:
+                self.backoff = min(1.0, self.backoff + 0.05)
+        if self.logger and (self.backoff < 1) != (backoff < 1):
+            self.logger.warning('{} throttle {}: {:.0f} ms/MiB against {:.0f} ms/MiB at best'.format(
+                self.name,
+                'backing off' if self.backoff < 1 else 'recovered',
+                self.latency * 1000,
+                self.best_latency * 1000,
+            ), extra={
+                'throttle': self.name,
+                'backoff': self.backoff,
+            })
+
+    observe_read = observe
+    observe_write = observe
+
+
+class ThrottleGroup(object):
+    '''
+    The throttles a single download is subject to. Received bytes are
+    taken from all of them, the download waits for the slowest.
+    '''
+
+    def __init__(self, throttles, destination=None):
+        '''
+        :param throttles: list
+            `Throttle`s limiting the source (global, host, SR)
+        :param destination: `Throttle`
+            limiting the storage the download is written to
+        '''
+        self.throttles = list(throttles)
+        self.destination = destination
+
+    def consume(self, n):
+        throttles = self.throttles + ([self.destination] if self.destination else [])
+        wait = max([t.reserve(n) for t in throttles] or [0])
+        if wait:
+            time.sleep(wait)
+
+    def observe_read(self, n, seconds):
+        for t in self.throttles:
+            t.observe(n, seconds)
+
+    def observe_write(self, n, seconds):
+        if self.destination:
+            self.destination.observe(n, seconds)
+
+
+class Shaper(object):
+    '''
+    Keeps the throttles of a run: one global, one per host, one per SR
+    and one per destination file system, all sharing the same schedule.
+    Safe to share between threads and pools.
+    '''
+
+    def __init__(self, rate=0, per_host=0, per_sr=0, per_destination=0,
+                 schedule=None, adaptive=False, logger=None):
+        '''
+        :param rate: int
+            bytes per second over all downloads, 0 for unlimited
+        :param per_host: int
+            bytes per second per XenServer host
+        :param per_sr: int
+            bytes per second per storage repository
+        :param per_destination: int
+            bytes per second per file system written to
+        :param schedule: `Schedule`
+        :param adaptive: boolean
+            see `Throttle`
+        '''
+        self.limits = {
+            'host': per_host,
+            'sr': per_sr,
+            'destination': per_destination,
+        }
+        self.schedule = schedule
+        self.adaptive = adaptive
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.throttles = {}
+        self.throttle = self._create('global', rate)
+
+    def _create(self, name, rate):
+        return Throttle(rate, schedule=self.schedule, adaptive=self.adaptive,
+                        name=name, logger=self.logger)
+
+    def _get(self, kind, key):
+        with self.lock:
+            if (kind, key) not in self.throttles:
+                self.throttles[(kind, key)] = self._create('{} {}'.format(kind, key), self.limits[kind])
+            return self.throttles[(kind, key)]
+
+    def group(self, host=None, srs=(), destination=None):
+        '''
+        :param host: hashable
+            the host the export is read from
+        :param srs: list
+            the storage repositories holding the exported disks
+        :param destination: hashable
+            identifies the storage the export is written to, see
+            `storage.LocalStorage.destination`
+        :returns: `ThrottleGroup`
+        '''
+        throttles = [self.throttle]
+        if host:
+            throttles.append(self._get('host', host))
+        throttles.extend(self._get('sr', sr) for sr in srs)
+        target = None
+        if destination is not None:
+            target = self._get('destination', destination)
+        return ThrottleGroup(throttles, target)
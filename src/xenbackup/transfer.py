@@ -0,0 +1,528 @@
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import httplib
+import json
+import os
+import socket
+import ssl
+import time
+import urllib2
+import urlparse
+
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+ALIGNMENT = 4096
+SPARSE_BLOCK = ALIGNMENT
+ZERO_BLOCK = b'\0' * SPARSE_BLOCK
+POSIX_FADV_DONTNEED = 4
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _posix_fadvise = _libc.posix_fadvise
+    _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+except (OSError, AttributeError):
+    _posix_fadvise = None
+
+
+def fadvise_dontneed(fd, offset, length):
+    '''
+    Tells the kernel that the given range of the file will not be read
+    again, so its (clean) pages can be dropped from the page cache.
+    Does nothing where posix_fadvise is not available.
+    '''
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    elif _posix_fadvise:
+        _posix_fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+
+
+def allocate_buffer(size, alignment=ALIGNMENT):
+    '''
+    :returns: memoryview
+        A writable buffer of `size` bytes starting at an `alignment`
+        boundary, as required for O_DIRECT.
+    '''
+    raw = (ctypes.c_char * (size + alignment))()
+    offset = -ctypes.addressof(raw) % alignment
+    view = memoryview(raw)[offset:offset + size]
+    return view
+
+
+def zero_runs(view, offset=0):
+    '''
+    Splits data written at `offset` of a file into runs of data and runs
+    of all zero blocks of `SPARSE_BLOCK` bytes aligned to the file.
+
+    Comparing a block with a string of zeros is a memcmp, which runs at
+    memory speed and stops at the first non zero byte of a data block.
+
+    :returns: list
+        [start, end, zero] of every run, the unaligned head and tail
+        are always data
+    '''
+    size = len(view)
+    runs = []
+    pos = min(size, -offset % SPARSE_BLOCK)
+    if pos:
+        runs.append([0, pos, False])
+    while pos + SPARSE_BLOCK <= size:
+        zero = view[pos:pos + SPARSE_BLOCK] == ZERO_BLOCK
+        if runs and runs[-1][2] == zero:
+            runs[-1][1] = pos + SPARSE_BLOCK
+        else:
+            runs.append([pos, pos + SPARSE_BLOCK, zero])
+        pos += SPARSE_BLOCK
+    if pos < size:
+        if runs and not runs[-1][2]:
+            runs[-1][1] = size
+        else:
+            runs.append([pos, size, False])
+    return runs
+
+
+def to_bytes(data):
+    '''
+    Converts a memoryview to a str for APIs that do not take buffers.
+    '''
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
+def connect(scheme, netloc, timeout=120):
+    '''
+    :returns: httplib.HTTPConnection
+        not verifying the certificate, XenServer hosts use self signed ones
+    '''
+    if scheme == 'https':
+        try:
+            return httplib.HTTPSConnection(
+                netloc,
+                timeout=timeout,
+                context=ssl._create_unverified_context(),
+            )
+        except AttributeError:
+            return httplib.HTTPSConnection(netloc, timeout=timeout)
+    return httplib.HTTPConnection(netloc, timeout=timeout)
+
+
+class ExportConnection(object):
+    '''
+    Keeps one HTTP(S) connection per host open between downloads.
+
+    XenServer closes the connection after an export in most versions,
+    in that case the connection is reopened on the next request.
+    Redirects to other pool members are followed.
+    '''
+
+    def __init__(self, auth, timeout=120):
+        '''
+        :param auth: str
+            base64 encoded user:password
+        '''
+        self.auth = auth
+        self.timeout = timeout
+        self.connections = {}
+
+    def _connection(self, scheme, netloc):
+        key = (scheme, netloc)
+        conn = self.connections.get(key)
+        if conn is None:
+            conn = connect(scheme, netloc, self.timeout)
+            self.connections[key] = conn
+        return conn
+
+    def get(self, url, headers=None, redirects=5):
+        '''
+        :returns: httplib.HTTPResponse
+        :raises: urllib2.HTTPError if the server does not answer with a 2xx
+        '''
+        parts = urlparse.urlsplit(url)
+        path = parts.path
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = {
+            'Authorization': 'Basic {}'.format(self.auth),
+        }
+        request_headers.update(headers or {})
+        conn = self._connection(parts.scheme, parts.netloc)
+        try:
+            conn.request('GET', path, headers=request_headers)
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # the kept alive connection was closed by the server, retry once
+            conn.close()
+            conn.request('GET', path, headers=request_headers)
+            response = conn.getresponse()
+        if response.status in (301, 302, 303, 307) and redirects:
+            location = response.getheader('location')
+            response.read()
+            return self.get(urlparse.urljoin(url, location), headers, redirects - 1)
+        if response.status // 100 != 2:
+            response.read()
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+        if response.will_close:
+            # the response owns the socket now, a new request needs a new connection
+            self.connections.pop((parts.scheme, parts.netloc), None)
+        return response
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+
+def put(url, chunks, length, headers=None, timeout=120, stats=None):
+    '''
+    Uploads a stream with a HTTP PUT, e.g. to the /import handlers.
+
+    :param chunks: iterable
+        the strings to send, `length` bytes together
+    :param stats: dict
+        bytes and send_seconds are added to it, also when the upload fails
+    :returns: str
+        the response body
+    :raises: urllib2.HTTPError if the server does not answer with a 2xx
+    '''
+    parts = urlparse.urlsplit(url)
+    path = parts.path
+    if parts.query:
+        path += '?' + parts.query
+    conn = connect(parts.scheme, parts.netloc, timeout)
+    try:
+        conn.putrequest('PUT', path, skip_accept_encoding=True)
+        for key, value in sorted((headers or {}).items()):
+            conn.putheader(key, value)
+        conn.putheader('Content-Length', str(length))
+        conn.endheaders()
+        sent = 0
+        for data in chunks:
+            started = time.time()
+            conn.send(data)
+            sent += len(data)
+            if stats is not None:
+                stats['bytes'] = stats.get('bytes', 0) + len(data)
+                stats['send_seconds'] = stats.get('send_seconds', 0) + time.time() - started
+        if sent != length:
+            raise httplib.IncompleteRead('', length - sent)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status // 100 != 2:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+        return body
+    finally:
+        conn.close()
+
+
+def readinto(response, view):
+    '''
+    Reads from a HTTP response into `view` without allocating new
+    strings where possible.
+
+    :returns: int
+        number of bytes read, 0 at the end of the response
+    '''
+    if hasattr(response, 'readinto'):
+        return response.readinto(view)
+    sock = getattr(response.fp, '_sock', None)
+    if response.chunked or sock is None or not hasattr(sock, 'recv_into'):
+        data = response.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+    # httplib reads the headers unbuffered, so everything after them is
+    # still on the socket and can be received straight into the buffer.
+    size = len(view)
+    if response.length is not None:
+        size = min(size, response.length)
+        if not size:
+            response.close()
+            return 0
+    while True:
+        try:
+            n = sock.recv_into(view, size)
+            break
+        except socket.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+    if response.length is not None:
+        response.length -= n
+        if n == 0:
+            raise httplib.IncompleteRead('', response.length)
+    if not n:
+        response.close()
+    return n
+
+
+def copy(response, writer, view, throttle=None, stats=None):
+    '''
+    Copies a HTTP response to `writer`, filling the whole buffer before
+    every write.
+
+    :param view: memoryview
+        reusable buffer, see `allocate_buffer`
+    :param throttle: `throttle.ThrottleGroup` or `throttle.Throttle`
+        takes the received bytes and is told how long reading and
+        writing took, not counting the time spent throttled
+    :param stats: dict
+        bytes, read_seconds, write_seconds and throttled_seconds are
+        added to it, also when the copy fails
+    :returns: int
+        number of bytes copied
+    '''
+    total = 0
+    size = len(view)
+    while True:
+        pos = 0
+        read_seconds = 0
+        throttled_seconds = 0
+        while pos < size:
+            started = time.time()
+            n = readinto(response, view[pos:])
+            read_seconds += time.time() - started
+            if not n:
+                break
+            pos += n
+            if throttle:
+                started = time.time()
+                throttle.consume(n)
+                throttled_seconds += time.time() - started
+        write_seconds = 0
+        if pos:
+            started = time.time()
+            writer.write(view[:pos])
+            write_seconds = time.time() - started
+            if throttle:
+                throttle.observe_read(pos, read_seconds)
+                throttle.observe_write(pos, write_seconds)
+            total += pos
+        if stats is not None:
+            for key, value in (('bytes', pos),
+                               ('read_seconds', read_seconds),
+                               ('write_seconds', write_seconds),
+                               ('throttled_seconds', throttled_seconds)):
+                stats[key] = stats.get(key, 0) + value
+        if pos < size:
+            return total
+
+
+class FileWriter(object):
+    '''
+    Writes straight to a file descriptor, without Python's file buffering.
+
+    :param direct: boolean
+        Open the file with O_DIRECT so the data bypasses the page cache.
+        Falls back to normal writes if the file system does not support it.
+    :param drop_cache: boolean
+        Flush and drop the written pages from the page cache every
+        `drop_interval` bytes, so a backup does not evict everything
+        else cached on the host.
+    :param offset: int
+        Continue writing an existing file at this offset, everything
+        after it is truncated. Must be block aligned with `direct`.
+    :param checkpoint: callable
+        Called with the number of bytes that are safely on disk, every
+        `checkpoint_interval` bytes and when the file is closed.
+    :param sparse: boolean
+        Seek over blocks of zeros instead of writing them, leaving holes
+        in the file. `skipped` counts the bytes not written.
+    '''
+
+    def __init__(self, path, direct=False, drop_cache=False,
+                 drop_interval=64 * 1024 * 1024, buffer_size=DEFAULT_BUFFER_SIZE,
+                 offset=0, checkpoint=None, checkpoint_interval=256 * 1024 * 1024,
+                 sparse=False):
+        flags = os.O_WRONLY | os.O_CREAT
+        if not offset:
+            flags |= os.O_TRUNC
+        self.fd = None
+        self.direct = False
+        if direct and hasattr(os, 'O_DIRECT'):
+            try:
+                self.fd = os.open(path, flags | os.O_DIRECT, 0o644)
+                self.direct = True
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+        if self.fd is None:
+            self.fd = os.open(path, flags, 0o644)
+        if offset:
+            os.ftruncate(self.fd, offset)
+            os.lseek(self.fd, offset, os.SEEK_SET)
+        self.drop_cache = drop_cache
+        self.drop_interval = drop_interval
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.offset = offset
+        self.dropped = offset
+        self.synced = offset
+        self.sparse = sparse
+        self.skipped = 0
+        if self.direct:
+            # O_DIRECT needs aligned memory and aligned sizes, stage the
+            # data in an aligned buffer and write it out in full blocks
+            self.staging = allocate_buffer(buffer_size)
+            self.staged = 0
+
+    def _write_all(self, view):
+        while len(view):
+            n = os.write(self.fd, view)
+            view = view[n:]
+            self.offset += n
+
+    def _write(self, data):
+        view = memoryview(data) if not isinstance(data, memoryview) else data
+        if not self.sparse:
+            self._write_all(view)
+        else:
+            for start, end, zero in zero_runs(view, self.offset):
+                if zero:
+                    os.lseek(self.fd, end - start, os.SEEK_CUR)
+                    self.offset += end - start
+                    self.skipped += end - start
+                else:
+                    self._write_all(view[start:end])
+        if self.drop_cache and self.offset - self.dropped >= self.drop_interval:
+            self._sync()
+        elif self.checkpoint and self.offset - self.synced >= self.checkpoint_interval:
+            self._sync()
+
+    def _sync(self):
+        if self.sparse and os.fstat(self.fd).st_size < self.offset:
+            # a hole at the end only exists once the file is extended over it
+            os.ftruncate(self.fd, self.offset)
+        os.fdatasync(self.fd)
+        self.synced = self.offset
+        if self.drop_cache:
+            fadvise_dontneed(self.fd, self.dropped, self.offset - self.dropped)
+            self.dropped = self.offset
+        if self.checkpoint:
+            self.checkpoint(self.offset)
+
+    def write(self, data):
+        if not self.direct:
+            self._write(data)
+            return
+        view = memoryview(data) if not isinstance(data, memoryview) else data
+        size = len(self.staging)
+        while len(view):
+            n = min(size - self.staged, len(view))
+            self.staging[self.staged:self.staged + n] = view[:n]
+            self.staged += n
+            view = view[n:]
+            if self.staged == size:
+                self._write(self.staging)
+                self.staged = 0
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            if self.direct and self.staged:
+                # the tail is rarely block aligned, finish without O_DIRECT
+                fcntl.fcntl(self.fd, fcntl.F_SETFL,
+                            fcntl.fcntl(self.fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+                self._write(self.staging[:self.staged])
+                self.staged = 0
+            if (self.drop_cache or self.checkpoint) and self.offset > self.synced:
+                self._sync()
+            elif self.sparse and os.fstat(self.fd).st_size < self.offset:
+                os.ftruncate(self.fd, self.offset)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    def abort(self):
+        # everything written so far is valid and kept for resuming
+        self.close()
+
+
+class PartialDownload(object):
+    '''
+    A download written to `<path>.partial`, with its progress kept in
+    `<path>.partial.json`. Only `finish()` produces the final archive,
+    through an atomic rename, so half written files never end up
+    looking like a backup.
+    '''
+
+    def __init__(self, path, url):
+        '''
+        :param path: str
+            destination without extension
+        :param url: str
+            the export url, a partial file from another url is discarded
+        '''
+        self.path = path
+        self.partial = path + '.partial'
+        self.sidecar = self.partial + '.json'
+        self.url = url
+        self.info = {}
+        if os.path.exists(self.sidecar):
+            try:
+                with open(self.sidecar) as f:
+                    self.info = json.load(f)
+            except ValueError:
+                self.info = {}
+        if self.info.get('url') != url or not os.path.exists(self.partial):
+            self.discard()
+
+    @property
+    def resume_offset(self):
+        '''
+        The offset a download can be resumed from, 0 if it has to start over.
+        Only uncompressed exports are resumable, a compressor's state
+        can not be restored.
+        '''
+        if self.info.get('mode') != 'none':
+            return 0
+        offset = self.info.get('offset', 0)
+        return offset - offset % ALIGNMENT
+
+    def start(self, mode, ext, offset=0):
+        self.info = {
+            'url': self.url,
+            'mode': mode,
+            'ext': ext,
+            'offset': offset,
+        }
+        self.save(offset)
+
+    def writer(self, direct=False, drop_cache=False, buffer_size=DEFAULT_BUFFER_SIZE, offset=0, sparse=False):
+        '''
+        :returns: `FileWriter`
+            writing to the partial file from `offset`, checkpointing
+            its progress in the sidecar
+        '''
+        return FileWriter(
+            self.partial,
+            direct=direct,
+            drop_cache=drop_cache,
+            buffer_size=buffer_size,
+            offset=offset,
+            checkpoint=self.save,
+            sparse=sparse,
+        )
+
+    def save(self, offset):
+        self.info['offset'] = offset
+        tmp = self.sidecar + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.info, f)
+        os.rename(tmp, self.sidecar)
+
+    def finish(self):
+        '''
+        :returns: str
+            path of the final archive
+        '''
+        path = self.path + self.info['ext']
+        os.rename(self.partial, path)
+        os.remove(self.sidecar)
+        self.info = {}
+        return path
+
+    def discard(self):
+        for path in (self.partial, self.sidecar):
+            if os.path.exists(path):
+                os.remove(path)
+        self.info = {}
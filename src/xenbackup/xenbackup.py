@@ -23,39 +23,197 @@ THE SOFTWARE.
 """
 
 import XenAPI
+import scheduler
+import compression
+import state
+import transfer
+import incremental
+import dedup
+import engine
+import throttle
+import storage
+import metadata
+import metrics
+import integrity
+import planner
+import restore
+import catalog
+import tasks
+import fanout
 import time
+import functools
 import urllib2
 import base64
 import socket
 import os.path
 import os
-import ssl
+import sys
 import argparse
 import logging
 import json
+import threading
 import logstash
-from archive_rotator import rotator
-from archive_rotator.algorithms import SimpleRotator
 from datetime import datetime
 from logging.handlers import SysLogHandler
 
+COMPRESSION_MODES = ('none', 'client', 'server', 'auto')
+
+# value of the use_compression parameter on /export
+SERVER_COMPRESSION = {
+    'gzip': 'true',
+    'zstd': 'zstd',
+}
+
+# headers and checksums of the XVA chunks and the VM metadata, on top of the disks
+EXPORT_OVERHEAD = 0.01
+EXPORT_METADATA_SIZE = 16 * 1024 * 1024
+
+# retries of destroying the disks of a snapshot, and the first delay
+DESTROY_RETRIES = 3
+DESTROY_RETRY_DELAY = 5
+
 class XenBackup(object):
 
-    def __init__(self, server, user, password, rotate=True, rotate_num=5, logger=None):
+    def __init__(self, server, user, password, rotate=True, rotate_num=5, logger=None,
+                 compression=None, compression_level=None, compression_threaded=True,
+                 compression_mode=None, server_compression='gzip', state=None,
+                 buffer_size=transfer.DEFAULT_BUFFER_SIZE, direct_io=False, drop_cache=False,
+                 incremental=False, full_every=7, chunk_store=None, metadata=None,
+                 transport=None, shaper=None, storage=None, run_metrics=None, profiler=None,
+                 checksum=integrity.DEFAULT_CHECKSUM, validate=True, sparse=False, backup_catalog=None, retention=None,
+                 split_disks=False, disk_streams=4, task_watcher=None, mirrors=None,
+                 mirror_policy='block', mirror_buffer=fanout.DEFAULT_MIRROR_BUFFER):
         '''
         :param server: str
         :param user: str
         :param password: str
+        :param compression: str
+            gzip, zstd or lz4 to compress the exports while downloading
+        :param compression_level: int
+            compression level, the compressor's default if None
+        :param compression_threaded: boolean
+            compress in a separate thread
+        :param compression_mode: str
+            none, client, server or auto. Defaults to client if `compression`
+            is set, otherwise none. auto picks the mode per VM based on the
+            export times of previous runs, stored in `state`.
+        :param server_compression: str
+            gzip or zstd, the compression to request from the server
+        :param state: `state.BackupState`
+        :param buffer_size: int
+            size of the download buffer in bytes
+        :param direct_io: boolean
+            write the exports with O_DIRECT, bypassing the page cache
+        :param drop_cache: boolean
+            drop the written exports from the page cache while downloading
+        :param incremental: boolean
+            keep the last snapshot on the host and only export the
+            changes of each disk since then, see export_incremental()
+        :param full_every: int
+            number of restore points in an incremental chain, the first
+            being a full export
+        :param chunk_store: `dedup.ChunkStore`
+            store the exports deduplicated in this chunk store, with a
+            manifest in place of the .xva
+        :param metadata: `metadata.MetadataCache`
+            cache of the pool's records to share with other instances,
+            a new one is created on this session if None. A shared cache
+            reads the records on the session of its creator.
+        :param transport: `XenAPI.PooledTransport`
+            XML-RPC connection pool to share with other instances
+        :param shaper: `throttle.Shaper`
+            bandwidth limits shared with other instances
+        :param storage: `storage.LocalStorage` or `storage.S3Storage`
+            where to store the backups, files below the `path` passed
+            to download_vm() if None
+        :param run_metrics: `metrics.RunMetrics`
+            collects the per phase timings of the VMs
+        :param profiler: `metrics.SamplingProfiler`
+            samples the stacks of download_vm() and export_snapshot()
+        :param checksum: str
+            sha256 or xxhash, hash every archive while it is written and
+            store it in an integrity manifest next to it. None to disable.
+        :param validate: boolean
+            check the chunk checksums inside XVA exports while downloading
+        :param sparse: boolean
+            leave blocks of zeros of uncompressed exports as holes in the
+            files instead of writing them
+        :param backup_catalog: `catalog.BackupCatalog`
+            record the backups in this catalog and expire them with
+            `retention` instead of rotating them with archive_rotator
+        :param retention: `catalog.Retention`
+            which backups of a VM to keep, the newest `rotate_num` if None
+        :param split_disks: boolean
+            export the metadata and every disk of a VM separately, as full
+            restore points, instead of one XVA, see export_incremental()
+        :param disk_streams: int
+            number of disks of a VM downloaded at the same time in
+            incremental and split exports
+        :param task_watcher: `tasks.TaskWatcher`
+            follows the Async calls, to share with other instances, a new
+            one is created on this session if None. A shared watcher runs
+            the calls on the session of its creator, which has to stay
+            logged in until its `drain()` returned.
+        :param mirrors: list of tuples (path, backend)
+            further backup directories or s3://bucket/prefix paths and
+            their storage, which get a copy of every archive from the
+            same download, see `fanout.FanOutWriter`
+        :param mirror_policy: str
+            block, spill or drop, what a mirror that can not keep up
+            with the download does, see `fanout.MirrorSink`
+        :param mirror_buffer: int
+            bytes queued per mirror
         '''
         self.auth = auth = base64.encodestring("%s:%s" % (user, password)).strip()
         self.logger = logger
         self.enable_rotate = rotate
         self.rotate_num = rotate_num
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threaded = compression_threaded
+        if compression_mode is None:
+            compression_mode = 'client' if compression else 'none'
+        if compression_mode not in COMPRESSION_MODES:
+            raise Exception('Unknown compression mode: {}'.format(compression_mode))
+        if compression_mode in ('client', 'auto') and not compression:
+            self.compression = 'gzip'
+        self.compression_mode = compression_mode
+        self.server_compression = server_compression
+        self.server_compression_supported = None
+        self.state = state
+        self.buffer_size = buffer_size
+        self.direct_io = direct_io
+        self.drop_cache = drop_cache
+        self.sparse = sparse
+        self.incremental = incremental
+        self.full_every = full_every
+        self.chunk_store = chunk_store
+        self.connection = transfer.ExportConnection(self.auth)
+        self._buffer = None
+        self.transport = transport
+        self.shaper = shaper
+        self.storage = storage
+        self.run_metrics = run_metrics
+        self.profiler = profiler
+        self.checksum = checksum
+        self.validate = validate
+        self.catalog = backup_catalog
+        self.retention = retention
+        self.split_disks = split_disks
+        self.disk_streams = disk_streams
+        self.mirrors = mirrors or []
+        self.mirror_policy = mirror_policy
+        self.mirror_buffer = mirror_buffer
+        if self.compression:
+            # fail early if the compressor is unknown or its module is missing
+            self._get_compressor()
         self.server = self.login(server, user, password)
+        self.metadata = metadata or self._create_metadata_cache()
+        self.task_watcher = task_watcher or tasks.TaskWatcher(self.session, self.logger)
 
     def login(self, server, user, password):
         try:
-            self.session = XenAPI.Session('https://{}'.format(server))
+            self.session = XenAPI.Session('https://{}'.format(server), transport=self.transport)
             self.session.xenapi.login_with_password(user, password)
             return server
         except XenAPI.Failure as e:
@@ -68,8 +226,18 @@ class XenBackup(object):
                 return self.login(newserver, user, password) 
             raise
 
+    def _create_metadata_cache(self):
+        return metadata.MetadataCache(self.session, self.logger)
+
+    def logout(self):
+        self.connection.close()
+        try:
+            self.session.xenapi.session.logout()
+        except Exception:
+            pass
+
     def get_vms(self):
-        all_vms = self.session.xenapi.VM.get_all_records()
+        all_vms = self.metadata.all('VM')
         vms = {}
         for vm in all_vms:
             vm_record = all_vms[vm]
@@ -80,6 +248,63 @@ class XenBackup(object):
             vms[vm] = vm_record
         return vms
 
+    def get_vm_srs(self, vm_info):
+        '''
+        :param vm_info: dict
+            Retrieved from get_vms()
+        :returns: list
+            OpaqueRefs of the storage repositories holding the VM's disks
+        '''
+        srs = []
+        for vbd in vm_info['VBDs']:
+            vbd_record = self.metadata.get('VBD', vbd)
+            if vbd_record['type'].lower() != 'disk':
+                continue
+            sr = self.metadata.get('VDI', vbd_record['VDI'])['SR']
+            if sr not in srs:
+                srs.append(sr)
+        return srs
+
+    def get_export_size(self, vm_info):
+        '''
+        :param vm_info: dict
+            record of a VM or a snapshot
+        :returns: int
+            upper bound of the size of its uncompressed XVA export
+        '''
+        size = 0
+        for vbd in vm_info['VBDs']:
+            vbd_record = self.metadata.get('VBD', vbd)
+            if vbd_record['type'].lower() != 'disk':
+                continue
+            size += int(self.metadata.get('VDI', vbd_record['VDI'])['virtual_size'])
+        return int(size * (1 + EXPORT_OVERHEAD)) + EXPORT_METADATA_SIZE
+
+    def get_jobs(self, vms, names=None):
+        '''
+        :param vms: dict
+            Retrieved from get_vms()
+        :param names: list
+            lower case VM names to include, all VMs if empty
+        :returns: list of dicts
+            Jobs for `scheduler.BackupScheduler.run`
+        '''
+        jobs = []
+        for vm in vms:
+            vm_info = vms[vm]
+            if names and vm_info['name_label'].lower() not in names:
+                continue
+            host = vm_info['resident_on']
+            if host == 'OpaqueRef:NULL':
+                host = None
+            jobs.append({
+                'opaque_ref': vm,
+                'vm_info': vm_info,
+                'host': host,
+                'srs': self.get_vm_srs(vm_info),
+            })
+        return jobs
+
     def create_snapshot(self, opaque_ref, vm_info, retry_max=3, retry_delay=30):
         '''
         :param opaque_ref: str
@@ -90,10 +315,11 @@ class XenBackup(object):
             Maximum number of retries
         :param retry_delay: int
             wait x number of seconds before retrying
-        :returns: tuple (snapshot_opaque_ref, name)
-            returns the opaque_ref id and the name of the snapshot
+        :returns: str
+            OpaqueRef of the snapshot, named `<vm name>_<UTC time>`,
+            None if every try failed
         '''
-        vm_uuid = self.session.xenapi.VM.get_uuid(opaque_ref)
+        vm_uuid = vm_info['uuid']
         extra = {
             'host': self.server,
             'vm_name': vm_info['name_label'],
@@ -102,20 +328,29 @@ class XenBackup(object):
         self.logger.info('Creating snapshot from {}'.format(
             vm_info['name_label'],
         ), extra)
+        vm_metrics = self.get_vm_metrics(vm_info)
         done = False
         tries = 0
         while not done and tries <= retry_max:
             if tries and (retry_max >= tries):
-                self.logger.info('Retrying snapshot creation in {} seconds [{}/{}]'.format(
-                    retry_delay, 
+                delay = tasks.backoff(retry_delay, tries)
+                self.logger.info('Retrying snapshot creation in {:.0f} seconds [{}/{}]'.format(
+                    delay,
                     tries, 
                     retry_max, 
                 ), extra=extra)
-                time.sleep(retry_delay)
+                vm_metrics.add('snapshot_retries', 1)
+                time.sleep(delay)
             try:
                 tries += 1
                 name = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-                result = self.session.xenapi.VM.snapshot(opaque_ref, '{}_{}'.format(vm_info['name_label'], name))
+                with vm_metrics.phase('snapshot'):
+                    result = self.task_watcher.call(
+                        'VM.snapshot',
+                        opaque_ref,
+                        '{}_{}'.format(vm_info['name_label'], name),
+                        progress=lambda progress: self._snapshot_progress(vm_info, progress),
+                    )
                 self.logger.info('Snapshot successfully created from {}'.format(
                     vm_info['name_label'],
                 ), extra=extra)
@@ -126,6 +361,17 @@ class XenBackup(object):
                     vm_info['name_label'],
                 ), extra=extra)
 
+    def _snapshot_progress(self, vm_info, progress):
+        # the task starts at 0 and ends at 1, only the steps in between are news
+        if 0 < progress < 1:
+            self.logger.info('Snapshot of {} {:.0%} done'.format(vm_info['name_label'], progress), extra={
+                'host': self.server,
+                'vm_name': vm_info['name_label'],
+                'vm_uuid': vm_info['uuid'],
+                'progress': progress,
+            })
+
+    @metrics.profiled
     def download_vm(self, opaque_ref, vm_info, path, retry_max=3, retry_delay=30):
         '''
         :param opaque_ref: str
@@ -141,41 +387,114 @@ class XenBackup(object):
         snapshot_opaque_ref = self.create_snapshot(opaque_ref, vm_info, retry_max, retry_delay)
         if not snapshot_opaque_ref:
             return None
-        vm_uuid = self.session.xenapi.VM.get_uuid(opaque_ref)
+        # only tells whether the export handed the snapshot to a delete
+        released = scheduler.SnapshotRelease(lambda: None)
+        try:
+            return self.export_snapshot(snapshot_opaque_ref, opaque_ref, vm_info, path, retry_max, retry_delay,
+                                        released=released)
+        except Exception:
+            t, v, tb = sys.exc_info()
+            if not released.deferred:
+                self.delete_snapshot(snapshot_opaque_ref, vm_info)
+            raise t, v, tb
+
+    @metrics.profiled
+    def export_snapshot(self, snapshot_opaque_ref, opaque_ref, vm_info, path, retry_max=3, retry_delay=30,
+                        released=None):
+        '''
+        Downloads an existing snapshot, deletes it from the server and
+        rotates the backups. The snapshot is deleted even if the
+        download fails.
+
+        :param snapshot_opaque_ref: str
+            OpaqueRef returned by create_snapshot()
+        :param opaque_ref: str
+            OpaqueRef of the VM the snapshot was created from
+        :param vm_info: dict
+            Retrieved from get_vms()
+        :param retry_max: int
+            Maximum number of retries
+        :param retry_delay: int
+            wait x number of seconds before retrying.
+        :param released: `scheduler.SnapshotRelease`
+            deferred to the background delete of the snapshot, which
+            calls it once the snapshot is gone
+        :returns: boolean
+        '''
+        if self.incremental or self.split_disks:
+            return self.export_incremental(snapshot_opaque_ref, opaque_ref, vm_info, path, retry_max, retry_delay,
+                                           released=released)
+        vm_uuid = vm_info['uuid']
         extra = {
             'host': self.server,
             'vm_name': vm_info['name_label'],
             'vm_uuid': vm_uuid, 
         }
-        filename = '{}-{}.xva'.format(vm_info['name_label'], vm_uuid)
+        filename = '{}-{}'.format(vm_info['name_label'], vm_uuid)
         folder = '{}'.format(vm_info['name_label'])
         self.logger.info('Downloading vm snapshot from {}'.format(
             vm_info['name_label']
         ), extra=extra)
+        vm_metrics = self.get_vm_metrics(vm_info)
         done = False
         tries = 0
         while not done and tries <= retry_max:
             if tries and (retry_max >= tries):                
-                self.logger.info('Retrying download of snapshot in {} seconds [{}/{}]'.format(
-                    retry_delay, 
+                delay = tasks.backoff(retry_delay, tries)
+                self.logger.info('Retrying download of snapshot in {:.0f} seconds [{}/{}]'.format(
+                    delay,
                     tries, 
                     retry_max,
                 ), extra=extra)
-                time.sleep(retry_delay)
+                vm_metrics.add('export_retries', 1)
+                time.sleep(delay)
             try:
                 tries += 1
-                url = 'https://{}/export?uuid={}'.format(self.server, self.session.xenapi.VM.get_uuid(snapshot_opaque_ref))
-                vm_path = os.path.abspath(os.path.join(path, folder))
-                if not os.path.exists(vm_path):
-                    os.mkdir(vm_path)    
-                vm_snap_path = os.path.abspath(os.path.join(vm_path, filename))
-                self._download_url(vm_snap_path, url)
+                snapshot_info = self.metadata.get('VM', snapshot_opaque_ref)
+                url = 'https://{}/export?uuid={}'.format(self.server, snapshot_info['uuid'])
+                backend = self.get_storage(path)
+                vm_path = backend.folder(folder)
+                mode = self.choose_compression_mode(vm_uuid)
+                started = time.time()
+                archive = {}
+                copies = self._mirror_copies(folder, filename)
+                with vm_metrics.phase('export'):
+                    vm_snap_path, mode = self._download_url(
+                        backend.join(vm_path, filename),
+                        url,
+                        mode,
+                        deduplicate=self.chunk_store is not None,
+                        throttle=self.get_throttle(vm_info, backend.destination(vm_path)),
+                        backend=backend,
+                        vm_metrics=vm_metrics,
+                        info=archive,
+                        mirrors=copies,
+                        size=self.get_export_size(snapshot_info),
+                    )
+                self.record_export(vm_uuid, mode, time.time() - started, archive['size'])
                 self.logger.info('Snapshot for vm {} successfully downloaded. Removing snapshot from the server.'.format(
                     vm_info['name_label'],
                 ), extra=extra)                
-                self.delete_snapshot(snapshot_opaque_ref, vm_info)
-                if self.enable_rotate:
-                    self.rotate(vm_snap_path)
+                self.delete_snapshot(snapshot_opaque_ref, vm_info, wait=False, released=released)
+                stored = [(path, backend, archive)]
+                for copy in copies:
+                    if 'error' in copy:
+                        self.logger.warning('Mirror {} of {} was left behind: {}'.format(
+                            copy['root'],
+                            vm_info['name_label'],
+                            copy['error'],
+                        ), extra=dict(extra, error=copy['error']))
+                    else:
+                        stored.append((copy['root'], copy['backend'], copy))
+                for root, stored_backend, stored_info in stored:
+                    if self.catalog:
+                        self.catalog_backup(vm_info, 'archive', root, stored_backend, [stored_info])
+                        if self.enable_rotate:
+                            with vm_metrics.phase('rotate'):
+                                self.expire_backups(vm_info, 'archive', root, stored_backend)
+                    elif self.enable_rotate:
+                        with vm_metrics.phase('rotate'):
+                            self.rotate(stored_info['location'], stored_backend)
                 done = True
                 return True
             except Exception, e:
@@ -186,19 +505,267 @@ class XenBackup(object):
                     'host': self.server,
                     'vm_name': vm_info['name_label'],
                 })
+                if isinstance(e, urllib2.HTTPError) and e.code == 404 and tries <= retry_max:
+                    # the snapshot is gone, the only way forward is a new one
+                    self.logger.warning('Snapshot of {} no longer exists, creating a new one'.format(
+                        vm_info['name_label'],
+                    ), extra=extra)
+                    snapshot_opaque_ref = self.create_snapshot(opaque_ref, vm_info, retry_max, retry_delay)
+                    if not snapshot_opaque_ref:
+                        return False
+        self.delete_snapshot(snapshot_opaque_ref, vm_info, wait=False, released=released)
+        return False
+
+    def export_incremental(self, snapshot_opaque_ref, opaque_ref, vm_info, path, retry_max=3, retry_delay=30,
+                           released=None):
+        '''
+        Exports the VM metadata and every disk of the snapshot as VHD,
+        `disk_streams` at a time. If the previous restore point's snapshot
+        still exists on the host, the disks are exported as deltas against
+        it. The new snapshot is kept on the host as the base of the next
+        run, the previous one is deleted. With `split_disks` and without
+        `incremental` every restore point is a full and no snapshot is kept.
+
+        Restore points are recorded in index.json in the VM's folder,
+        see `incremental.RestorePointIndex`.
+
+        :param snapshot_opaque_ref: str
+            OpaqueRef returned by create_snapshot()
+        :param opaque_ref: str
+            OpaqueRef of the VM the snapshot was created from
+        :param vm_info: dict
+            Retrieved from get_vms()
+        :param released: `scheduler.SnapshotRelease`
+            see export_snapshot(), not called if the snapshot is kept
+        :returns: boolean
+        '''
+        vm_uuid = vm_info['uuid']
+        extra = {
+            'host': self.server,
+            'vm_name': vm_info['name_label'],
+            'vm_uuid': vm_uuid,
+        }
+        try:
+            backend = self.get_storage(path)
+            if backend.remote:
+                raise Exception('Incremental and split backups need a local --path')
+            vm_path = backend.folder(vm_info['name_label'])
+            index = incremental.RestorePointIndex(vm_path)
+            if self.incremental:
+                previous_opaque_ref, base = self._incremental_base(index, vm_info)
+            else:
+                # a snapshot left by an earlier incremental run is not needed anymore
+                latest = index.latest()
+                previous_opaque_ref = self.metadata.find('VM', latest['snapshot_uuid']) if latest else None
+                base = None
+            vm_throttle = self.get_throttle(vm_info, backend.destination(vm_path))
+            vm_metrics = self.get_vm_metrics(vm_info)
+            snapshot_uuid = self.metadata.get('VM', snapshot_opaque_ref)['uuid']
+        except Exception:
+            # nothing was downloaded, the snapshot must not be left on the host
+            t, v, tb = sys.exc_info()
+            self.delete_snapshot(snapshot_opaque_ref, vm_info, wait=False, released=released)
+            raise t, v, tb
+        point = {
+            'id': datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'),
+            'type': 'delta' if base else 'full',
+            'parent': base['id'] if base else None,
+            'snapshot_uuid': snapshot_uuid,
+            'metadata': None,
+            'disks': {},
+        }
+        self.logger.info('Downloading {} restore point of {}'.format(
+            point['type'],
+            vm_info['name_label'],
+        ), extra=extra)
+        mode = 'client' if self.compression else 'none'
+        # catalog information of the downloaded files, by file name
+        files = {}
+        lock = threading.Lock()
+
+        def download(part):
+            info = {}
+            connection = buffer = None
+            if self.disk_streams > 1:
+                connection = transfer.ExportConnection(self.auth)
+                buffer = transfer.allocate_buffer(self.buffer_size)
+            try:
+                filename, _ = self._download_url(
+                    os.path.join(vm_path, part['name']),
+                    part['url'],
+                    mode,
+                    ext=part['ext'],
+                    throttle=vm_throttle,
+                    vm_metrics=vm_metrics,
+                    info=info,
+                    connection=connection,
+                    buffer=buffer,
+                )
+            finally:
+                if connection:
+                    connection.close()
+            with lock:
+                files[os.path.basename(filename)] = info
+                if part['userdevice'] is None:
+                    point['metadata'] = os.path.basename(filename)
+                else:
+                    point['disks'][part['userdevice']] = {
+                        'vdi_uuid': part['vdi_uuid'],
+                        'file': os.path.basename(filename),
+                        'delta': part['delta'],
+                    }
+
+        tries = 0
+        while tries <= retry_max:
+            if tries:
+                delay = tasks.backoff(retry_delay, tries)
+                self.logger.info('Retrying download of restore point in {:.0f} seconds [{}/{}]'.format(
+                    delay,
+                    tries,
+                    retry_max,
+                ), extra=extra)
+                vm_metrics.add('export_retries', 1)
+                time.sleep(delay)
+            tries += 1
+            try:
+                # parts finished by an earlier try are not downloaded again
+                parts = []
+                if not point['metadata']:
+                    parts.append({
+                        'name': '{}.metadata'.format(point['id']),
+                        'url': 'https://{}/export_metadata?uuid={}'.format(self.server, snapshot_uuid),
+                        'ext': '.xva',
+                        'userdevice': None,
+                    })
+                for userdevice, vdi_uuid in sorted(self.get_snapshot_disks(snapshot_opaque_ref).items()):
+                    if userdevice in point['disks']:
+                        continue
+                    url = 'https://{}/export_raw_vdi?vdi={}&format=vhd'.format(self.server, vdi_uuid)
+                    base_vdi_uuid = base['disks'].get(userdevice, {}).get('vdi_uuid') if base else None
+                    if base_vdi_uuid:
+                        url += '&base={}'.format(base_vdi_uuid)
+                    parts.append({
+                        'name': '{}.{}'.format(point['id'], userdevice),
+                        'url': url,
+                        'ext': '.vhd',
+                        'userdevice': userdevice,
+                        'vdi_uuid': vdi_uuid,
+                        'delta': bool(base_vdi_uuid),
+                    })
+                with vm_metrics.phase('export'):
+                    storage.run_parallel(download, parts, self.disk_streams, name='xenbackup-disk')
+                if self.catalog:
+                    # the restore points before this one are imported first
+                    self.catalog_backup(vm_info, 'point', path, backend, [
+                        files[os.path.basename(f)] for f in index.files(point)
+                    ], point=point, index=index)
+                index.add(point)
+                self.logger.info('Restore point of {} successfully downloaded.'.format(
+                    vm_info['name_label'],
+                ), extra=extra)
+                if previous_opaque_ref:
+                    self.delete_snapshot(previous_opaque_ref, vm_info, wait=False)
+                if not self.incremental:
+                    self.delete_snapshot(snapshot_opaque_ref, vm_info, wait=False, released=released)
+                if self.enable_rotate:
+                    with vm_metrics.phase('rotate'):
+                        if self.catalog:
+                            self.expire_backups(vm_info, 'point', path, backend, index=index)
+                        else:
+                            index.expire(self.rotate_num, sidecars=[integrity.INTEGRITY_SUFFIX])
+                return True
+            except Exception as e:
+                self.logger.exception('Error downloading restore point for {}'.format(
+                    vm_info['name_label'],
+                ), extra={
+                    'error': str(e),
+                    'host': self.server,
+                    'vm_name': vm_info['name_label'],
+                })
+                if isinstance(e, urllib2.HTTPError) and e.code == 404 and base:
+                    # the base disks are gone, fall back to a full restore point
+                    base = None
+                    point.update(type='full', parent=None, disks={})
+        self.delete_snapshot(snapshot_opaque_ref, vm_info, wait=False, released=released)
         return False
 
-    def delete_snapshot(self, snapshot_opaque_ref, vm_info):
+    def _incremental_base(self, index, vm_info):
+        '''
+        :returns: tuple (snapshot_opaque_ref, restore_point)
+            the snapshot of the latest restore point if it still exists on
+            the host, and the restore point to base the next deltas on,
+            None if the next restore point must be a full.
+        '''
+        latest = index.latest()
+        if not latest:
+            return None, None
+        opaque_ref = self.metadata.find('VM', latest['snapshot_uuid'])
+        if opaque_ref is None:
+            self.logger.warning('Snapshot of the last restore point of {} no longer exists, creating a full'.format(
+                vm_info['name_label'],
+            ), extra={
+                'host': self.server,
+                'vm_name': vm_info['name_label'],
+            })
+            return None, None
+        if len(index.chain(latest['id'])) >= self.full_every:
+            return opaque_ref, None
+        return opaque_ref, latest
+
+    def get_snapshot_disks(self, snapshot_opaque_ref):
+        '''
+        :returns: dict
+            userdevice -> VDI uuid of the snapshot's disks
+        '''
+        disks = {}
+        for vbd in self.metadata.get('VM', snapshot_opaque_ref)['VBDs']:
+            vbd_record = self.metadata.get('VBD', vbd)
+            if vbd_record['type'].lower() != 'disk':
+                continue
+            disks[vbd_record['userdevice']] = self.metadata.get('VDI', vbd_record['VDI'])['uuid']
+        return disks
+
+    def delete_snapshot(self, snapshot_opaque_ref, vm_info, wait=True, released=None):
+        '''
+        Destroys the disks of a snapshot, all at the same time, and then
+        the snapshot.
+
+        :param wait: boolean
+            wait for the snapshot to be deleted, if False it is deleted in
+            the background and the export can go on, see
+            `tasks.TaskWatcher.drain()`
+        :param released: `scheduler.SnapshotRelease`
+            called when a background delete has finished, failed or not
+        :returns: boolean
+            whether the snapshot was deleted, True if not waited for
+        '''
+        if not wait:
+            def delete():
+                try:
+                    self.delete_snapshot(snapshot_opaque_ref, vm_info)
+                finally:
+                    if released is not None:
+                        released()
+
+            self.task_watcher.background(delete, name='xenbackup-delete')
+            if released is not None:
+                # after the thread started, a failed start leaves the release to the worker
+                released.defer()
+            return True
+        with self.get_vm_metrics(vm_info).phase('delete'):
+            return self._delete_snapshot(snapshot_opaque_ref, vm_info)
+
+    def _delete_snapshot(self, snapshot_opaque_ref, vm_info):
         try:
-            snap_record = self.session.xenapi.VM.get_record(snapshot_opaque_ref)  
+            snap_record = self.metadata.get('VM', snapshot_opaque_ref)
+            vdis = []
             for vbd in snap_record['VBDs']:
-                vbd_record = self.session.xenapi.VBD.get_record(vbd)
+                vbd_record = self.metadata.get('VBD', vbd)
                 if vbd_record['type'].lower() != 'disk':
-                    continue                
-                vdi = vbd_record['VDI']
-                sr = self.session.xenapi.VDI.get_SR(vdi)
-                self.session.xenapi.VDI.destroy(vdi)
-            self.session.xenapi.VM.destroy(snapshot_opaque_ref)
+                    continue
+                vdis.append(vbd_record['VDI'])
+            self._destroy('VDI', vdis, vm_info)
+            self._destroy('VM', [snapshot_opaque_ref], vm_info)
             return True
         except Exception, e:
             self.logger.exception('Error deleting snapshot for {}'.format(vm_info['name_label']), extra={
@@ -208,35 +775,438 @@ class XenBackup(object):
             })
         return False
 
-    def _download_url(self, path, url):
+    def _destroy(self, cls, opaque_refs, vm_info):
+        '''
+        Destroys objects with Async tasks running at the same time, retrying
+        the failed ones up to DESTROY_RETRIES times with backoff. Objects
+        that no longer exist count as destroyed, a destroy whose task was
+        lost is tried again.
+
+        :param cls: str
+            VDI or VM
+        :raises: XenAPI.Failure of the last try
+        '''
+        pending = list(opaque_refs)
+        for attempt in range(DESTROY_RETRIES + 1):
+            if attempt:
+                delay = tasks.backoff(DESTROY_RETRY_DELAY, attempt)
+                self.logger.info('Retrying to destroy {} {} of {} in {:.0f} seconds [{}/{}]'.format(
+                    len(pending),
+                    cls,
+                    vm_info['name_label'],
+                    delay,
+                    attempt,
+                    DESTROY_RETRIES,
+                ), extra={
+                    'error': str(error),
+                    'host': self.server,
+                    'vm_name': vm_info['name_label'],
+                })
+                self.get_vm_metrics(vm_info).add('delete_retries', 1)
+                time.sleep(delay)
+            submitted = []
+            failed = []
+            for opaque_ref in pending:
+                try:
+                    submitted.append((opaque_ref, self.task_watcher.submit('{}.destroy'.format(cls), opaque_ref)))
+                except XenAPI.Failure as e:
+                    submitted.append((opaque_ref, e))
+            for opaque_ref, task in submitted:
+                try:
+                    if isinstance(task, XenAPI.Failure):
+                        raise task
+                    self.task_watcher.wait(task)
+                except XenAPI.Failure as e:
+                    if e.details[0] != 'HANDLE_INVALID' or opaque_ref not in e.details:
+                        failed.append(opaque_ref)
+                        error = e
+                        continue
+                self.metadata.forget(cls, opaque_ref)
+            pending = failed
+            if not pending:
+                return
+        raise error
+
+    def get_storage(self, path):
+        '''
+        :returns: `storage.LocalStorage` or `storage.S3Storage`
+            the storage passed to the constructor, or the directory `path`
+        '''
+        return self.storage or storage.LocalStorage(path)
+
+    def get_vm_metrics(self, vm_info):
+        '''
+        :returns: `metrics.VMMetrics`
+            where to record the timings of the VM, thrown away without
+            `run_metrics`
+        '''
+        if not self.run_metrics:
+            return metrics.VMMetrics(self.server, vm_info)
+        return self.run_metrics.vm(self.server, vm_info)
+
+    def get_throttle(self, vm_info, destination):
+        '''
+        :param destination: hashable
+            the storage written to, see `storage.LocalStorage.destination`
+        :returns: `throttle.ThrottleGroup`
+            the bandwidth limits of the VM's host, its storage repositories
+            and the destination, None without a shaper
+        '''
+        if not self.shaper:
+            return None
+        host = vm_info['resident_on']
+        return self.shaper.group(
+            host=(self.server, host) if host != 'OpaqueRef:NULL' else None,
+            srs=[(self.server, sr) for sr in self.get_vm_srs(vm_info)],
+            destination=destination,
+        )
+
+    def _open_url(self, url, headers=None, connection=None):
         socket.setdefaulttimeout(120)
-        request = urllib2.Request(url)
-        request.add_header('Authorization', 'Basic {}'.format(self.auth))
+        return (connection or self.connection).get(url, headers)
+
+    def _download_url(self, path, url, mode=None, ext='.xva', deduplicate=False, throttle=None, backend=None,
+                      vm_metrics=None, info=None, connection=None, buffer=None, mirrors=None, size=None):
+        '''
+        :param path: str
+            destination without extension, a file or an object key
+            depending on `backend`
+        :param url: str
+        :param mode: str
+            none, client or server
+        :param ext: str
+            extension of the uncompressed file
+        :param deduplicate: boolean
+            store the export in the chunk store and write a manifest
+            with the extension `ext.manifest`
+        :param throttle: `throttle.ThrottleGroup`
+        :param backend: `storage.LocalStorage` or `storage.S3Storage`
+            local files if None
+        :param vm_metrics: `metrics.VMMetrics`
+            gets the time to first byte, the bytes received, the bytes
+            left as holes and the time spent waiting for the writer and
+            the bandwidth limits
+        :param info: dict
+            gets the `location` and `size` of the stored archive and the
+            `algorithm` and `digest` of its checksum, for the catalog
+        :param connection: `transfer.ExportConnection`
+        :param buffer: memoryview
+            download buffer, see `transfer.allocate_buffer()`. The
+            connection and the buffer of the instance are used if None,
+            downloads running at the same time need their own.
+        :param mirrors: list of dicts
+            further copies of the archive written from the same download,
+            each with the `backend` and the `path` in it, see
+            `fanout.MirrorSink`. Each gets the `location`, `size`,
+            `algorithm` and `digest` of its copy like `info`, or the
+            `error` that left it behind. Not for deduplicated exports.
+        :param size: int
+            expected size of the export in bytes, sizes the parts of S3
+            uploads, see `storage.MultipartWriter`
+        :returns: tuple (path, mode)
+            path of the archive including its extension and the
+            compression mode that was actually used
+
+        Local exports are written to `path.partial`. If an earlier try of
+        the same export left a partial file, the download continues where
+        it stopped when the server supports ranges.
+
+        The archive is hashed while it is written and XVA exports are
+        parsed on the fly to check their chunk checksums, see
+        `integrity.XVAValidator`. The hash goes into an integrity manifest
+        next to the archive.
+        '''
+        if mode is None:
+            mode = 'client' if self.compression else 'none'
+        if deduplicate:
+            # compressed streams do not deduplicate, chunks are compressed by the store
+            mode = 'none'
+            # a manifest is no copy without the chunk store
+            mirrors = None
+        backend = backend or storage.LocalStorage(os.path.dirname(path))
+        if deduplicate and backend.remote:
+            raise Exception('Deduplicated backups need a local --path')
+        validate = self.validate and ext == '.xva'
+        partial = backend.upload(path, url, size)
+        requested = time.time()
+        offset = 0
+        result = None
+        received = None
+        if partial.resume_offset:
+            result = self._open_url(url, {'Range': 'bytes={}-'.format(partial.resume_offset)}, connection)
+            if result.status == 206:
+                offset = partial.resume_offset
+                mode = partial.info['mode']
+                ext = partial.info['ext']
+                self.logger.info('Resuming download of {} at {} bytes'.format(url, offset), extra={
+                    'host': self.server,
+                })
+            else:
+                # ranges are not supported, start over on the same snapshot
+                partial.discard()
+                if mode == 'server':
+                    result.close()
+                    result = None
+
+        head = b''
+        if not offset:
+            if mode == 'server' and self.server_compression_supported is not False:
+                try:
+                    result = self._open_url('{}&use_compression={}'.format(
+                        url,
+                        SERVER_COMPRESSION[self.server_compression],
+                    ), connection=connection)
+                except urllib2.HTTPError as e:
+                    self._server_compression_unsupported(str(e))
+            if result is None:
+                result = self._open_url(url, connection=connection)
+
+            head = result.read(4)
+            if vm_metrics:
+                vm_metrics.first('first_byte_seconds', time.time() - requested)
+            received = compression.detect(head)
+            if mode == 'server' and not received and self.server_compression_supported is not False:
+                self._server_compression_unsupported('received an uncompressed export')
+            if received:
+                mode = 'server'
+            elif mode != 'none' and self.compression:
+                mode = 'client'
+            else:
+                mode = 'none'
+            ext = compression.suffix(received or (self.compression if mode == 'client' else None), ext)
+            if deduplicate:
+                mode = 'dedup'
+                ext += '.manifest'
+            partial.start(mode, ext)
 
+        if buffer is None:
+            if self._buffer is None:
+                self._buffer = transfer.allocate_buffer(self.buffer_size)
+            buffer = self._buffer
+        checksum = integrity.Checksum(self.checksum) if self.checksum else None
+        validator = integrity.XVAValidator(received) if validate else None
+        taps = [t for t in (checksum, validator) if t]
+        # the validator sees the export decompressed, otherwise it is counted before compressing
+        length = integrity.Length() if mode == 'client' and not validator else None
+        file_writer = None
+        if deduplicate:
+            # the checksum covers the export, the chunks are checked by their names
+            writer = integrity.TapWriter(dedup.DedupWriter(partial.partial, self.chunk_store), taps)
+        else:
+            # compressed archives have no runs of zeros worth a hole
+            writer = file_writer = partial.writer(
+                direct=self.direct_io,
+                drop_cache=self.drop_cache,
+                buffer_size=self.buffer_size,
+                offset=offset,
+                sparse=self.sparse and mode == 'none',
+            )
+            if mirrors:
+                # spill next to the primary copy, remote ones spill to the temporary directory
+                spill_dir = None if backend.remote else os.path.dirname(path)
+                writer = self._mirror_writer(writer, mirrors, url, mode, ext, spill_dir, size)
+                if offset:
+                    writer.prefill(partial.partial, offset)
+            if checksum:
+                writer = integrity.TapWriter(writer, [checksum])
+            if mode == 'client':
+                writer = compression.CompressingWriter(
+                    writer,
+                    self._get_compressor(),
+                    threaded=self.compression_threaded,
+                )
+            if validator or length:
+                writer = integrity.TapWriter(writer, [t for t in (validator, length) if t])
+            if offset and taps:
+                # only uncompressed exports resume, the file is the export
+                integrity.replay(partial.partial, offset, taps)
+        stats = {}
         try:
-            result = urllib2.urlopen(request, context=ssl._create_unverified_context())                                       
-        except AttributeError:
-            result = urllib2.urlopen(request)  
+            writer.write(head)
+            transfer.copy(result, writer, buffer, throttle, stats)
+            if validator:
+                validator.finish()
+            writer.close()
+        except Exception:
+            writer.abort()
+            result.close()
+            raise
+        finally:
+            if vm_metrics:
+                vm_metrics.add('bytes', len(head) + stats.get('bytes', 0))
+                vm_metrics.add('write_stall_seconds', stats.get('write_seconds', 0))
+                vm_metrics.add('throttled_seconds', stats.get('throttled_seconds', 0))
+                vm_metrics.add('sparse_bytes', getattr(file_writer, 'skipped', 0))
+        path = partial.finish()
+        stored = [(backend, path, info)]
+        for mirror in mirrors or []:
+            sink = mirror.pop('sink', None)
+            upload = mirror.pop('upload', None)
+            if sink is not None:
+                if vm_metrics:
+                    vm_metrics.add('mirror_spill_bytes', sink.spilled)
+                if sink.error is None:
+                    try:
+                        stored.append((mirror['backend'], upload.finish(), mirror))
+                        continue
+                    except Exception as e:
+                        sink.error = e
+                mirror['error'] = str(sink.error)
+            if vm_metrics:
+                vm_metrics.add('mirror_failures', 1)
+        uncompressed_size = None
+        if mode in ('client', 'server'):
+            # saves restores decompressing the archive once only to learn its length
+            uncompressed_size = validator.size if validator else length.size if length else None
+        for stored_backend, location, stored_info in stored:
+            if checksum:
+                stored_backend.put(location + integrity.INTEGRITY_SUFFIX, integrity.manifest(
+                    checksum,
+                    'stream' if deduplicate else 'file',
+                    validator,
+                    uncompressed_size,
+                ))
+            if stored_info is not None:
+                stored_info.update(
+                    location=location,
+                    size=stored_backend.size(location),
+                    algorithm=checksum.algorithm if checksum else None,
+                    digest=checksum.hexdigest() if checksum else None,
+                )
+        return path, mode
+
+    def _mirror_writer(self, writer, mirrors, url, mode, ext, spill_dir=None, size=None):
+        '''
+        :param writer: file like object
+            writing the primary copy
+        :param mirrors: list of dicts
+            see `_download_url()`, get the `upload` and the `sink` of
+            their copy
+        :param spill_dir: str
+            directory of the spill files, the temporary directory if None
+        :param size: int
+            expected size of the export in bytes
+        :returns: `fanout.FanOutWriter`
+        '''
+        sinks = []
+        for mirror in mirrors:
+            if 'path' not in mirror:
+                continue
+            mirror.pop('error', None)
+            try:
+                upload = mirror['backend'].upload(mirror['path'], url, size)
+                upload.start(mode, ext)
+                sink = fanout.MirrorSink(
+                    mirror['path'],
+                    upload.writer(
+                        direct=self.direct_io,
+                        drop_cache=self.drop_cache,
+                        buffer_size=self.buffer_size,
+                        sparse=self.sparse and mode == 'none',
+                    ),
+                    buffer_size=self.mirror_buffer,
+                    policy=self.mirror_policy,
+                    spill_dir=spill_dir,
+                )
+            except Exception as e:
+                # a mirror that can not be written is left behind, not the backup
+                mirror['error'] = str(e)
+                continue
+            mirror['upload'] = upload
+            mirror['sink'] = sink
+            sinks.append(sink)
+        return fanout.FanOutWriter(writer, sinks)
+
+    def _mirror_copies(self, folder, filename):
+        '''
+        :returns: list of dicts
+            the `mirrors` of `_download_url()` for an archive, with the
+            `root` of every mirror. Mirrors whose folder can not be
+            created get the `error`.
+        '''
+        copies = []
+        for root, backend in self.mirrors:
+            copy = {
+                'root': root,
+                'backend': backend,
+            }
+            try:
+                copy['path'] = backend.join(backend.folder(folder), filename)
+            except Exception as e:
+                copy['error'] = str(e)
+            copies.append(copy)
+        return copies
 
-        with open(path, r'wb') as f:
-            block_sz = 8192
-            while True:
-                buffer = result.read(block_sz)
-                if not buffer:
-                    break
-                f.write(buffer)
+    def _server_compression_unsupported(self, reason):
+        self.server_compression_supported = False
+        self.logger.warning('{} does not support server side compression ({}), falling back to {}'.format(
+            self.server,
+            reason,
+            'client side compression' if self.compression else 'no compression',
+        ), extra={
+            'host': self.server,
+        })
+
+    def _get_compressor(self):
+        return compression.get_compressor(self.compression, self.compression_level)
+
+    def choose_compression_mode(self, vm_uuid):
+        '''
+        :param vm_uuid: str
+        :returns: str
+            none, client or server. In auto mode modes that have not been
+            tried for the VM are tried first, after that the mode with the
+            lowest average export time wins.
+        '''
+        if self.compression_mode != 'auto':
+            return self.compression_mode
+        modes = ['server', 'client', 'none']
+        if self.server_compression_supported is False:
+            modes.remove('server')
+        exports = {}
+        if self.state:
+            exports = self.state.get_vm(vm_uuid).get('exports', {})
+        modes = [m for m in modes if not exports.get(m, {}).get('unsupported')]
+        for mode in modes:
+            if mode not in exports:
+                return mode
+        return min(modes, key=lambda m: exports[m]['seconds'])
+
+    def record_export(self, vm_uuid, mode, seconds, size):
+        '''
+        Stores the export time of the VM with the given mode, as a moving
+        average, for choose_compression_mode().
+        '''
+        if not self.state:
+            return
+        with self.state.vm(vm_uuid) as vm:
+            exports = vm.setdefault('exports', {})
+            if self.compression_mode == 'auto' and self.server_compression_supported is False:
+                exports['server'] = {'unsupported': True}
+            stats = exports.setdefault(mode, {})
+            if 'seconds' in stats:
+                seconds = (stats['seconds'] + seconds) / 2.0
+            stats['seconds'] = seconds
+            stats['bytes'] = size
+            stats['runs'] = stats.get('runs', 0) + 1
 
-    def rotate(self, path):
+    def rotate(self, path, backend=None):
         '''
         :param path: str
+        :param backend: `storage.LocalStorage` or `storage.S3Storage`
+            local files if None
         :returns: boolean
         '''
         try:
-            rotator.rotate(
-                SimpleRotator(self.rotate_num, False),
-                path=path,
-                ext='.xva',
-            )
+            backend = backend or storage.LocalStorage(os.path.dirname(path))
+            expiring = None
+            if path.endswith('.manifest'):
+                # open the manifests about to be deleted, their chunk lists
+                # are streamed from the open files after the rotation
+                expiring = lambda paths: [dedup.read_manifest(p)[1] for p in paths if p.endswith('.manifest')]
+            expired = backend.rotate(path, self.rotate_num, expiring, sidecars=[integrity.INTEGRITY_SUFFIX])
+            for manifest in expired or []:
+                self.chunk_store.release(manifest)
             return True
         except Exception, e:
             self.logger.error('Error rotating snapshots', extra={
@@ -245,60 +1215,704 @@ class XenBackup(object):
             })
         return False
 
+    def catalog_backup(self, vm_info, kind, path, backend, files, point=None, index=None):
+        '''
+        Records a new backup in the catalog, archives under their final
+        name. The first time a VM's backups of this kind are cataloged,
+        its earlier backups are imported from its folder.
+
+        :param kind: str
+            archive or point
+        :param path: str
+            the backup directory or s3://bucket/prefix
+        :param files: list of dicts
+            the `info` of `_download_url()` of every file of the backup
+        :param point: dict
+            the incremental restore point, see `incremental.RestorePointIndex`
+        :param index: `incremental.RestorePointIndex`
+            the VM's restore points, without `point`
+        :returns: boolean
+        '''
+        destination = catalog.destination(path)
+        try:
+            if not self.catalog.is_imported(destination, vm_info['uuid'], kind):
+                self._import_backups(vm_info, kind, destination, backend, files[0]['location'], index)
+            rotation_id = None
+            if kind == 'archive':
+                rotation_id = self.catalog.next_rotation_id(destination, vm_info['uuid'])
+                files = [dict(files[0], location=backend.archive(
+                    files[0]['location'],
+                    rotation_id,
+                    sidecars=[integrity.INTEGRITY_SUFFIX],
+                ))]
+            self.catalog.add(
+                destination,
+                vm_info['uuid'],
+                vm_info['name_label'],
+                kind,
+                files,
+                created=catalog.point_time(point['id']) if point else None,
+                point_id=point['id'] if point else None,
+                parent=point['parent'] if point else None,
+                rotation_id=rotation_id,
+            )
+            return True
+        except Exception, e:
+            self.logger.exception('Error cataloging the backup of {}'.format(vm_info['name_label']), extra={
+                'host': self.server,
+                'vm_name': vm_info['name_label'],
+                'error': str(e),
+            })
+        return False
+
+    def _import_backups(self, vm_info, kind, destination, backend, location, index=None):
+        if kind == 'archive':
+            # objects are stored under their final name, the new backup is
+            # among them and added by the caller
+            backups = [{
+                'files': [catalog.file_info(backend, archive, integrity.INTEGRITY_SUFFIX)],
+                'created': created,
+                'rotation_id': rotation_id,
+            } for archive, created, rotation_id in backend.rotated(location, sidecars=[integrity.INTEGRITY_SUFFIX])
+                if archive != location]
+        else:
+            backups = [{
+                'files': [
+                    catalog.file_info(backend, f, integrity.INTEGRITY_SUFFIX)
+                    for f in index.files(point) if os.path.exists(f)
+                ],
+                'created': catalog.point_time(point['id']),
+                'point_id': point['id'],
+                'parent': point['parent'],
+            } for point in index.points]
+        self.catalog.add_many(destination, vm_info['uuid'], vm_info['name_label'], kind, backups, imported=True)
+        if backups:
+            self.logger.info('Imported {} earlier backups of {} into the catalog'.format(
+                len(backups),
+                vm_info['name_label'],
+            ), extra={
+                'host': self.server,
+                'vm_name': vm_info['name_label'],
+                'vm_uuid': vm_info['uuid'],
+            })
+
+    def expire_backups(self, vm_info, kind, path, backend, index=None):
+        '''
+        Deletes the backups of a VM the retention does not keep, as
+        decided by the catalog. The files are deleted concurrently.
+
+        :param kind: str
+            archive or point
+        :param index: `incremental.RestorePointIndex`
+            the VM's restore points, the expired ones are removed from it
+        :returns: boolean
+        '''
+        try:
+            expired = self.catalog.expired(
+                catalog.destination(path),
+                vm_info['uuid'],
+                kind,
+                self.retention or catalog.Retention(last=self.rotate_num),
+            )
+            if not expired:
+                return True
+            locations = [f['location'] for backup in expired for f in backup['files']]
+            # open the manifests before they are deleted, their chunk lists
+            # are streamed from the open files afterwards
+            manifests = [
+                dedup.read_manifest(location)[1] for location in locations
+                if location.endswith('.manifest') and os.path.exists(location)
+            ]
+            if index:
+                index.remove([backup['point_id'] for backup in expired])
+            backend.delete(locations + [location + integrity.INTEGRITY_SUFFIX for location in locations])
+            self.catalog.remove([backup['id'] for backup in expired])
+            if self.chunk_store:
+                for manifest in manifests:
+                    self.chunk_store.release(manifest)
+            self.logger.info('Expired {} backups of {}, {:.1f} GiB'.format(
+                len(expired),
+                vm_info['name_label'],
+                sum(backup['size'] for backup in expired) / 1024.0 ** 3,
+            ), extra={
+                'host': self.server,
+                'vm_name': vm_info['name_label'],
+                'vm_uuid': vm_info['uuid'],
+                'expired': len(expired),
+            })
+            return True
+        except Exception, e:
+            self.logger.exception('Error expiring the backups of {}'.format(vm_info['name_label']), extra={
+                'host': self.server,
+                'vm_name': vm_info['name_label'],
+                'error': str(e),
+            })
+        return False
+
+def create_logger(args):
+    logger = logging.getLogger('xenbackup')
+    logger.addHandler(logging.StreamHandler())
+    logger.addHandler(logstash.LogstashHandler(args.logstash_host, args.logstash_port, version=1))
+    logger.setLevel(logging.INFO)
+    return logger
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'verify':
+        return verify_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'restore':
+        return restore_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'list':
+        return list_main(sys.argv[2:])
     parser = argparse.ArgumentParser()
-    parser.add_argument('--path', help='backup directory', required=True, type=str)
-    parser.add_argument('--host', help='xenserver host', required=True, type=str)
-    parser.add_argument('--user', help='xenserver user', required=True, type=str)
-    parser.add_argument('--password', help='xenserver password', required=True, type=str)
+    parser.add_argument('--path', help='backup directory or s3://bucket/prefix', required=True, type=str)
+    parser.add_argument('--host', help='xenserver host', default=None, type=str)
+    parser.add_argument('--user', help='xenserver user', default=None, type=str)
+    parser.add_argument('--password', help='xenserver password', default=None, type=str)
+    parser.add_argument('--config', help='JSON file listing several pools to backup from one process', default=None, type=str)
+    parser.add_argument('--max_parallel', help='maximum concurrent exports over all pools of --config (0 = unlimited)', default=0, type=int)
+    parser.add_argument('--bandwidth', help='maximum download rate in MiB/s over all exports (0 = unlimited)', default=0, type=int)
+    parser.add_argument('--bandwidth_per_host', help='maximum download rate in MiB/s per xenserver host (0 = unlimited)', default=0, type=int)
+    parser.add_argument('--bandwidth_per_sr', help='maximum download rate in MiB/s per storage repository (0 = unlimited)', default=0, type=int)
+    parser.add_argument('--bandwidth_per_destination', help='maximum download rate in MiB/s per destination file system (0 = unlimited)', default=0, type=int)
+    parser.add_argument('--bandwidth_schedule', help='time of day factors for the bandwidth limits, e.g. 08:00-18:00=0.2,22:00-06:00=2', default=None, type=str)
+    parser.add_argument('--adaptive_throttle', help='slow down the exports when the read or write latency degrades', action='store_true')
 
     parser.add_argument('--retry_max', help='max retries per VM', default=3, type=int)    
-    parser.add_argument('--retry_delay', help='number of seconds to wait after each failed try', default=30, type=int)
+    parser.add_argument('--retry_delay', help='number of seconds to wait after the first failed try, doubling with every further try', default=30, type=int)
 
     parser.add_argument('--rotate', help='enable rotate', default=True, type=bool)
     parser.add_argument('--rotate_num', help='maximum number of snapshots stored in a directory', default=5, type=int)
+    parser.add_argument('--keep_daily', help='also keep the newest backup of each of this many days', default=0, type=int)
+    parser.add_argument('--keep_weekly', help='also keep the newest backup of each of this many weeks', default=0, type=int)
+    parser.add_argument('--keep_monthly', help='also keep the newest backup of each of this many months', default=0, type=int)
+    parser.add_argument('--keep_yearly', help='also keep the newest backup of each of this many years', default=0, type=int)
+    parser.add_argument('--no_catalog', help='rotate the backups by reading their folders instead of keeping a catalog of them', action='store_true')
 
     parser.add_argument('--vms', help='a comma separated list of virtual machines to backup', default=None, type=str)
 
+    parser.add_argument('--skip_unchanged', help='skip halted VMs that did not change since their last backup', action='store_true')
+    parser.add_argument('--max_skip_days', help='back up unchanged VMs anyway after this many days (0 = never)', default=30, type=int)
+    parser.add_argument('--plan', help='only log which VMs would be backed up, in which order, and the predicted backup window', action='store_true')
+
+    parser.add_argument('--parallel', help='number of VMs to backup at the same time', default=1, type=int)
+    parser.add_argument('--max_per_host', help='maximum concurrent exports per xenserver host (0 = unlimited)', default=2, type=int)
+    parser.add_argument('--max_per_sr', help='maximum concurrent exports per storage repository (0 = unlimited)', default=1, type=int)
+    parser.add_argument('--snapshot_lookahead', help='number of snapshots to create ahead of the running exports (0 = disabled)', default=0, type=int)
+
+    parser.add_argument('--compression', help='compress the exports while downloading', default=None, choices=sorted(compression.COMPRESSORS), type=str)
+    parser.add_argument('--compression_level', help='compression level, uses the compressor default if not set', default=None, type=int)
+    parser.add_argument('--compression_mode', help='where to compress the exports, auto picks per VM based on previous runs', default=None, choices=COMPRESSION_MODES, type=str)
+    parser.add_argument('--server_compression', help='compression to request from the server', default='gzip', choices=sorted(SERVER_COMPRESSION), type=str)
+
+    parser.add_argument('--buffer_size', help='download buffer size in MiB', default=transfer.DEFAULT_BUFFER_SIZE // 1024 // 1024, type=int)
+    parser.add_argument('--direct_io', help='write the exports with O_DIRECT, bypassing the page cache', action='store_true')
+    parser.add_argument('--drop_cache', help='drop the exports from the page cache while writing them', action='store_true')
+    parser.add_argument('--sparse', help='leave blocks of zeros of uncompressed exports as holes instead of writing them', action='store_true')
+
+    parser.add_argument('--incremental', help='export only the changed blocks of each disk since the last backup', action='store_true')
+    parser.add_argument('--full_every', help='number of restore points in an incremental chain, starting with a full', default=7, type=int)
+    parser.add_argument('--split_disks', help='export the metadata and every disk of a VM separately and in parallel instead of one XVA', action='store_true')
+    parser.add_argument('--disk_streams', help='number of disks of a VM downloaded at the same time with --incremental and --split_disks', default=4, type=int)
+
+    parser.add_argument('--dedup', help='store the exports deduplicated in path/.chunks', action='store_true')
+
+    parser.add_argument('--mirror', help='another backup directory or s3://bucket/prefix getting a copy of every archive from the same download, can be repeated', default=None, action='append')
+    parser.add_argument('--mirror_policy', help='what a mirror that can not keep up does: block the download, spill to a temporary file or drop the mirror', default='block', choices=fanout.POLICIES, type=str)
+    parser.add_argument('--mirror_buffer', help='MiB queued per mirror', default=fanout.DEFAULT_MIRROR_BUFFER // 1024 // 1024, type=int)
+
+    parser.add_argument('--s3_endpoint', help='endpoint url of an S3 compatible store, AWS if not set', default=None, type=str)
+    parser.add_argument('--s3_part_size', help='first multipart upload part size in MiB, 5 to 5120, raised for exports that need more than 9000 parts and doubled every 1000 parts beyond their expected size', default=64, type=int)
+    parser.add_argument('--s3_concurrency', help='parts uploaded at the same time per export', default=4, type=int)
+    parser.add_argument('--state_path', help='directory of the state file, path by default, ~/.xenbackup for s3 paths', default=None, type=str)
+
+    parser.add_argument('--checksum', help='hash every archive while writing it and store the hash next to it, xxhash by default when installed, otherwise sha256, which costs several CPU seconds per GB', default=integrity.DEFAULT_CHECKSUM, choices=integrity.CHECKSUMS + ('none',), type=str)
+    parser.add_argument('--no_validate', help='do not check the chunk checksums inside the XVA exports while downloading, saves the CPU time of hashing every chunk again, several seconds per GB for SHA-1 checksums', action='store_true')
+
+    parser.add_argument('--report', help='write a JSON report with the per phase timings of every VM to this file', default=None, type=str)
+    parser.add_argument('--prometheus_textfile', help='write the metrics of the run to this file for the node_exporter textfile collector', default=None, type=str)
+    parser.add_argument('--pushgateway', help='push the metrics of the run to this Prometheus pushgateway, e.g. http://pushgateway:9091', default=None, type=str)
+    parser.add_argument('--profile', help='sample the stacks of the exports and write them in collapsed stack format to this file', default=None, type=str)
+
     parser.add_argument('--logstash_host', help='ip/hostname of the syslog server', default='127.0.0.1', type=str)
     parser.add_argument('--logstash_port', help='port of the syslog server', default=5959, type=int)
 
     args = parser.parse_args()
+    if not args.config and not (args.host and args.user and args.password):
+        parser.error('--host, --user and --password are required unless --config is given')
 
-    logger = logging.getLogger('xenbackup')
-    logger.addHandler(logging.StreamHandler())
-    logger.addHandler(logstash.LogstashHandler(args.logstash_host, args.logstash_port, version=1))
-    logger.setLevel(logging.INFO)
+    logger = create_logger(args)
+    config = None
+    if args.config:
+        config = engine.load_config(args.config)
+        # top level settings of the config apply to all pools
+        args = argparse.Namespace(**dict(vars(args), **dict(
+            (key, value) for key, value in config.items() if key != 'pools'
+        )))
+    shaper = throttle.Shaper(
+        rate=args.bandwidth * 1024 * 1024,
+        per_host=args.bandwidth_per_host * 1024 * 1024,
+        per_sr=args.bandwidth_per_sr * 1024 * 1024,
+        per_destination=args.bandwidth_per_destination * 1024 * 1024,
+        schedule=throttle.Schedule(args.bandwidth_schedule) if args.bandwidth_schedule else None,
+        adaptive=args.adaptive_throttle,
+        logger=logger,
+    )
+    run_metrics = metrics.RunMetrics()
+    profiler = metrics.SamplingProfiler() if args.profile else None
+    pool_backup = functools.partial(backup_pool, run_metrics=run_metrics, profiler=profiler)
+    try:
+        if not config:
+            pool_backup(args, logger, shaper=shaper)
+            return
+        multi_pool = engine.MultiPoolEngine(
+            backup_pool=pool_backup,
+            logger=logger,
+            max_parallel=args.max_parallel,
+            shaper=shaper,
+        )
+        results = multi_pool.run([
+            argparse.Namespace(**dict(vars(args), **pool))
+            for pool in config['pools']
+        ])
+        if any(pool_results is None for pool_results in results.values()):
+            # a pool failed before its VMs could be backed up, as a single pool run would
+            sys.exit(1)
+    finally:
+        write_metrics(args, logger, run_metrics, profiler)
+
+def write_metrics(args, logger, run_metrics, profiler=None):
+    '''
+    Writes the report, metrics and profile asked for on the command line.
+    A failure is logged, it does not fail the run.
+    '''
+    run_metrics.finish()
+    outputs = [
+        (args.report, run_metrics.write_report),
+        (args.prometheus_textfile, run_metrics.write_textfile),
+        (args.pushgateway, run_metrics.push),
+        (args.profile, profiler.write if profiler else None),
+    ]
+    for target, write in outputs:
+        if not target:
+            continue
+        try:
+            write(target)
+        except Exception, e:
+            logger.exception('Failed to write metrics to {}'.format(target), extra={
+                'error': str(e),
+            })
+
+def verify_main(argv):
+    '''
+    xenbackup verify: reads the stored archives again and compares them
+    with their integrity manifests.
+    '''
+    parser = argparse.ArgumentParser(prog='xenbackup verify')
+    parser.add_argument('--path', help='backup directory or s3://bucket/prefix', required=True, type=str)
+    parser.add_argument('--vms', help='a comma separated list of virtual machines to verify', default=None, type=str)
+
+    parser.add_argument('--parallel', help='number of archives to verify at the same time', default=4, type=int)
+    parser.add_argument('--s3_endpoint', help='endpoint url of an S3 compatible store, AWS if not set', default=None, type=str)
+    parser.add_argument('--logstash_host', help='ip/hostname of the syslog server', default='127.0.0.1', type=str)
+    parser.add_argument('--logstash_port', help='port of the syslog server', default=5959, type=int)
+    args = parser.parse_args(argv)
+    logger = create_logger(args)
+
+    backend = storage.open_storage(args.path, endpoint_url=args.s3_endpoint)
+    chunk_store = None
+    if not backend.remote and os.path.exists(os.path.join(args.path, '.chunks')):
+        chunk_store = dedup.ChunkStore(os.path.join(args.path, '.chunks'))
+    started = time.time()
+    results = integrity.verify_all(
+        backend,
+        logger,
+        parallel=args.parallel,
+        chunk_store=chunk_store,
+        names=args.vms.lower().split(',') if args.vms else None,
+    )
+    failed = [location for location, error in results if error]
+    logger.info('Verified {} archives in {:.0f} seconds: {} intact, {} failed'.format(
+        len(results),
+        time.time() - started,
+        len(results) - len(failed),
+        len(failed),
+    ), extra={
+        'verified': len(results),
+        'failed': len(failed),
+    })
+    if failed:
+        sys.exit(1)
+
+def open_catalog(args, backend):
+    '''
+    :returns: `catalog.BackupCatalog`
+        the catalog of the backups in `args.path`, None if there is none
+    '''
+    state_path = args.state_path
+    if not state_path:
+        state_path = os.path.expanduser('~/.xenbackup') if backend.remote else args.path
+    if not os.path.exists(os.path.join(state_path, catalog.BackupCatalog.filename)):
+        return None
+    return catalog.BackupCatalog(state_path)
+
+def list_main(argv):
+    '''
+    xenbackup list: lists the backups recorded in the catalog.
+    '''
+    parser = argparse.ArgumentParser(prog='xenbackup list')
+    parser.add_argument('--path', help='backup directory or s3://bucket/prefix', required=True, type=str)
+    parser.add_argument('--vms', help='a comma separated list of virtual machines to list', default=None, type=str)
+    parser.add_argument('--state_path', help='directory of the state file and catalog, path by default, ~/.xenbackup for s3 paths', default=None, type=str)
+    parser.add_argument('--s3_endpoint', help='endpoint url of an S3 compatible store, AWS if not set', default=None, type=str)
+    parser.add_argument('--logstash_host', help='ip/hostname of the syslog server', default='127.0.0.1', type=str)
+    parser.add_argument('--logstash_port', help='port of the syslog server', default=5959, type=int)
+    args = parser.parse_args(argv)
+    logger = create_logger(args)
+
+    backup_catalog = open_catalog(args, storage.open_storage(args.path, endpoint_url=args.s3_endpoint))
+    if backup_catalog is None:
+        parser.error('There is no catalog of {}'.format(args.path))
+    destination = catalog.destination(args.path)
+    if args.vms:
+        backups = [b for name in args.vms.split(',') for b in backup_catalog.backups(destination, vm_name=name)]
+    else:
+        backups = backup_catalog.backups(destination)
+    for backup in backups:
+        if backup['kind'] == 'point':
+            what = 'restore point {} ({})'.format(backup['point_id'], 'delta' if backup['parent'] else 'full')
+        else:
+            what = backup['files'][0]['location'] if backup['files'] else 'archive'
+        logger.info('{} {} {:.2f} GiB {}'.format(
+            backup['vm_name'],
+            datetime.fromtimestamp(backup['created']).strftime('%Y-%m-%d %H:%M:%S'),
+            backup['size'] / 1024.0 ** 3,
+            what,
+        ), extra={
+            'vm_name': backup['vm_name'],
+            'vm_uuid': backup['vm_uuid'],
+            'backup_time': backup['created'],
+            'bytes': backup['size'],
+        })
+    logger.info('{} backups of {} VMs, {:.1f} GiB'.format(
+        len(backups),
+        len(set(b['vm_uuid'] for b in backups)),
+        sum(b['size'] for b in backups) / 1024.0 ** 3,
+    ))
+
+def restore_main(argv):
+    '''
+    xenbackup restore: imports the newest backups of VMs into a pool.
+    '''
+    parser = argparse.ArgumentParser(prog='xenbackup restore')
+    parser.add_argument('--path', help='backup directory or s3://bucket/prefix', required=True, type=str)
+    parser.add_argument('--host', help='xenserver host', required=True, type=str)
+    parser.add_argument('--user', help='xenserver user', required=True, type=str)
+    parser.add_argument('--password', help='xenserver password', required=True, type=str)
+    parser.add_argument('--vms', help='a comma separated list of the virtual machines to restore', required=True, type=str)
+    parser.add_argument('--point', help='id of the incremental restore point to restore, the newest backup by default', default=None, type=str)
+    parser.add_argument('--sr', help='a comma separated list of names or uuids of the storage repositories to restore to, the default SR if not set', default=None, type=str)
+    parser.add_argument('--parallel', help='number of VMs to restore at the same time', default=2, type=int)
+    parser.add_argument('--max_per_sr', help='maximum concurrent restores per storage repository (0 = unlimited)', default=1, type=int)
+    parser.add_argument('--preserve', help='keep the MAC addresses of the network interfaces', action='store_true')
+    parser.add_argument('--disk_streams', help='number of disks of a VM imported at the same time from incremental and split backups', default=4, type=int)
+    parser.add_argument('--state_path', help='directory of the state file and catalog, path by default, ~/.xenbackup for s3 paths', default=None, type=str)
+    parser.add_argument('--s3_endpoint', help='endpoint url of an S3 compatible store, AWS if not set', default=None, type=str)
+    parser.add_argument('--logstash_host', help='ip/hostname of the syslog server', default='127.0.0.1', type=str)
+    parser.add_argument('--logstash_port', help='port of the syslog server', default=5959, type=int)
+    args = parser.parse_args(argv)
+    logger = create_logger(args)
+
+    backend = storage.open_storage(args.path, endpoint_url=args.s3_endpoint)
+    chunk_store = None
+    if not backend.remote and os.path.exists(os.path.join(args.path, '.chunks')):
+        chunk_store = dedup.ChunkStore(os.path.join(args.path, '.chunks'))
+    names = args.vms.split(',')
+    if args.point and len(names) > 1:
+        parser.error('--point needs a single VM')
+    try:
+        backup_catalog = open_catalog(args, backend)
+        jobs = [
+            restore.find_backup(backend, name, args.point, backup_catalog, catalog.destination(args.path))
+            for name in names
+        ]
+    except restore.RestoreError as e:
+        parser.error(str(e))
+    transport = XenAPI.PooledTransport(size=args.parallel * max(1, args.disk_streams) + 1)
+    xenbackup = XenBackup(args.host, args.user, args.password, logger=logger, transport=transport, checksum=None)
+    all_srs = xenbackup.metadata.all('SR')
+    if args.sr:
+        srs = []
+        for sr in args.sr.split(','):
+            matches = [ref for ref, record in all_srs.items() if sr in (record['uuid'], record['name_label'])]
+            if len(matches) != 1:
+                parser.error('{} SRs match {}'.format(len(matches), sr))
+            srs.append(matches[0])
+    else:
+        pool = xenbackup.session.xenapi.pool.get_all()[0]
+        srs = [xenbackup.session.xenapi.pool.get_default_SR(pool)]
+    started = time.time()
+    results = restore.restore_all(
+        jobs,
+        lambda: restore.Restorer(
+            XenBackup(xenbackup.server, args.user, args.password, logger=logger, transport=transport,
+                      metadata=xenbackup.metadata, checksum=None),
+            backend,
+            chunk_store=chunk_store,
+            preserve=args.preserve,
+            disk_streams=args.disk_streams,
+        ),
+        srs,
+        workers=args.parallel,
+        max_per_sr=args.max_per_sr,
+        logger=logger,
+    )
+    xenbackup.logout()
+    transport.close()
+    failed = [r for r in results if r['status'] != 'success']
+    for r in failed:
+        logger.error('Restore of {} failed: {}'.format(r['vm_name'], r['error']), extra={
+            'host': xenbackup.server,
+            'vm_name': r['vm_name'],
+        })
+    restored = sum(r['bytes'] for r in results)
+    logger.info('Restore finished: {} succeeded, {} failed, {:.1f} GiB in {:.0f} seconds'.format(
+        len(results) - len(failed),
+        len(failed),
+        restored / 1024.0 ** 3,
+        time.time() - started,
+    ), extra={
+        'host': xenbackup.server,
+        'succeeded': len(results) - len(failed),
+        'failed': len(failed),
+        'bytes': restored,
+    })
+    if failed:
+        sys.exit(1)
+
+def backup_pool(args, logger, budget=None, shaper=None, shared=None, run_metrics=None, profiler=None):
+    '''
+    Backs up the VMs of one pool.
+
+    :param args: argparse.Namespace
+        the command line arguments, or a pool of a --config file
+    :param budget: `scheduler.Budget`
+        concurrency budget shared with other pools
+    :param shaper: `throttle.Shaper`
+        bandwidth limits shared with other pools
+    :param shared: callable
+        shared(key, factory) returns the object shared by all pools for
+        `key`, so pools backing up to the same path share its state and
+        chunk store
+    :param run_metrics: `metrics.RunMetrics`
+        gets the timings and results of the pool's VMs
+    :param profiler: `metrics.SamplingProfiler`
+    :returns: list
+        result dicts, see `scheduler.BackupScheduler.run`
+    '''
+    if shared is None:
+        shared = lambda key, factory: factory()
     logger.info('Starting backup of VMs on {} '.format(args.host), extra={
         'host': args.host,
     })
+    xenbackup = None
     try:
-        xenbackup = XenBackup(
-            server=args.host,
+        backend = shared(('storage', args.path), lambda: storage.open_storage(
+            args.path,
+            endpoint_url=args.s3_endpoint,
+            part_size=args.s3_part_size * 1024 * 1024,
+            concurrency=args.s3_concurrency,
+        ))
+        if backend.remote and (args.incremental or args.split_disks or args.dedup):
+            raise Exception('--incremental, --split_disks and --dedup need a local --path')
+        if args.mirror and (args.incremental or args.split_disks or args.dedup):
+            raise Exception('--mirror only copies .xva archives, not --incremental, --split_disks or --dedup backups')
+        mirrors = [(mirror, shared(('storage', mirror), lambda mirror=mirror: storage.open_storage(
+            mirror,
+            endpoint_url=args.s3_endpoint,
+            part_size=args.s3_part_size * 1024 * 1024,
+            concurrency=args.s3_concurrency,
+        ))) for mirror in args.mirror or []]
+        s3_backends = [b for b in [backend] + [m for _, m in mirrors] if isinstance(b, storage.S3Storage)]
+        part_size = args.s3_part_size * 1024 * 1024
+        if s3_backends and not storage.S3_MIN_PART_SIZE <= part_size <= storage.S3_MAX_PART_SIZE:
+            raise Exception('--s3_part_size must be between {} and {} MiB'.format(
+                storage.S3_MIN_PART_SIZE // 1024 ** 2,
+                storage.S3_MAX_PART_SIZE // 1024 ** 2,
+            ))
+        state_path = args.state_path
+        if not state_path:
+            state_path = os.path.expanduser('~/.xenbackup') if backend.remote else args.path
+        if not os.path.exists(state_path):
+            os.makedirs(state_path)
+        backup_state = shared(('state', state_path), lambda: state.BackupState(state_path))
+        backup_catalog = None
+        retention = catalog.Retention(
+            last=args.rotate_num,
+            daily=args.keep_daily,
+            weekly=args.keep_weekly,
+            monthly=args.keep_monthly,
+            yearly=args.keep_yearly,
+        )
+        if not args.no_catalog:
+            backup_catalog = shared(('catalog', state_path), lambda: catalog.BackupCatalog(state_path))
+        elif args.keep_daily or args.keep_weekly or args.keep_monthly or args.keep_yearly:
+            raise Exception('--keep_daily, --keep_weekly, --keep_monthly and --keep_yearly need the catalog')
+        # the workers, the snapshotter, the metadata cache and the task watcher
+        # share the connections
+        transport = XenAPI.PooledTransport(size=args.parallel + 3)
+        chunk_store = None
+        if args.dedup:
+            chunk_store = shared(('chunks', args.path), lambda: dedup.ChunkStore(
+                os.path.join(args.path, '.chunks'),
+                compression=args.compression,
+                compression_level=args.compression_level,
+            ))
+        backup_kwargs = dict(
             user=args.user,
             password=args.password,
             logger=logger,
             rotate=args.rotate,
             rotate_num=args.rotate_num,
+            compression=args.compression,
+            compression_level=args.compression_level,
+            compression_mode=args.compression_mode,
+            server_compression=args.server_compression,
+            state=backup_state,
+            buffer_size=args.buffer_size * 1024 * 1024,
+            direct_io=args.direct_io,
+            drop_cache=args.drop_cache,
+            sparse=args.sparse,
+            incremental=args.incremental,
+            full_every=args.full_every,
+            chunk_store=chunk_store,
+            transport=transport,
+            shaper=shaper,
+            storage=backend,
+            run_metrics=run_metrics,
+            profiler=profiler,
+            checksum=args.checksum if args.checksum != 'none' else None,
+            validate=not args.no_validate,
+            backup_catalog=backup_catalog,
+            retention=retention,
+            split_disks=args.split_disks,
+            disk_streams=args.disk_streams,
+            mirrors=mirrors,
+            mirror_policy=args.mirror_policy,
+            mirror_buffer=args.mirror_buffer * 1024 * 1024,
         )
+        xenbackup = XenBackup(server=args.host, **backup_kwargs)
         backup_vms = []
         if args.vms:
             backup_vms = args.vms.lower().split(',')
         vms = xenbackup.get_vms()
-        for vm in vms:
-            if (vms[vm]['name_label'].lower() in backup_vms) or not backup_vms:
-                xenbackup.download_vm(
-                    opaque_ref=vm,
-                    vm_info=vms[vm],
-                    path=args.path,
-                    retry_max=args.retry_max,
-                    retry_delay=args.retry_delay,
-                )
+        jobs = xenbackup.get_jobs(vms, backup_vms)
+        backup_planner = planner.BackupPlanner(
+            xenbackup,
+            state=backup_state,
+            skip_unchanged=args.skip_unchanged,
+            max_skip_age=args.max_skip_days * 86400,
+        )
+        jobs, skipped = backup_planner.plan(jobs)
+        if s3_backends and jobs:
+            largest = max(jobs, key=lambda job: xenbackup.get_export_size(job['vm_info']))
+            if xenbackup.get_export_size(largest['vm_info']) > storage.max_object_size(part_size):
+                raise Exception('The export of {} does not fit in an S3 object with --s3_part_size {}'.format(
+                    largest['vm_info']['name_label'],
+                    args.s3_part_size,
+                ))
+        for job in skipped:
+            logger.info('Skipping {}, it did not change since its last backup'.format(
+                job['vm_info']['name_label'],
+            ), extra={
+                'host': xenbackup.server,
+                'vm_name': job['vm_info']['name_label'],
+                'vm_uuid': job['vm_info']['uuid'],
+            })
+        window = planner.predict(jobs, args.parallel, args.max_per_host, args.max_per_sr)
+        logger.info('Planned {} VMs, {:.1f} GiB, skipped {} unchanged VMs, predicted backup window {}'.format(
+            len(jobs),
+            sum(job['size'] for job in jobs) / 1024.0 ** 3,
+            len(skipped),
+            '{:.0f} seconds'.format(window) if window is not None else 'unknown',
+        ), extra={
+            'host': xenbackup.server,
+            'planned': len(jobs),
+            'skipped': len(skipped),
+            'predicted_seconds': window,
+        })
+        if args.plan:
+            for job in jobs:
+                logger.info('{} {:.1f} GiB, {}'.format(
+                    job['vm_info']['name_label'],
+                    job['size'] / 1024.0 ** 3,
+                    '{:.0f} seconds'.format(job['estimate']) if job['estimate'] is not None else 'no history',
+                ), extra={
+                    'host': xenbackup.server,
+                    'vm_name': job['vm_info']['name_label'],
+                    'vm_uuid': job['vm_info']['uuid'],
+                })
+            xenbackup.logout()
+            transport.close()
+            return []
+        started = time.time()
+        # the workers make their XenAPI calls on this session through the
+        # shared cache and watcher, so one event.from loop follows every
+        # task; it is logged out after the last background delete
+        backup_scheduler = scheduler.BackupScheduler(
+            backup_factory=lambda: XenBackup(
+                server=xenbackup.server,
+                metadata=xenbackup.metadata,
+                task_watcher=xenbackup.task_watcher,
+                **backup_kwargs
+            ),
+            workers=args.parallel,
+            max_per_host=args.max_per_host,
+            max_per_sr=args.max_per_sr,
+            lookahead=args.snapshot_lookahead,
+            logger=logger,
+            budget=budget,
+            path=args.path,
+            retry_max=args.retry_max,
+            retry_delay=args.retry_delay,
+        )
+        try:
+            results = backup_scheduler.run(jobs)
+        finally:
+            # the snapshots still being deleted in the background
+            xenbackup.task_watcher.drain()
+        backup_planner.record(jobs, results)
+        scheduler.summarize(results, logger, xenbackup.server)
+        if window is not None:
+            logger.info('Backup window {:.0f} seconds, predicted {:.0f} seconds'.format(
+                time.time() - started,
+                window,
+            ), extra={
+                'host': xenbackup.server,
+                'seconds': time.time() - started,
+                'predicted_seconds': window,
+            })
+        if run_metrics:
+            run_metrics.record_results(xenbackup.server, results)
+        xenbackup.logout()
+        transport.close()
+        stats = transport.stats()
+        logger.info('{} XenAPI requests, {:.3f}s average, {:.3f}s max, {} connections opened, {} reconnects'.format(
+            stats['requests'],
+            stats['seconds'] / stats['requests'] if stats['requests'] else 0,
+            stats['max_seconds'],
+            stats['connects'],
+            stats['reconnects'],
+        ), extra=dict(stats, host=xenbackup.server))
+        return results
     except Exception, e:
+        # the pool master the session was redirected to, as for the results
+        host = xenbackup.server if xenbackup else args.host
         logger.exception('Error occurred when trying to backup VMS from {}'.format(
-            args.host
+            host
         ))
+        if run_metrics:
+            run_metrics.record_results(host, None)
         raise
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
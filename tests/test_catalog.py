@@ -0,0 +1,145 @@
+import logging
+import shutil
+import tempfile
+import time
+import unittest
+
+import catalog
+import storage
+
+try:
+    import boto3
+    from moto import mock_s3
+except ImportError:
+    boto3 = mock_s3 = None
+
+DAY = 24 * 60 * 60
+
+
+def noon(days_ago):
+    # the retention buckets are in local time
+    t = time.localtime(time.time() - days_ago * DAY)
+    return time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 12, 0, 0, 0, 0, -1))
+
+
+def date(year, month, day):
+    return time.mktime((year, month, day, 12, 0, 0, 0, 0, -1))
+
+
+class ExpiredTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.catalog = catalog.BackupCatalog(self.path)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.path)
+
+    def add(self, created, point_id=None, parent=None, kind='archive'):
+        return self.catalog.add('/backups', 'uuid', 'vm', kind, [{
+            'location': '/backups/vm/{}'.format(created),
+            'size': 1,
+        }], created=created, point_id=point_id, parent=parent)
+
+    def expired(self, retention, kind='archive'):
+        return sorted(b['id'] for b in self.catalog.expired('/backups', 'uuid', kind, retention))
+
+    def test_last(self):
+        ids = [self.add(noon(10 - i)) for i in range(5)]
+        self.assertEqual(self.expired(catalog.Retention(last=2)), ids[:3])
+
+    def test_keeps_all(self):
+        for i in range(5):
+            self.add(noon(i))
+        self.assertEqual(self.expired(catalog.Retention(last=0)), [])
+
+    def test_daily(self):
+        # two backups a day for five days, the newest of the three newest days stay
+        ids = {}
+        for days_ago in range(5):
+            ids[days_ago] = [self.add(noon(days_ago) - 3600), self.add(noon(days_ago))]
+        kept = [ids[days_ago][1] for days_ago in range(3)]
+        everything = sorted(i for pair in ids.values() for i in pair)
+        self.assertEqual(self.expired(catalog.Retention(last=0, daily=3)),
+                         [i for i in everything if i not in kept])
+
+    def test_grandfather_father_son(self):
+        created = [noon(days_ago) for days_ago in range(400, -1, -1)]
+        ids = dict((self.add(c), c) for c in created)
+        retention = catalog.Retention(last=2, daily=7, weekly=4, monthly=6, yearly=2)
+        kept = set(ids) - set(self.expired(retention))
+        newest = sorted(ids, key=ids.get, reverse=True)
+        # the last and daily ones overlap
+        for backup_id in newest[:7]:
+            self.assertTrue(backup_id in kept)
+        months = set(time.strftime('%Y-%m', time.localtime(ids[i])) for i in kept)
+        self.assertTrue(len(months) >= 6)
+        years = set(time.strftime('%Y', time.localtime(ids[i])) for i in kept)
+        self.assertEqual(len(years), 2)
+        # at most one per bucket, a backup kept for several reasons counts once
+        self.assertTrue(len(kept) <= 2 + 7 + 4 + 6 + 2)
+
+    def test_weeks_across_new_year(self):
+        self.assertEqual(catalog.bucket(date(2026, 12, 31), catalog.ISO_WEEK), '2026-53')
+        self.assertEqual(catalog.bucket(date(2027, 1, 3), catalog.ISO_WEEK), '2026-53')
+        self.assertEqual(catalog.bucket(date(2027, 1, 4), catalog.ISO_WEEK), '2027-01')
+        # Thursday and Saturday of the week of new year are one week
+        week52, thursday, saturday, week1 = [self.add(date(*d)) for d in [
+            (2026, 12, 21), (2026, 12, 31), (2027, 1, 2), (2027, 1, 4),
+        ]]
+        self.assertEqual(self.expired(catalog.Retention(last=0, weekly=3)), [thursday])
+
+    def test_keeps_parents_of_kept_deltas(self):
+        full = self.add(noon(5), 'p0', kind='point')
+        deltas = [full]
+        for i in range(1, 4):
+            deltas.append(self.add(noon(5 - i), 'p{}'.format(i), 'p{}'.format(i - 1), kind='point'))
+        # only the newest is kept, it needs every point before it
+        self.assertEqual(self.expired(catalog.Retention(last=1), 'point'), [])
+        new_full = self.add(noon(1), 'p4', kind='point')
+        delta = self.add(noon(0), 'p5', 'p4', kind='point')
+        self.assertEqual(self.expired(catalog.Retention(last=1), 'point'), deltas)
+        self.assertEqual(self.expired(catalog.Retention(last=2), 'point'), deltas)
+        self.assertEqual(self.expired(catalog.Retention(last=3), 'point'), [])
+
+
+@unittest.skipIf(mock_s3 is None, 'moto is not installed')
+class ImportTest(unittest.TestCase):
+
+    def setUp(self):
+        import xenbackup
+        self.mock = mock_s3()
+        self.mock.start()
+        client = boto3.client('s3', region_name='us-east-1',
+                              aws_access_key_id='test', aws_secret_access_key='test')
+        client.create_bucket(Bucket='backups')
+        self.storage = storage.S3Storage('backups', prefix='xen', client=client)
+        self.path = tempfile.mkdtemp()
+        self.catalog = catalog.BackupCatalog(self.path)
+        # no session needed to catalog
+        self.backup = xenbackup.XenBackup.__new__(xenbackup.XenBackup)
+        self.backup.catalog = self.catalog
+        self.backup.server = 'xenserver'
+        self.backup.logger = logging.getLogger('test')
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.path)
+        self.mock.stop()
+
+    def test_new_object_is_not_imported(self):
+        earlier = 'xen/vm/vm-uuid.2026-01-01-120000.xva'
+        location = 'xen/vm/vm-uuid.2026-01-02-120000.xva'
+        self.storage.put(earlier, 'old')
+        self.storage.put(location, 'new')
+        vm_info = {'uuid': 'uuid', 'name_label': 'vm'}
+        self.assertTrue(self.backup.catalog_backup(vm_info, 'archive', 's3://backups/xen', self.storage, [
+            catalog.file_info(self.storage, location),
+        ]))
+        backups = self.catalog.backups('s3://backups/xen')
+        self.assertEqual([[f['location'] for f in b['files']] for b in backups], [[earlier], [location]])
+
+
+if __name__ == '__main__':
+    unittest.main()
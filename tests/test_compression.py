@@ -0,0 +1,122 @@
+import os
+import unittest
+from StringIO import StringIO
+
+import compression
+
+MB = 1024 * 1024
+
+
+def available():
+    names = ['gzip']
+    if compression.zstandard is not None:
+        names.append('zstd')
+    if compression.lz4 is not None:
+        names.append('lz4')
+    return names
+
+
+class Sink(object):
+
+    def __init__(self, fail=False):
+        self.pieces = []
+        self.fail = fail
+        self.closed = False
+        self.aborted = False
+
+    def write(self, data):
+        if self.fail:
+            raise IOError('disk full')
+        self.pieces.append(bytes(data))
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+    def getvalue(self):
+        return b''.join(self.pieces)
+
+
+class CompressingWriterTest(unittest.TestCase):
+
+    def compress(self, name, data, threaded):
+        sink = Sink()
+        writer = compression.CompressingWriter(sink, compression.get_compressor(name), threaded=threaded)
+        # the caller reuses its buffer, as transfer.copy() does
+        buf = bytearray(64 * 1024)
+        view = memoryview(buf)
+        for i in range(0, len(data), len(buf)):
+            piece = data[i:i + len(buf)]
+            buf[:len(piece)] = piece
+            writer.write(view[:len(piece)])
+        writer.close()
+        self.assertTrue(sink.closed)
+        return sink.getvalue()
+
+    def test_round_trip(self):
+        data = os.urandom(MB) + b'\0' * MB
+        for name in available():
+            for threaded in (True, False):
+                compressed = self.compress(name, data, threaded)
+                self.assertEqual(compression.detect(compressed[:4]), name)
+                self.assertEqual(compression.decompress(name, compressed), data)
+
+    def test_error_surfaces(self):
+        sink = Sink(fail=True)
+        writer = compression.CompressingWriter(sink, compression.get_compressor('gzip'))
+        data = os.urandom(MB)
+
+        def write():
+            # the error of the thread comes out of a later write or of close
+            for i in range(20):
+                writer.write(data)
+            writer.close()
+
+        self.assertRaises(IOError, write)
+        writer.abort()
+        self.assertTrue(sink.aborted)
+
+    def test_abort(self):
+        sink = Sink()
+        writer = compression.CompressingWriter(sink, compression.get_compressor('gzip'))
+        writer.write(b'data')
+        writer.abort()
+        self.assertTrue(sink.aborted)
+        self.assertFalse(writer.thread.is_alive())
+
+
+class DecompressorTest(unittest.TestCase):
+
+    def compressed(self, name, data):
+        compressor = compression.get_compressor(name)
+        return compressor.compress(data) + compressor.flush()
+
+    def test_bounded_output(self):
+        # a thousandfold compression must not come out in one piece
+        data = b'\0' * (20 * MB)
+        for name in available():
+            pieces = []
+            compressed = self.compressed(name, data)
+            decompressor = compression.Decompressor(name)
+            for i in range(0, len(compressed), 1000):
+                decompressor.decompress_to(compressed[i:i + 1000], pieces.append, MB)
+            self.assertTrue(max(len(p) for p in pieces) <= MB, name)
+            self.assertEqual(b''.join(pieces), data, name)
+
+    def test_iter_decompressed(self):
+        data = os.urandom(MB) + b'\0' * (10 * MB)
+        for name in available():
+            pieces = list(compression.iter_decompressed(name, StringIO(self.compressed(name, data)), MB))
+            self.assertTrue(max(len(p) for p in pieces) <= MB, name)
+            self.assertEqual(b''.join(pieces), data, name)
+
+    def test_detect(self):
+        self.assertEqual(compression.detect(b'xva\0'), None)
+        self.assertEqual(compression.suffix('zstd'), '.xva.zst')
+        self.assertEqual(compression.suffix(None, '.vhd'), '.vhd')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import hashlib
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import dedup
+
+
+class PythonChunker(dedup.Chunker):
+    # the plain Python loop whether numpy is installed or not
+    _find = dedup.Chunker._find_python
+
+
+def random_bytes(size, seed):
+    rng = random.Random(seed)
+    return bytearray(rng.getrandbits(8) for _ in xrange(size))
+
+
+def chunk(chunker, data, piece):
+    chunks = []
+    for i in xrange(0, len(data), piece):
+        chunks.extend(chunker.feed(data[i:i + piece]))
+    return chunks + chunker.finish()
+
+
+class ChunkerTest(unittest.TestCase):
+
+    sizes = dict(min_size=1024, avg_size=4096, max_size=16384)
+
+    def setUp(self):
+        self.data = random_bytes(200 * 1024, 1)
+
+    def test_boundaries(self):
+        chunks = chunk(PythonChunker(**self.sizes), self.data, 10000)
+        self.assertEqual(b''.join(chunks), bytes(self.data))
+        self.assertTrue(len(chunks) > 10)
+        for c in chunks[:-1]:
+            self.assertTrue(self.sizes['min_size'] <= len(c) <= self.sizes['max_size'])
+
+    def test_max_size(self):
+        # no cut point in runs of zeros, the chunks end at max_size
+        chunks = chunk(PythonChunker(**self.sizes), bytearray(100000), 7000)
+        self.assertEqual([len(c) for c in chunks[:-1]], [self.sizes['max_size']] * (len(chunks) - 1))
+
+    def test_independent_of_writes(self):
+        expected = chunk(PythonChunker(**self.sizes), self.data, len(self.data))
+        for piece in (1000, 4096, 65536):
+            self.assertEqual(chunk(PythonChunker(**self.sizes), self.data, piece), expected)
+
+    def test_resynchronizes(self):
+        # inserting data at the start only changes the first chunks
+        chunks = chunk(PythonChunker(**self.sizes), self.data, 10000)
+        shifted = chunk(PythonChunker(**self.sizes), random_bytes(3000, 2) + self.data, 10000)
+        self.assertTrue(len(set(chunks) & set(shifted)) >= len(chunks) - 2)
+
+    @unittest.skipIf(dedup.numpy is None, 'numpy is not installed')
+    def test_numpy_matches_python(self):
+        for sizes in (self.sizes, dict(min_size=512 * 1024, avg_size=1024 * 1024, max_size=4 * 1024 * 1024)):
+            data = self.data * (1 if sizes is self.sizes else 40)
+            expected = [len(c) for c in chunk(PythonChunker(**sizes), data, 65536)]
+            self.assertEqual([len(c) for c in chunk(dedup.Chunker(**sizes), data, 65536)], expected)
+
+
+
+class ChunkStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = dedup.ChunkStore(os.path.join(self.path, 'chunks'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.path)
+
+    def refs(self, digest):
+        with self.store.lock:
+            return self.store.db.execute('SELECT refs FROM chunks WHERE hash = ?', (buffer(digest),)).fetchone()[0]
+
+    def test_concurrent_put_counts_new_once(self):
+        data = 'chunk' * 1000
+        digest = hashlib.sha256(data).digest()
+        results = []
+        arrived = []
+        both = threading.Event()
+        rename = os.rename
+
+        def racing_rename(src, dst):
+            # both workers found the chunk missing before either indexed it
+            arrived.append(src)
+            if len(arrived) == 2:
+                both.set()
+            both.wait(5)
+            rename(src, dst)
+
+        threads = [threading.Thread(target=lambda: results.append(self.store.put(digest, data))) for i in range(2)]
+        dedup.os.rename = racing_rename
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            dedup.os.rename = rename
+        self.assertTrue(both.is_set())
+        self.assertEqual(sorted(results), [False, True])
+        self.assertEqual(self.refs(digest), 2)
+
+    def test_manifest_release(self):
+        chunks = [str(i) * 100 for i in range(10)]
+        # more digests than one read, with repeated chunks spread over several batches
+        stream = [chunks[i % len(chunks)] for i in range(dedup.DIGEST_BATCH * 2 + 5)]
+        manifest = os.path.join(self.path, 'vm.xva.manifest')
+        writer = dedup.DedupWriter(manifest, self.store)
+        for c in stream:
+            writer._store([c])
+        writer.close()
+        self.assertEqual(writer.new_chunks, len(chunks))
+        info, digests = dedup.read_manifest(manifest)
+        self.assertEqual(info['chunks'], len(stream))
+        # the digests are read from the open file, even once it is deleted
+        os.remove(manifest)
+        self.assertEqual(self.store.release(digests), len(chunks))
+        self.assertEqual([d for d, _, files in os.walk(self.store.path) if files and d != self.store.path], [])
+
+    def test_release_keeps_referenced_chunks(self):
+        kept = hashlib.sha256('kept').digest()
+        released = hashlib.sha256('released').digest()
+        self.store.put(kept, 'kept')
+        self.store.put(kept, 'kept')
+        self.store.put(released, 'released')
+        self.assertEqual(self.store.release(iter([kept, released])), 1)
+        self.assertEqual(self.refs(kept), 1)
+        self.assertEqual(self.store.read(kept), 'kept')
+
+    def test_commits_every_batch(self):
+        batch = dedup.DIGEST_BATCH
+        dedup.DIGEST_BATCH = 10
+        try:
+            for i in range(10):
+                self.store.put(hashlib.sha256(str(i)).digest(), str(i))
+        finally:
+            dedup.DIGEST_BATCH = batch
+        # what a crash now would leave behind
+        db = sqlite3.connect(os.path.join(self.store.path, 'index.sqlite'))
+        try:
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM chunks').fetchone()[0], 10)
+        finally:
+            db.close()
+
+    def test_deletes_outside_the_lock(self):
+        data = 'released' * 100
+        digest = hashlib.sha256(data).digest()
+        self.store.put(digest, data)
+        results = []
+        remove = os.remove
+        put = threading.Thread(target=lambda: results.append(self.store.put(digest, data)))
+
+        def locked_remove(path):
+            self.assertTrue(self.store.lock.acquire(False))
+            self.store.lock.release()
+            # a worker storing the chunk again waits for its file to be gone
+            put.start()
+            put.join(0.2)
+            self.assertTrue(put.is_alive())
+            remove(path)
+
+        dedup.os.remove = locked_remove
+        try:
+            self.assertEqual(self.store.release([digest]), 1)
+        finally:
+            dedup.os.remove = remove
+        put.join(5)
+        self.assertEqual(results, [True])
+        self.assertEqual(self.refs(digest), 1)
+        self.assertEqual(self.store.read(digest), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
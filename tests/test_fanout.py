@@ -0,0 +1,96 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+import fanout
+
+
+class Writer(object):
+
+    def __init__(self, gate=None, fail=False):
+        self.gate = gate
+        self.fail = fail
+        self.data = []
+        self.closed = False
+        self.aborted = False
+
+    def write(self, data):
+        if self.gate:
+            self.gate.wait()
+        if self.fail:
+            raise IOError('disk full')
+        self.data.append(data)
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+class MirrorSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+        rng = random.Random(1)
+        self.pieces = [''.join(chr(rng.getrandbits(8)) for _ in range(rng.randint(1, 3000))) for _ in range(200)]
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def test_spill_keeps_the_order(self):
+        gate = threading.Event()
+        writer = Writer(gate)
+        sink = fanout.MirrorSink('mirror', writer, buffer_size=4096, policy='spill', spill_dir=self.spill_dir)
+        for i, piece in enumerate(self.pieces):
+            sink.write(piece)
+            if i == 150:
+                # the mirror catches up while the rest still goes through the spill file
+                gate.set()
+        sink.close()
+        self.assertEqual(sink.error, None)
+        self.assertTrue(sink.spilled > 0)
+        self.assertTrue(writer.closed)
+        self.assertEqual(''.join(writer.data), ''.join(self.pieces))
+        self.assertEqual(sink.bytes, sum(len(p) for p in self.pieces))
+        # the spill file is gone with its handles
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_block(self):
+        writer = Writer()
+        sink = fanout.MirrorSink('mirror', writer, buffer_size=4096, policy='block')
+        for piece in self.pieces:
+            sink.write(piece)
+        sink.close()
+        self.assertEqual(sink.spilled, 0)
+        self.assertEqual(''.join(writer.data), ''.join(self.pieces))
+
+    def test_drop(self):
+        writer = Writer(threading.Event())
+        sink = fanout.MirrorSink('mirror', writer, buffer_size=4096, policy='drop', drop_timeout=0.2)
+        for piece in self.pieces:
+            sink.write(piece)
+        self.assertTrue(isinstance(sink.error, fanout.SlowMirror))
+        writer.gate.set()
+        sink.close()
+        self.assertTrue(writer.aborted)
+        self.assertFalse(writer.closed)
+
+    def test_failed_mirror_does_not_fail_the_stream(self):
+        primary = Writer()
+        mirror = Writer(fail=True)
+        stream = fanout.FanOutWriter(primary, [fanout.MirrorSink('mirror', mirror)])
+        for piece in self.pieces:
+            stream.write(piece)
+        stream.close()
+        self.assertTrue(primary.closed)
+        self.assertTrue(isinstance(stream.mirrors[0].error, IOError))
+        self.assertTrue(mirror.aborted)
+        self.assertEqual(''.join(primary.data), ''.join(self.pieces))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import gzip
+import hashlib
+import os
+import tarfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import integrity
+
+CHUNK = 64 * 1024
+
+
+def member(name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    return info.tobuf(tarfile.USTAR_FORMAT) + data + b'\0' * (-len(data) % integrity.TAR_BLOCK)
+
+
+def base256(header):
+    '''
+    Rewrites the size of a tar header in base-256, as GNU tar does from
+    8 GiB on.
+    '''
+    size = integrity._tar_number(header[124:136])
+    field = bytearray(12)
+    field[0] = 0x80
+    for i in range(11, 0, -1):
+        field[i] = size & 0xff
+        size >>= 8
+    header = header[:124] + bytes(field) + header[136:]
+    checksum = integrity._tar_checksum(header)
+    return header[:148] + '{:06o}\0 '.format(checksum) + header[156:]
+
+
+def xva(chunks=3, corrupt=None, sizes=None):
+    '''
+    :param corrupt: int
+        number of the chunk whose checksum does not match
+    :param sizes: callable
+        rewrites the headers of the chunks
+    '''
+    parts = [member('ova.xml', b'<value><struct/></value>')]
+    for i in range(chunks):
+        data = os.urandom(CHUNK)
+        name = 'Ref:12/{:08d}'.format(i)
+        chunk = member(name, data)
+        if sizes:
+            chunk = sizes(chunk[:integrity.TAR_BLOCK]) + chunk[integrity.TAR_BLOCK:]
+        digest = hashlib.sha1(data if i != corrupt else data[1:]).hexdigest()
+        parts += [chunk, member(name + '.checksum', digest)]
+    return b''.join(parts) + b'\0' * 2 * integrity.TAR_BLOCK
+
+
+class XVAValidatorTest(unittest.TestCase):
+
+    def validate(self, data, received=None, piece=1000):
+        validator = integrity.XVAValidator(received)
+        # in pieces that do not line up with the tar blocks
+        for i in range(0, len(data), piece):
+            validator.update(data[i:i + piece])
+        validator.finish()
+        return validator
+
+    def test_valid(self):
+        data = xva()
+        validator = self.validate(data)
+        self.assertEqual(validator.summary(), {'members': 7, 'chunks': 3, 'verified_chunks': 3})
+        self.assertEqual(validator.size, len(data))
+
+    def test_checksum_mismatch(self):
+        self.assertRaises(integrity.IntegrityError, self.validate, xva(corrupt=1))
+
+    def test_truncated(self):
+        data = xva()
+        self.assertRaises(integrity.IntegrityError, self.validate, data[:len(data) // 2])
+        # without its end of archive blocks
+        self.assertRaises(integrity.IntegrityError, self.validate, data[:-2 * integrity.TAR_BLOCK])
+
+    def test_corrupt_header(self):
+        data = bytearray(xva())
+        # the name in the header of the first chunk
+        data[integrity.TAR_BLOCK * 2 + 10] ^= 0xff
+        self.assertRaises(integrity.IntegrityError, self.validate, bytes(data))
+
+    def test_base256_sizes(self):
+        self.assertEqual(integrity._tar_number(b'\x80' + b'\0' * 6 + b'\x02\x00\x00\x00\x00'), 8 * 1024 ** 3)
+        validator = self.validate(xva(sizes=base256))
+        self.assertEqual(validator.verified, 3)
+
+    def test_compressed(self):
+        data = xva()
+        compressed = StringIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+            f.write(data)
+        validator = self.validate(compressed.getvalue(), 'gzip')
+        self.assertEqual(validator.verified, 3)
+        self.assertEqual(validator.size, len(data))
+
+
+class ChecksumTest(unittest.TestCase):
+
+    def test_checksum(self):
+        checksum = integrity.Checksum('sha256')
+        checksum.update(b'abc')
+        checksum.update(memoryview(b'def'))
+        self.assertEqual(checksum.hexdigest(), hashlib.sha256(b'abcdef').hexdigest())
+        self.assertEqual(checksum.size, 6)
+
+    def test_unknown(self):
+        self.assertRaises(Exception, integrity.Checksum, 'md5')
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(integrity.READ_SIZE + 1000)
+        self.file = tempfile.NamedTemporaryFile()
+        self.file.write(self.data)
+        self.file.flush()
+
+    def tearDown(self):
+        self.file.close()
+
+    def test_replay(self):
+        # a resumed download hashes the part already on disk first
+        checksum = integrity.Checksum('sha256')
+        length = integrity.Length()
+        integrity.replay(self.file.name, integrity.READ_SIZE + 10, [checksum, length])
+        checksum.update(self.data[integrity.READ_SIZE + 10:])
+        self.assertEqual(checksum.hexdigest(), hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(length.size, integrity.READ_SIZE + 10)
+
+    def test_short_file(self):
+        self.assertRaises(integrity.IntegrityError, integrity.replay, self.file.name,
+                          len(self.data) + 1, [integrity.Length()])
+
+
+if __name__ == '__main__':
+    unittest.main()
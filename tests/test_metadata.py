@@ -0,0 +1,118 @@
+import unittest
+
+import XenAPI
+import metadata
+
+
+class FakeClass(object):
+
+    def __init__(self, session, cls):
+        self.session = session
+        self.cls = cls
+
+    def get_all_records(self):
+        self.session.calls.append((self.cls, 'get_all_records'))
+        return dict(self.session.objects[self.cls])
+
+    def get_record(self, opaque_ref):
+        self.session.calls.append((self.cls, 'get_record'))
+        if opaque_ref not in self.session.objects[self.cls]:
+            raise XenAPI.Failure(['HANDLE_INVALID', self.cls, opaque_ref])
+        return self.session.objects[self.cls][opaque_ref]
+
+
+class FakeEvent(object):
+
+    def __init__(self, session):
+        setattr(self, 'from', self._from)
+        self.session = session
+
+    def _from(self, classes, token, timeout):
+        session = self.session
+        session.calls.append(('event', token))
+        if not session.events:
+            raise XenAPI.Failure(['MESSAGE_METHOD_UNKNOWN', 'event.from'])
+        if token == '':
+            events = [{'class': cls.lower(), 'operation': 'add', 'ref': ref, 'snapshot': record}
+                      for cls in classes for ref, record in session.objects[cls].items()]
+        else:
+            events = session.pending
+        session.pending = []
+        return {'events': events, 'token': str(len(session.calls))}
+
+
+class FakeXenAPI(object):
+
+    def __init__(self, session):
+        self.event = FakeEvent(session)
+        for cls in metadata.MetadataCache.classes:
+            setattr(self, cls, FakeClass(session, cls))
+
+
+class FakeSession(object):
+
+    def __init__(self, events=True):
+        self.events = events
+        self.calls = []
+        self.pending = []
+        self.objects = dict((cls, {}) for cls in metadata.MetadataCache.classes)
+        self.objects['VM']['OpaqueRef:1'] = {'uuid': 'a', 'name_label': 'web'}
+        self.xenapi = FakeXenAPI(self)
+
+    def change(self, operation, ref, record=None):
+        if record is None:
+            self.objects['VM'].pop(ref, None)
+        else:
+            self.objects['VM'][ref] = record
+        self.pending.append({'class': 'vm', 'operation': operation, 'ref': ref, 'snapshot': record})
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+    def test_loads_once(self):
+        session = FakeSession()
+        cache = metadata.MetadataCache(session)
+        self.assertEqual(cache.all('VM'), {'OpaqueRef:1': {'uuid': 'a', 'name_label': 'web'}})
+        self.assertEqual(cache.get('VM', 'OpaqueRef:1')['name_label'], 'web')
+        self.assertEqual(cache.find('VM', 'a'), 'OpaqueRef:1')
+        self.assertEqual(session.calls, [('event', '')])
+
+    def test_refresh(self):
+        session = FakeSession()
+        cache = metadata.MetadataCache(session)
+        cache.all('VM')
+        session.change('mod', 'OpaqueRef:1', {'uuid': 'a', 'name_label': 'db'})
+        session.change('add', 'OpaqueRef:2', {'uuid': 'b', 'name_label': 'snapshot'})
+        # unknown, so the cache picks up the changes first
+        self.assertEqual(cache.get('VM', 'OpaqueRef:2')['name_label'], 'snapshot')
+        self.assertEqual(cache.get('VM', 'OpaqueRef:1')['name_label'], 'db')
+        session.change('del', 'OpaqueRef:2')
+        cache.refresh()
+        self.assertEqual(sorted(cache.all('VM')), ['OpaqueRef:1'])
+        self.assertEqual([c for c in session.calls if c[0] != 'event'], [])
+
+    def test_forget(self):
+        session = FakeSession()
+        cache = metadata.MetadataCache(session)
+        cache.all('VM')
+        cache.forget('VM', 'OpaqueRef:1')
+        self.assertEqual(cache.all('VM'), {})
+        self.assertEqual(cache.find('VM', 'missing'), None)
+
+    def test_unknown_object(self):
+        cache = metadata.MetadataCache(FakeSession())
+        self.assertRaises(XenAPI.Failure, cache.get, 'VM', 'OpaqueRef:9')
+
+    def test_without_event_from(self):
+        session = FakeSession(events=False)
+        cache = metadata.MetadataCache(session)
+        self.assertEqual(sorted(cache.all('VM')), ['OpaqueRef:1'])
+        self.assertIn(('VM', 'get_all_records'), session.calls)
+        # every refresh loads everything again
+        session.objects['VM']['OpaqueRef:2'] = {'uuid': 'b'}
+        cache.refresh()
+        self.assertEqual(sorted(cache.all('VM')), ['OpaqueRef:1', 'OpaqueRef:2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import shutil
+import tempfile
+import time
+import unittest
+
+import planner
+import state
+
+GB = 1024 ** 3
+
+
+class FakeMetadata(object):
+
+    def __init__(self):
+        self.records = {'VBD': {}, 'VDI': {}, 'VM_metrics': {}}
+
+    def get(self, cls, opaque_ref):
+        return self.records[cls][opaque_ref]
+
+
+class FakeBackup(object):
+
+    def __init__(self):
+        self.metadata = FakeMetadata()
+
+    def vm(self, uuid, size, power_state='Halted', start_time='20261017T08:00:00Z'):
+        records = self.metadata.records
+        records['VDI'][uuid] = {'uuid': 'vdi-' + uuid, 'virtual_size': str(size),
+                                'physical_utilisation': str(size)}
+        records['VBD'][uuid] = {'type': 'Disk', 'VDI': uuid, 'userdevice': '0'}
+        records['VBD'][uuid + '-cd'] = {'type': 'CD', 'VDI': 'OpaqueRef:NULL', 'userdevice': '3'}
+        records['VM_metrics'][uuid] = {'start_time': start_time}
+        return {'vm_info': {
+            'uuid': uuid,
+            'power_state': power_state,
+            'metrics': uuid,
+            'VBDs': [uuid, uuid + '-cd'],
+        }}
+
+
+def job(estimate, host='host1', srs=('sr1',)):
+    return {'estimate': estimate, 'host': host, 'srs': list(srs)}
+
+
+class PredictTest(unittest.TestCase):
+
+    def test_serial(self):
+        self.assertEqual(planner.predict([job(10), job(20), job(5)]), 35)
+
+    def test_parallel(self):
+        jobs = [job(30, srs=['a']), job(10, srs=['b']), job(10, srs=['c']), job(10, srs=['d'])]
+        # the second worker takes the short jobs while the first runs the long one
+        self.assertEqual(planner.predict(jobs, workers=2, max_per_host=0), 30)
+
+    def test_limits(self):
+        # one export per SR at a time, however many workers
+        jobs = [job(10), job(10), job(10)]
+        self.assertEqual(planner.predict(jobs, workers=3), 30)
+        # and two per host
+        jobs = [job(10, srs=[sr]) for sr in 'abc']
+        self.assertEqual(planner.predict(jobs, workers=3), 20)
+
+    def test_skips_blocked_jobs(self):
+        # the second job waits for the SR of the first, the third does not
+        jobs = [job(10, srs=['a']), job(10, srs=['a']), job(10, srs=['b'])]
+        self.assertEqual(planner.predict(jobs, workers=2), 20)
+
+    def test_unknown(self):
+        self.assertEqual(planner.predict([job(10), job(None)]), None)
+        self.assertEqual(planner.predict([]), 0)
+
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.state = state.BackupState(self.path)
+        self.backup = FakeBackup()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def backed_up(self, planned, seconds):
+        self.planner().record([planned], [{
+            'vm_uuid': planned['vm_info']['uuid'],
+            'status': 'success',
+            'started': time.time(),
+            'duration': seconds,
+        }])
+
+    def planner(self, **kwargs):
+        return planner.BackupPlanner(self.backup, self.state, **kwargs)
+
+    def test_estimates(self):
+        known = self.backup.vm('known', 10 * GB)
+        self.backed_up(self.planner().plan([known])[0][0], 100)
+        # twice as large since
+        known = self.backup.vm('known', 20 * GB)
+        new = self.backup.vm('new', 50 * GB)
+        small = self.backup.vm('small', GB)
+        todo, skipped = self.planner().plan([small, known, new])
+        self.assertEqual([j['vm_info']['uuid'] for j in todo], ['new', 'known', 'small'])
+        self.assertEqual([j['estimate'] for j in todo], [500, 200, 10])
+        self.assertEqual(todo[1]['size'], 20 * GB)
+
+    def test_without_history(self):
+        todo, skipped = self.planner().plan([self.backup.vm('a', GB), self.backup.vm('b', 2 * GB)])
+        self.assertEqual([j['estimate'] for j in todo], [None, None])
+        self.assertEqual(todo[0]['vm_info']['uuid'], 'b')
+
+    def test_skip_unchanged(self):
+        vm = self.backup.vm('vm', GB)
+        self.backed_up(self.planner().plan([vm])[0][0], 10)
+        self.assertEqual(self.planner(skip_unchanged=True).plan([vm]), ([], [vm]))
+        self.assertEqual(self.planner().plan([vm])[0], [vm])
+        # expired
+        self.assertEqual(self.planner(skip_unchanged=True, max_skip_age=-1).plan([vm])[0], [vm])
+
+    def test_changed(self):
+        vm = self.backup.vm('vm', GB)
+        self.backed_up(self.planner().plan([vm])[0][0], 10)
+        restarted = self.backup.vm('vm', GB, start_time='20261017T09:00:00Z')
+        self.assertEqual(self.planner(skip_unchanged=True).plan([restarted])[0], [restarted])
+        running = self.backup.vm('vm', GB, power_state='Running')
+        self.assertEqual(self.planner(skip_unchanged=True).plan([running])[0], [running])
+        self.assertEqual(running['fingerprint'], None)
+
+
+if __name__ == '__main__':
+    unittest.main()
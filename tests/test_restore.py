@@ -0,0 +1,77 @@
+import gzip
+import json
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import integrity
+import restore
+import storage
+
+
+def vhd(size, length=4096):
+    footer = restore.VHD_COOKIE + b'\0' * 40 + struct.pack('>Q', size) + b'\0' * 8
+    return footer + b'\1' * (length - len(footer))
+
+
+class RestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.backend = storage.LocalStorage(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, data, compressed=False):
+        location = os.path.join(self.path, name)
+        f = gzip.open(location, 'wb') if compressed else open(location, 'wb')
+        with f:
+            f.write(data)
+        return location
+
+    def read(self, archive):
+        chunks, length = archive
+        return b''.join(chunks), length
+
+    def test_vhd_size(self):
+        self.assertEqual(restore.vhd_size(self.backend, self.write('disk.vhd', vhd(10 * 2 ** 30))), 10 * 2 ** 30)
+        self.assertEqual(restore.vhd_size(self.backend, self.write('disk.vhd.gz', vhd(2 ** 40), True)), 2 ** 40)
+
+    def test_not_a_vhd(self):
+        location = self.write('disk.vhd', b'\0' * 4096)
+        self.assertRaises(restore.RestoreError, restore.vhd_size, self.backend, location)
+
+    def test_open_archive(self):
+        data = os.urandom(100000)
+        self.assertEqual(self.read(restore.open_archive(self.backend, self.write('vm.xva', data))),
+                         (data, len(data)))
+
+    def test_sent_compressed(self):
+        location = self.write('vm.xva.gz', b'x' * 100000, True)
+        self.assertEqual(self.read(restore.open_archive(self.backend, location)),
+                         (open(location, 'rb').read(), os.path.getsize(location)))
+
+    def test_decompressed(self):
+        data = b'x' * 100000
+        location = self.write('vm.xva.gz', data, True)
+        # counted without a manifest
+        self.assertEqual(self.read(restore.open_archive(self.backend, location, send_compressed=())),
+                         (data, len(data)))
+        counted = []
+        decompressed = restore.decompressed
+        restore.decompressed = lambda *args: counted.append(args) or decompressed(*args)
+        try:
+            self.backend.put(location + integrity.INTEGRITY_SUFFIX, json.dumps({'uncompressed_size': len(data)}))
+            self.assertEqual(self.read(restore.open_archive(self.backend, location, send_compressed=())),
+                             (data, len(data)))
+        finally:
+            restore.decompressed = decompressed
+        # the manifest spares decompressing it twice
+        self.assertEqual(len(counted), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+import scheduler
+
+
+class LimiterTest(unittest.TestCase):
+
+    def test_limits_per_key(self):
+        limiter = scheduler.Limiter({'host': 2, 'sr': 1})
+        first = [('host', 'a'), ('sr', 'x')]
+        self.assertTrue(limiter.can_acquire(first))
+        limiter.acquire(first)
+        # the SR is busy, whatever the host
+        self.assertFalse(limiter.can_acquire([('host', 'b'), ('sr', 'x')]))
+        self.assertTrue(limiter.can_acquire([('host', 'a'), ('sr', 'y')]))
+        limiter.acquire([('host', 'a'), ('sr', 'y')])
+        self.assertFalse(limiter.can_acquire([('host', 'a'), ('sr', 'z')]))
+        limiter.release(first)
+        self.assertTrue(limiter.can_acquire([('host', 'a'), ('sr', 'x')]))
+
+    def test_unlimited(self):
+        limiter = scheduler.Limiter({'host': 0})
+        for i in range(10):
+            self.assertTrue(limiter.can_acquire([('host', 'a'), ('sr', 'x')]))
+            limiter.acquire([('host', 'a'), ('sr', 'x')])
+
+    def test_release_forgets_idle_keys(self):
+        limiter = scheduler.Limiter({'host': 1})
+        limiter.acquire([('host', 'a')])
+        limiter.release([('host', 'a')])
+        self.assertEqual(limiter.running, {})
+
+
+class BudgetTest(unittest.TestCase):
+
+    def test_shared_between_schedulers(self):
+        budget = scheduler.Budget(2)
+        limiter = budget.limiter
+        for i in range(2):
+            self.assertTrue(limiter.can_acquire(budget.keys))
+            limiter.acquire(budget.keys)
+        self.assertFalse(limiter.can_acquire(budget.keys))
+        limiter.release(budget.keys)
+        self.assertTrue(limiter.can_acquire(budget.keys))
+
+    def test_unlimited(self):
+        budget = scheduler.Budget()
+        for i in range(100):
+            budget.limiter.acquire(budget.keys)
+        self.assertTrue(budget.limiter.can_acquire(budget.keys))
+
+
+class SnapshotReleaseTest(unittest.TestCase):
+
+    def test_releases_once(self):
+        calls = []
+        released = scheduler.SnapshotRelease(lambda: calls.append(1))
+        released.defer()
+        released()
+        released()
+        self.assertTrue(released.deferred)
+        self.assertEqual(calls, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import incremental
+import storage
+import xenbackup
+
+
+class FakeMetadata(object):
+
+    def __init__(self, disks):
+        vbds = []
+        self.records = {'VM': {}, 'VBD': {}, 'VDI': {}}
+        for userdevice in disks:
+            vbd = 'OpaqueRef:vbd{}'.format(userdevice)
+            self.records['VBD'][vbd] = {'type': 'Disk', 'VDI': 'OpaqueRef:vdi' + userdevice, 'userdevice': userdevice}
+            self.records['VDI']['OpaqueRef:vdi' + userdevice] = {'uuid': 'vdi-' + userdevice}
+            vbds.append(vbd)
+        self.records['VBD']['OpaqueRef:cd'] = {'type': 'CD', 'VDI': 'OpaqueRef:NULL', 'userdevice': '3'}
+        self.records['VM']['OpaqueRef:snapshot'] = {'uuid': 'snapshot', 'VBDs': vbds + ['OpaqueRef:cd']}
+
+    def get(self, cls, opaque_ref):
+        return self.records[cls][opaque_ref]
+
+    def find(self, cls, uuid):
+        return None
+
+
+class SplitDisksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.downloads = []
+        self.deleted = []
+        self.failing = set()
+        self.running = 0
+        self.concurrent = 0
+        self.lock = threading.Lock()
+        # exports through stubbed downloads, without a session
+        backup = self.backup = xenbackup.XenBackup.__new__(xenbackup.XenBackup)
+        backup.server = 'xenserver'
+        backup.logger = logging.getLogger('test')
+        backup.auth = 'dXNlcjpwYXNzd29yZA=='
+        backup.buffer_size = 1024 * 1024
+        backup.incremental = False
+        backup.split_disks = True
+        backup.disk_streams = 2
+        backup.storage = None
+        backup.shaper = None
+        backup.run_metrics = None
+        backup.compression = None
+        backup.catalog = None
+        backup.enable_rotate = False
+        backup.metadata = FakeMetadata(['0', '1', '2', '4'])
+        backup._download_url = self.download
+        backup.delete_snapshot = lambda opaque_ref, vm_info, wait=True, released=None: self.deleted.append(opaque_ref)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def download(self, path, url, mode=None, ext='.xva', **kwargs):
+        with self.lock:
+            self.running += 1
+            self.concurrent = max(self.concurrent, self.running)
+            self.downloads.append(url)
+        try:
+            time.sleep(0.05)
+            if url in self.failing:
+                self.failing.remove(url)
+                raise IOError('connection reset')
+            with open(path + ext, 'wb') as f:
+                f.write(url)
+            return path + ext, mode
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def export(self):
+        vm_info = {'uuid': 'uuid', 'name_label': 'vm'}
+        return self.backup.export_incremental('OpaqueRef:snapshot', 'OpaqueRef:vm', vm_info, self.path,
+                                              retry_max=1, retry_delay=0)
+
+    def test_split(self):
+        self.assertTrue(self.export())
+        self.assertEqual(self.concurrent, 2)
+        self.assertEqual(sorted(self.downloads), [
+            'https://xenserver/export_metadata?uuid=snapshot',
+            'https://xenserver/export_raw_vdi?vdi=vdi-0&format=vhd',
+            'https://xenserver/export_raw_vdi?vdi=vdi-1&format=vhd',
+            'https://xenserver/export_raw_vdi?vdi=vdi-2&format=vhd',
+            'https://xenserver/export_raw_vdi?vdi=vdi-4&format=vhd',
+        ])
+        # a full restore point, the snapshot is not kept
+        point = incremental.RestorePointIndex(os.path.join(self.path, 'vm')).latest()
+        self.assertEqual(point['type'], 'full')
+        self.assertEqual(point['metadata'], point['id'] + '.metadata.xva')
+        self.assertEqual(sorted(point['disks']), ['0', '1', '2', '4'])
+        self.assertEqual(point['disks']['4'], {'vdi_uuid': 'vdi-4', 'file': point['id'] + '.4.vhd', 'delta': False})
+        self.assertEqual(self.deleted, ['OpaqueRef:snapshot'])
+
+    def test_one_stream(self):
+        self.backup.disk_streams = 1
+        self.assertTrue(self.export())
+        self.assertEqual(self.concurrent, 1)
+        self.assertEqual(len(self.downloads), 5)
+
+    def test_retry_failed_disk(self):
+        url = 'https://xenserver/export_raw_vdi?vdi=vdi-1&format=vhd'
+        self.failing.add(url)
+        self.assertTrue(self.export())
+        # the other parts are not downloaded again
+        self.assertEqual(len(self.downloads), 6)
+        self.assertEqual(self.downloads.count(url), 2)
+        point = incremental.RestorePointIndex(os.path.join(self.path, 'vm')).latest()
+        self.assertEqual(sorted(point['disks']), ['0', '1', '2', '4'])
+
+
+class RunParallelTest(unittest.TestCase):
+
+    def test_first_error_after_all_items(self):
+        done = []
+
+        def work(item):
+            if item == 2:
+                raise ValueError(item)
+            done.append(item)
+
+        self.assertRaises(ValueError, storage.run_parallel, work, range(10), 3)
+        self.assertEqual(sorted(done), [0, 1, 3, 4, 5, 6, 7, 8, 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import unittest
+
+import storage
+
+try:
+    import boto3
+    from moto import mock_s3
+except ImportError:
+    boto3 = mock_s3 = None
+
+MB = 1024 * 1024
+# the smallest part S3 takes, except for the last one
+PART_SIZE = 5 * MB
+
+
+class FailingClient(object):
+    '''
+    Fails the upload of one part.
+    '''
+
+    def __init__(self, client, part):
+        self.client = client
+        self.part = part
+
+    def upload_part(self, **kwargs):
+        if kwargs['PartNumber'] == self.part:
+            raise IOError('connection reset')
+        return self.client.upload_part(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class RecordingClient(object):
+    '''
+    Keeps the sizes of the uploaded parts instead of the parts.
+    '''
+
+    def __init__(self):
+        self.parts = {}
+        self.completed = None
+
+    def create_multipart_upload(self, **kwargs):
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, **kwargs):
+        self.parts[kwargs['PartNumber']] = len(kwargs['Body'])
+        return {'ETag': str(kwargs['PartNumber'])}
+
+    def complete_multipart_upload(self, **kwargs):
+        self.completed = [self.parts[part['PartNumber']] for part in kwargs['MultipartUpload']['Parts']]
+
+    def abort_multipart_upload(self, **kwargs):
+        self.completed = None
+
+
+class PartSizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = RecordingClient()
+
+    def test_parts_double(self):
+        writer = storage.MultipartWriter(self.client, 'backups', 'key', part_size=1, concurrency=2)
+        writer.write('x' * 3500)
+        writer.close()
+        sizes = self.client.completed
+        self.assertEqual(sum(sizes), 3500)
+        self.assertEqual(len(sizes), 1000 + 1000 + 125)
+        self.assertEqual(set(sizes[:1000]), set([1]))
+        self.assertEqual(set(sizes[1000:2000]), set([2]))
+        self.assertEqual(set(sizes[2000:]), set([4]))
+
+    def test_parts_double_past_expected_size(self):
+        writer = storage.MultipartWriter(self.client, 'backups', 'key', part_size=MB, expected_size=1500 * MB)
+        self.assertEqual(writer.part_size, MB)
+        self.assertEqual(writer.planned_parts, 1500)
+        writer.parts = 2498
+        writer._submit('x')
+        self.assertEqual(writer.part_size, MB)
+        writer._submit('x')
+        self.assertEqual(writer.part_size, 2 * MB)
+        writer.abort()
+
+    def test_expected_size_raises_part_size(self):
+        writer = storage.MultipartWriter(self.client, 'backups', 'key', part_size=64 * MB,
+                                         expected_size=1024 ** 4)
+        self.assertEqual(writer.part_size, 117 * MB)
+        self.assertTrue(writer.planned_parts <= storage.S3_MAX_PARTS - storage.S3_PART_GROWTH)
+        small = storage.MultipartWriter(self.client, 'backups', 'key', part_size=64 * MB, expected_size=10 * MB)
+        self.assertEqual(small.part_size, 64 * MB)
+
+    def test_too_many_parts(self):
+        writer = storage.MultipartWriter(self.client, 'backups', 'key', part_size=1)
+        writer.parts = storage.S3_MAX_PARTS
+        writer.upload_id = 'upload'
+        self.assertRaises(Exception, writer.write, 'x')
+
+    def test_max_object_size(self):
+        self.assertEqual(storage.max_object_size(64 * MB), storage.S3_MAX_OBJECT_SIZE)
+        self.assertEqual(storage.max_object_size(5 * MB), 5 * MB * 1000 * 1023)
+
+
+def pattern(size):
+    return ''.join(chr(i % 251) for i in xrange(size))
+
+
+@unittest.skipIf(mock_s3 is None, 'moto is not installed')
+class S3StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_s3()
+        self.mock.start()
+        self.client = boto3.client('s3', region_name='us-east-1',
+                                   aws_access_key_id='test', aws_secret_access_key='test')
+        self.client.create_bucket(Bucket='backups')
+        self.storage = storage.S3Storage('backups', prefix='xen', part_size=PART_SIZE,
+                                         concurrency=2, client=self.client)
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def upload(self, data, pieces=MB):
+        upload = self.storage.upload(self.storage.join(self.storage.folder('vm'), 'vm-uuid'), None)
+        upload.start('none', '.xva')
+        writer = upload.writer()
+        for i in xrange(0, len(data), pieces):
+            writer.write(data[i:i + pieces])
+        return upload, writer
+
+    def uploads(self):
+        return self.client.list_multipart_uploads(Bucket='backups').get('Uploads', [])
+
+    def test_multipart_upload(self):
+        data = pattern(12 * MB + 3)
+        upload, writer = self.upload(data)
+        self.assertTrue(writer.upload_id is not None)
+        writer.close()
+        location = upload.finish()
+        self.assertTrue(location.startswith('xen/vm/vm-uuid.'))
+        self.assertEqual(writer.parts, 3)
+        self.assertEqual(self.storage.size(location), len(data))
+        self.assertEqual(self.storage.read(location), data)
+        self.assertEqual(self.uploads(), [])
+
+    def test_small_object(self):
+        upload, writer = self.upload('small')
+        self.assertTrue(writer.upload_id is None)
+        writer.close()
+        self.assertEqual(self.storage.read(upload.finish()), 'small')
+
+    def test_abort(self):
+        upload, writer = self.upload(pattern(11 * MB))
+        self.assertEqual(len(self.uploads()), 1)
+        writer.abort()
+        self.assertEqual(self.uploads(), [])
+        self.assertEqual(self.storage.list('xen/'), [])
+
+    def test_failed_part_aborts(self):
+        self.storage.client = FailingClient(self.client, part=2)
+        data = pattern(11 * MB)
+        upload, writer = self.upload(data[:6 * MB])
+        try:
+            # the error surfaces on one of the next writes or on close
+            writer.write(data[6 * MB:])
+            writer.close()
+        except IOError:
+            # as _download_url does
+            writer.abort()
+        else:
+            self.fail('the failed part was not raised')
+        self.assertEqual(self.uploads(), [])
+        self.assertEqual(self.storage.list('xen/'), [])
+
+    def test_rotate(self):
+        keys = ['xen/vm/vm-uuid.2026-01-0{}-120000.xva'.format(day) for day in range(1, 6)]
+        for key in keys:
+            self.storage.put(key, 'data')
+            self.storage.put(key + '.integrity.json', '{}')
+        # another extension and another VM are left alone
+        self.storage.put('xen/vm/vm-uuid.2026-01-01-120000.xva.gz', 'data')
+        self.storage.put('xen/other/other-uuid.2026-01-01-120000.xva', 'data')
+        expiring = []
+        self.storage.rotate(keys[-1], 2, expiring.extend, sidecars=['.integrity.json'])
+        self.assertEqual(expiring, keys[:3])
+        self.assertEqual(sorted(self.storage.list('xen/')), sorted(
+            keys[3:] + [key + '.integrity.json' for key in keys[3:]] + [
+                'xen/vm/vm-uuid.2026-01-01-120000.xva.gz',
+                'xen/other/other-uuid.2026-01-01-120000.xva',
+            ]
+        ))
+        self.assertEqual([created for key, created, _ in self.storage.rotated(keys[-1], ['.integrity.json'])],
+                         sorted(created for key, created, _ in self.storage.rotated(keys[-1], ['.integrity.json'])))
+
+    def test_delete_in_batches(self):
+        keys = ['xen/vm/{}'.format(i) for i in range(storage.S3_DELETE_BATCH + 10)]
+        for key in keys:
+            self.storage.put(key, '')
+        self.storage.delete(keys)
+        self.assertEqual(self.storage.list('xen/'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+import logging
+import random
+import threading
+import time
+import unittest
+
+import XenAPI
+import tasks
+import xenbackup
+
+
+class Namespace(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeSession(object):
+    '''
+    Answers task.get_record from `records`, raising the Failures in it.
+    '''
+
+    def __init__(self, records):
+        self.records = records
+        self.xenapi = Namespace(task=Namespace(get_record=self.get_record, destroy=lambda task: None))
+
+    def get_record(self, task):
+        record = self.records[task]
+        if isinstance(record, XenAPI.Failure):
+            raise record
+        return record
+
+
+class BackoffTest(unittest.TestCase):
+
+    def test_doubles_with_jitter(self):
+        random.seed(1)
+        for attempt in range(1, 5):
+            delay = 2 ** (attempt - 1) * 10
+            for i in range(50):
+                self.assertTrue(delay / 2.0 <= tasks.backoff(10, attempt) <= delay)
+
+    def test_capped(self):
+        for i in range(50):
+            self.assertTrue(80 <= tasks.backoff(10, 20) <= 160)
+            self.assertTrue(15 <= tasks.backoff(10, 20, cap=30) <= 30)
+
+    def test_first_attempts(self):
+        # attempt 0 waits as long as the first retry
+        for i in range(50):
+            self.assertTrue(5 <= tasks.backoff(10, 0) <= 10)
+
+
+class PollTest(unittest.TestCase):
+
+    def poll(self, records):
+        watcher = tasks.TaskWatcher(FakeSession(records), poll_interval=0)
+        watcher.waiting = dict((task, 1) for task in records)
+        watcher._poll()
+        return watcher.tasks
+
+    def test_records(self):
+        record = {'status': 'pending', 'progress': 0.5}
+        self.assertEqual(self.poll({'OpaqueRef:t': record}), {'OpaqueRef:t': record})
+
+    def test_lost_task(self):
+        polled = self.poll({'OpaqueRef:t': XenAPI.Failure(['HANDLE_INVALID', 'task', 'OpaqueRef:t'])})
+        self.assertEqual(polled['OpaqueRef:t']['error_info'], [tasks.TASK_LOST, 'OpaqueRef:t'])
+
+    def test_session_error(self):
+        polled = self.poll({'OpaqueRef:t': XenAPI.Failure(['SESSION_INVALID', 'OpaqueRef:s'])})
+        self.assertEqual(polled['OpaqueRef:t']['status'], 'failure')
+        self.assertEqual(polled['OpaqueRef:t']['error_info'], ['SESSION_INVALID', 'OpaqueRef:s'])
+
+
+class FakeWatcher(object):
+    '''
+    Fails the tasks of `cls.destroy` with the next of `errors`, None for
+    a task that succeeds.
+    '''
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+
+    def submit(self, method, opaque_ref):
+        return opaque_ref
+
+    def wait(self, task):
+        error = self.errors.pop(0)
+        if error:
+            raise XenAPI.Failure(error)
+
+
+class DestroyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.delay = xenbackup.DESTROY_RETRY_DELAY
+        xenbackup.DESTROY_RETRY_DELAY = 0
+        self.forgotten = []
+        # no session needed to destroy through a watcher
+        self.backup = xenbackup.XenBackup.__new__(xenbackup.XenBackup)
+        self.backup.server = 'xenserver'
+        self.backup.logger = logging.getLogger('test')
+        self.backup.run_metrics = None
+        self.backup.metadata = Namespace(forget=lambda cls, opaque_ref: self.forgotten.append(opaque_ref))
+
+    def tearDown(self):
+        xenbackup.DESTROY_RETRY_DELAY = self.delay
+
+    def destroy(self, errors):
+        self.backup.task_watcher = FakeWatcher(errors)
+        self.backup._destroy('VDI', ['OpaqueRef:vdi'], {'name_label': 'vm', 'uuid': 'uuid'})
+
+    def test_destroyed(self):
+        self.destroy([None])
+        self.assertEqual(self.forgotten, ['OpaqueRef:vdi'])
+
+    def test_already_gone(self):
+        self.destroy([['HANDLE_INVALID', 'VDI', 'OpaqueRef:vdi']])
+        self.assertEqual(self.forgotten, ['OpaqueRef:vdi'])
+
+    def test_lost_task_is_retried(self):
+        self.destroy([[tasks.TASK_LOST, 'OpaqueRef:t'], None])
+        self.assertEqual(self.forgotten, ['OpaqueRef:vdi'])
+
+    def test_session_error_is_raised(self):
+        errors = [['SESSION_INVALID', 'OpaqueRef:s']] * (xenbackup.DESTROY_RETRIES + 1)
+        self.assertRaises(XenAPI.Failure, self.destroy, errors)
+        self.assertEqual(self.forgotten, [])
+
+
+class AsyncSession(object):
+    '''
+    Runs VM.snapshot as a task that is done at once and reports it with
+    event.from, until the session is made `invalid`.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}
+        self.new = []
+        self.invalid = False
+        self.followers = set()
+        self.xenapi = Namespace(
+            Async=Namespace(VM=Namespace(snapshot=self.snapshot)),
+            task=Namespace(get_record=self.get_record, destroy=lambda task: None),
+            event=Namespace(**{'from': self.events}),
+        )
+
+    def check(self):
+        if self.invalid:
+            raise XenAPI.Failure(['SESSION_INVALID', 'OpaqueRef:session'])
+
+    def snapshot(self, vm, name):
+        self.check()
+        with self.lock:
+            task = 'OpaqueRef:task-{}'.format(vm)
+            self.records[task] = {'status': 'success', 'result': '<value>{}-snapshot</value>'.format(vm)}
+            self.new.append(task)
+        return task
+
+    def events(self, classes, token, timeout):
+        self.followers.add(threading.current_thread().name)
+        self.check()
+        with self.lock:
+            new, self.new = self.new, []
+        if not new:
+            time.sleep(0.01)
+        return {
+            'events': [{'class': 'task', 'operation': 'mod', 'ref': task, 'snapshot': self.records[task]}
+                       for task in new],
+            'token': token + 'x',
+        }
+
+    def get_record(self, task):
+        self.check()
+        return self.records[task]
+
+
+class SharedWatcherTest(unittest.TestCase):
+    '''
+    The workers of a pool share the watcher, and its session, of the
+    first login.
+    '''
+
+    def setUp(self):
+        self.session = AsyncSession()
+        self.watcher = tasks.TaskWatcher(self.session, timeout=0, poll_interval=0.01)
+
+    def snapshots(self, workers):
+        results = {}
+
+        def snapshot(vm):
+            results[vm] = self.watcher.call('VM.snapshot', vm, 'name')
+
+        threads = [threading.Thread(target=snapshot, args=('OpaqueRef:vm{}'.format(i),)) for i in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        return results
+
+    def test_one_loop_follows_every_worker(self):
+        results = self.snapshots(4)
+        self.assertEqual(results, dict(('OpaqueRef:vm{}'.format(i), 'OpaqueRef:vm{}-snapshot'.format(i))
+                                       for i in range(4)))
+        self.assertEqual(self.session.followers, set(['xenbackup-tasks']))
+
+    def test_session_error_reaches_every_worker(self):
+        self.session.snapshot('OpaqueRef:vm0', 'name')
+        self.session.snapshot('OpaqueRef:vm1', 'name')
+        self.session.new = []
+        self.session.invalid = True
+        results = {}
+        threads = [threading.Thread(target=lambda task=task: results.__setitem__(task, self.wait(task)))
+                   for task in ['OpaqueRef:task-OpaqueRef:vm0', 'OpaqueRef:task-OpaqueRef:vm1']]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        self.assertEqual(results.values(), [['SESSION_INVALID', 'OpaqueRef:session']] * 2)
+
+    def wait(self, task):
+        try:
+            self.watcher.wait(task)
+        except XenAPI.Failure as e:
+            return e.details
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import time
+import unittest
+
+import throttle
+
+MB = throttle.MB
+
+
+def at(hour, minute):
+    '''
+    :returns: float
+        today at `hour`:`minute`, local time
+    '''
+    t = time.localtime()
+    return time.mktime((t.tm_year, t.tm_mon, t.tm_mday, hour, minute, 0, 0, 0, -1))
+
+
+class Clock(object):
+    '''
+    Stands in for the time module, sleeping only moves it forward.
+    '''
+
+    localtime = staticmethod(time.localtime)
+
+    def __init__(self, now):
+        self.now = now
+        self.slept = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+class ClockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock(at(12, 0))
+        self.time, throttle.time = throttle.time, self.clock
+
+    def tearDown(self):
+        throttle.time = self.time
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def test_factor(self):
+        schedule = throttle.Schedule('08:00-18:00=0.2, 22:00-06:00=2')
+        self.assertEqual(schedule.factor(at(12, 0)), 0.2)
+        self.assertEqual(schedule.factor(at(18, 0)), 1.0)
+        # across midnight
+        self.assertEqual(schedule.factor(at(23, 30)), 2)
+        self.assertEqual(schedule.factor(at(5, 59)), 2)
+
+    def test_seconds_left(self):
+        schedule = throttle.Schedule('22:00-06:00=0')
+        self.assertEqual(schedule.seconds_left(at(23, 0)), 7 * 3600)
+        self.assertEqual(schedule.seconds_left(at(12, 0)), 0)
+
+    def test_invalid(self):
+        self.assertRaises(Exception, throttle.Schedule, '08:00=0.2')
+        self.assertRaises(Exception, throttle.Schedule, '08:00-18:00=fast')
+
+
+class ThrottleTest(ClockTest):
+
+    def test_rate(self):
+        limit = throttle.Throttle(10 * MB)
+        # the first second worth is a burst, the rest is spread out
+        for i in range(30):
+            limit.consume(MB)
+        self.assertAlmostEqual(self.clock.slept, 2.0)
+
+    def test_unlimited(self):
+        limit = throttle.Throttle()
+        for i in range(30):
+            limit.consume(MB)
+        self.assertEqual(self.clock.slept, 0)
+
+    def test_schedule(self):
+        limit = throttle.Throttle(10 * MB, schedule=throttle.Schedule('11:00-13:00=0.5'))
+        self.assertEqual(limit.current_rate(self.clock.now), 5 * MB)
+
+    def test_paused(self):
+        limit = throttle.Throttle(10 * MB, schedule=throttle.Schedule('11:00-12:30=0'))
+        limit.consume(MB)
+        # waits, a minute at a time, for the end of the window
+        self.assertEqual(self.clock.now, at(12, 30))
+
+    def test_backoff(self):
+        limit = throttle.Throttle(10 * MB, adaptive=True)
+        limit.observe(MB, 0.01)
+        for i in range(3):
+            self.clock.now += 1
+            limit.observe(MB, 1)
+        self.assertEqual(limit.backoff, 0.75 ** 3)
+        self.assertEqual(limit.current_rate(), 10 * MB * 0.75 ** 3)
+        # cut until the averaged latency is back, then recovered 5% a second
+        backoffs = []
+        for i in range(40):
+            self.clock.now += 1
+            limit.observe(MB, 0.01)
+            backoffs.append(limit.backoff)
+        self.assertEqual(min(backoffs), limit.min_backoff)
+        lowest = backoffs.index(limit.min_backoff)
+        steps = [b - a for a, b in zip(backoffs[lowest:], backoffs[lowest + 1:])]
+        self.assertTrue(all(0 <= step < 0.051 for step in steps))
+        self.assertEqual(backoffs[-1], 1.0)
+
+    def test_backoff_without_rate(self):
+        limit = throttle.Throttle(adaptive=True)
+        for i in range(20):
+            self.clock.now += 0.1
+            limit.consume(MB)
+        limit.observe(MB, 0.01)
+        self.clock.now += 1
+        limit.observe(MB, 1)
+        # the measured combined throughput is cut instead
+        self.assertAlmostEqual(limit.current_rate(), limit.throughput * 0.75)
+        self.assertTrue(limit.throughput > 0)
+
+
+class ShaperTest(ClockTest):
+
+    def test_group(self):
+        shaper = throttle.Shaper(rate=100 * MB, per_host=10 * MB, per_sr=20 * MB)
+        first = shaper.group(host='host1', srs=['sr1'], destination='/backups')
+        second = shaper.group(host='host1', srs=['sr2'])
+        # the host throttle is shared, the SR throttles are not
+        self.assertIs(first.throttles[0], shaper.throttle)
+        self.assertIs(first.throttles[1], second.throttles[1])
+        self.assertIsNot(first.throttles[2], second.throttles[2])
+        self.assertEqual(first.destination.rate, 0)
+        self.assertEqual(second.destination, None)
+
+    def test_slowest_wins(self):
+        shaper = throttle.Shaper(rate=100 * MB, per_host=10 * MB)
+        group = shaper.group(host='host1')
+        for i in range(30):
+            group.consume(MB)
+        self.assertAlmostEqual(self.clock.slept, 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+import BaseHTTPServer
+import httplib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import transfer
+
+MB = 1024 * 1024
+BLOCK = transfer.SPARSE_BLOCK
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = self.server.body
+        self.send_response(200)
+        if self.path == '/chunked':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(body), 100000):
+                piece = body[i:i + 100000]
+                self.wfile.write('{:x}\r\n{}\r\n'.format(len(piece), piece))
+            self.wfile.write('0\r\n\r\n')
+            return
+        # a body cut short announces more than it sends
+        length = len(body) + (1000 if self.path == '/short' else 0)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Sink(object):
+
+    def __init__(self):
+        self.pieces = []
+
+    def write(self, data):
+        self.pieces.append(data.tobytes())
+
+    def getvalue(self):
+        return b''.join(self.pieces)
+
+
+class ReadintoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.body = os.urandom(3 * MB + 5)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path):
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=10)
+        connection.request('GET', path)
+        return connection.getresponse()
+
+    def test_copy(self):
+        for path in ('/', '/chunked'):
+            sink = Sink()
+            stats = {}
+            total = transfer.copy(self.get(path), sink, transfer.allocate_buffer(MB), stats=stats)
+            self.assertEqual(total, len(self.server.body))
+            self.assertEqual(stats['bytes'], total)
+            self.assertEqual(sink.getvalue(), self.server.body)
+            # the buffer is filled before every write
+            self.assertTrue(all(len(p) == MB for p in sink.pieces[:-1]))
+
+    def test_short_body(self):
+        self.assertRaises(httplib.IncompleteRead, transfer.copy, self.get('/short'), Sink(),
+                          transfer.allocate_buffer(MB))
+
+
+class ZeroRunsTest(unittest.TestCase):
+
+    def test_runs(self):
+        data = b'\0' * BLOCK + b'x' * BLOCK + b'\0' * 2 * BLOCK + b'x'
+        self.assertEqual(transfer.zero_runs(data), [
+            [0, BLOCK, True],
+            [BLOCK, 2 * BLOCK, False],
+            [2 * BLOCK, 4 * BLOCK, True],
+            [4 * BLOCK, 4 * BLOCK + 1, False],
+        ])
+
+    def test_aligned_to_the_file(self):
+        # written at offset 100, the first block of the file ends at BLOCK - 100
+        data = b'\0' * (3 * BLOCK)
+        self.assertEqual(transfer.zero_runs(memoryview(data), 100), [
+            [0, BLOCK - 100, False],
+            [BLOCK - 100, 3 * BLOCK - 100, True],
+            [3 * BLOCK - 100, 3 * BLOCK, False],
+        ])
+
+    def test_short(self):
+        self.assertEqual(transfer.zero_runs(b'\0' * 10), [[0, 10, False]])
+        self.assertEqual(transfer.zero_runs(b''), [])
+
+
+class FileWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file = os.path.join(self.path, 'vm.xva')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, pieces, **kwargs):
+        writer = transfer.FileWriter(self.file, **kwargs)
+        for piece in pieces:
+            writer.write(memoryview(piece))
+        writer.close()
+        return writer
+
+    def read(self):
+        with open(self.file, 'rb') as f:
+            return f.read()
+
+    def test_write(self):
+        data = os.urandom(MB + 7)
+        for direct in (False, True):
+            self.write([data[:1000], data[1000:]], direct=direct, buffer_size=64 * 1024)
+            self.assertEqual(self.read(), data)
+
+    def test_offset(self):
+        self.write([b'a' * 3 * BLOCK])
+        self.write([b'b' * 10], offset=BLOCK)
+        self.assertEqual(self.read(), b'a' * BLOCK + b'b' * 10)
+
+    def test_checkpoint(self):
+        offsets = []
+        self.write([b'x' * BLOCK] * 10, checkpoint=offsets.append, checkpoint_interval=3 * BLOCK)
+        self.assertEqual(offsets, [3 * BLOCK, 6 * BLOCK, 9 * BLOCK, 10 * BLOCK])
+
+    def test_sparse(self):
+        data = b'x' * 10 + b'\0' * (MB - 10) + b'x' * BLOCK + b'\0' * MB
+        writer = self.write([data[:5000], data[5000:]], sparse=True)
+        self.assertEqual(self.read(), data)
+        # the zeros after the first block are holes, but for the block
+        # split between the two writes, and so are those at the end
+        self.assertEqual(writer.skipped, 2 * MB - 2 * BLOCK)
+        self.assertEqual(os.path.getsize(self.file), len(data))
+        self.assertTrue(os.stat(self.file).st_blocks * 512 < MB)
+
+
+class PartialDownloadTest(unittest.TestCase):
+
+    url = 'https://xenserver/export?uuid=1'
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.location = os.path.join(self.path, 'vm')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def interrupted(self, data, mode='none'):
+        partial = transfer.PartialDownload(self.location, self.url)
+        partial.start(mode, '.xva')
+        writer = partial.writer()
+        writer.write(data)
+        # as _download_url does when the download fails
+        writer.abort()
+
+    def test_resume(self):
+        data = os.urandom(MB)
+        self.interrupted(data[:100000])
+        partial = transfer.PartialDownload(self.location, self.url)
+        # from the last block on disk
+        offset = partial.resume_offset
+        self.assertEqual(offset, 100000 - 100000 % transfer.ALIGNMENT)
+        writer = partial.writer(offset=offset)
+        writer.write(data[offset:])
+        writer.close()
+        path = partial.finish()
+        self.assertEqual(path, self.location + '.xva')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(os.listdir(self.path), ['vm.xva'])
+
+    def test_other_export(self):
+        self.interrupted(b'x' * 100000)
+        partial = transfer.PartialDownload(self.location, 'https://xenserver/export?uuid=2')
+        self.assertEqual(partial.resume_offset, 0)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_compressed(self):
+        # the compressor's state is lost, compressed downloads start over
+        self.interrupted(b'x' * 100000, mode='client')
+        self.assertEqual(transfer.PartialDownload(self.location, self.url).resume_offset, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
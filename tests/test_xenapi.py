@@ -0,0 +1,138 @@
+import errno
+import httplib
+import socket
+import unittest
+import xmlrpclib
+from StringIO import StringIO
+
+import XenAPI
+
+RESPONSE = xmlrpclib.dumps(({'Status': 'Success', 'Value': 'OpaqueRef:1'},), methodresponse=True)
+
+
+class FakeResponse(StringIO):
+
+    status = 200
+    reason = 'OK'
+    msg = None
+    will_close = False
+
+    def getheader(self, name, default=None):
+        return default
+
+
+class FakeConnection(object):
+    '''
+    Fails the request at `stage`, sending, waiting for or reading the
+    response, with `error`.
+    '''
+
+    def __init__(self, stage=None, error=None):
+        self.stage = stage
+        self.error = error
+        self.sent = 0
+        self.closed = False
+
+    def fail(self, stage):
+        if self.stage == stage:
+            self.stage = None
+            raise self.error
+
+    def putrequest(self, *args, **kwargs):
+        pass
+
+    def putheader(self, *args):
+        pass
+
+    def endheaders(self, body):
+        self.sent += 1
+        self.fail('send')
+
+    def getresponse(self, buffering=False):
+        self.fail('response')
+        response = FakeResponse(RESPONSE)
+        if self.stage == 'read':
+            response.read = lambda *args: self.fail('read')
+        return response
+
+    def close(self):
+        self.closed = True
+
+
+class ScriptedTransport(XenAPI.PooledTransport):
+
+    def __init__(self, connections):
+        XenAPI.PooledTransport.__init__(self, size=2, secure=False)
+        self.script = list(connections)
+
+    def _connect(self, host):
+        self.connects += 1
+        return self.script.pop(0), []
+
+
+class PooledTransportTest(unittest.TestCase):
+
+    def request(self, transport):
+        return transport.request('xenserver', '/', 'body')
+
+    def reused(self, connection):
+        '''
+        :returns: `ScriptedTransport`
+            with `connection` kept alive after a first request, and a
+            fresh connection to reconnect to
+        '''
+        connection.stage, stage = None, connection.stage
+        transport = ScriptedTransport([connection, FakeConnection()])
+        self.request(transport)
+        connection.stage = stage
+        return transport
+
+    def test_keeps_connection(self):
+        connection = FakeConnection()
+        transport = ScriptedTransport([connection])
+        for i in range(3):
+            self.assertEqual(self.request(transport), ({'Status': 'Success', 'Value': 'OpaqueRef:1'},))
+        self.assertEqual(connection.sent, 3)
+        self.assertEqual(transport.stats()['connects'], 1)
+
+    def test_retries_closed_connection(self):
+        for stage, error in [
+            ('response', httplib.BadStatusLine('')),
+            ('response', socket.error(errno.ECONNRESET, 'Connection reset by peer')),
+            ('send', socket.error(errno.EPIPE, 'Broken pipe')),
+        ]:
+            connection = FakeConnection(stage, error)
+            transport = self.reused(connection)
+            self.request(transport)
+            self.assertTrue(connection.closed)
+            self.assertEqual(transport.stats()['reconnects'], 1)
+            self.assertEqual(transport.stats()['connects'], 2)
+
+    def test_no_retry_after_timeout(self):
+        connection = FakeConnection('response', socket.timeout('timed out'))
+        transport = self.reused(connection)
+        self.assertRaises(socket.timeout, self.request, transport)
+        self.assertEqual(connection.sent, 2)
+        self.assertEqual(transport.stats()['reconnects'], 0)
+        self.assertEqual(transport.stats()['errors'], 1)
+
+    def test_no_retry_once_responded(self):
+        connection = FakeConnection('read', socket.error(errno.ECONNRESET, 'Connection reset by peer'))
+        transport = self.reused(connection)
+        self.assertRaises(socket.error, self.request, transport)
+        self.assertEqual(transport.stats()['reconnects'], 0)
+
+    def test_no_retry_of_other_errors(self):
+        connection = FakeConnection('response', socket.error(errno.EHOSTUNREACH, 'No route to host'))
+        transport = self.reused(connection)
+        self.assertRaises(socket.error, self.request, transport)
+        self.assertEqual(transport.stats()['reconnects'], 0)
+
+    def test_no_retry_of_new_connection(self):
+        transport = ScriptedTransport([FakeConnection('response', httplib.BadStatusLine('')), FakeConnection()])
+        self.assertRaises(httplib.BadStatusLine, self.request, transport)
+        self.assertEqual(transport.stats()['connects'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()